@@ -42,17 +42,27 @@ cstr * cstr_copy_from_char(char *string, size_t size) {
 }
 
 cstr_buff * cstr_buff_new(size_t size) {
+    return cstr_buff_new_growable(size, size);
+}
+
+/**
+* Creates a buffer of the given size that cstr_buff_put and cstr_buff_put_span
+* grow on demand, doubling its size each time, until it reaches max_size.
+*/
+cstr_buff * cstr_buff_new_growable(size_t size, size_t max_size) {
     // Allocate a new cstr_buff struct
     cstr_buff *buffer = (cstr_buff *) malloc(sizeof(cstr_buff));
 
     if (buffer != NULL) {
         buffer->data = cstr_new(size);
 
-        if (buffer->data != NULL) {
+        if (buffer->data != NULL && buffer->data->bytes != NULL) {
             buffer->position = 0;
+            buffer->max_size = max_size > size ? max_size : size;
         } else {
             // Allocating the actual char buffer failed
             // so release the newly allocated struct
+            cstr_free(buffer->data);
             free(buffer);
             buffer = NULL;
         }
@@ -73,17 +83,179 @@ void cstr_buff_reset(cstr_buff *buffer) {
     buffer->position = 0;
 }
 
+static int resize(cstr_buff *buffer, size_t new_size) {
+    char *bytes = realloc(buffer->data->bytes, new_size);
+
+    if (bytes == NULL) {
+        return CSTR_UNABLE_TO_ALLOCATE;
+    }
+
+    buffer->data->bytes = bytes;
+    buffer->data->size = new_size;
+    return 0;
+}
+
+/**
+* Grows the buffer until it is larger than required, as a buffer always keeps
+* its last byte free, or until it reaches its max_size.
+*/
+static int grow(cstr_buff *buffer, size_t required) {
+    size_t new_size = buffer->data->size;
+
+    if (new_size >= buffer->max_size) {
+        return CSTR_BUFFER_OVERFLOW;
+    }
+
+    if (new_size == 0) {
+        new_size = 1;
+    }
+
+    while (new_size <= required && new_size < buffer->max_size) {
+        new_size *= 2;
+    }
+
+    if (new_size > buffer->max_size) {
+        new_size = buffer->max_size;
+    }
+
+    return resize(buffer, new_size);
+}
+
 int cstr_buff_put(cstr_buff *buffer, char src) {
+    size_t next_position = buffer->position + 1;
+
+    if (next_position >= buffer->data->size) {
+        if (grow(buffer, next_position)) {
+            return CSTR_BUFFER_OVERFLOW;
+        }
+    }
+
+    buffer->data->bytes[buffer->position] = src;
+    buffer->position = next_position;
+
+    return 0;
+}
+
+int cstr_buff_put_span(cstr_buff *buffer, const char *src, size_t size) {
     int retval = 0;
-    int next_position = buffer->position + 1;
+    size_t available = buffer->data->size - buffer->position - 1;
 
-    if (next_position > 0 && next_position < buffer->data->size) {
-        buffer->data->bytes[buffer->position] = src;
-        buffer->position = next_position;
-    } else {
+    if (size > available) {
+        grow(buffer, buffer->position + size);
+        available = buffer->data->size - buffer->position - 1;
+    }
+
+    // Mirrors cstr_buff_put by keeping what fits and reporting the overflow
+    if (size > available) {
+        size = available;
         retval = CSTR_BUFFER_OVERFLOW;
     }
 
+    memcpy(buffer->data->bytes + buffer->position, src, size);
+    buffer->position += size;
+
     return retval;
 }
 
+int cstr_buff_reserve(cstr_buff *buffer, size_t size) {
+    size_t required = buffer->position + size;
+    size_t new_size = buffer->data->size;
+
+    if (required <= new_size) {
+        return 0;
+    }
+
+    if (new_size == 0) {
+        new_size = 1;
+    }
+
+    while (new_size < required) {
+        new_size *= 2;
+    }
+
+    // Reserving is not bound by the size cap
+    if (new_size > buffer->max_size) {
+        buffer->max_size = new_size;
+    }
+
+    return resize(buffer, new_size);
+}
+
+/**
+* Creates a pool that keeps up to capacity released buffers for reuse. New
+* buffers start at initial_size bytes and may grow to max_size.
+*/
+cstr_buff_pool * cstr_buff_pool_new(size_t capacity, size_t initial_size, size_t max_size) {
+    cstr_buff_pool *pool = (cstr_buff_pool *) malloc(sizeof(cstr_buff_pool));
+
+    if (pool != NULL) {
+        memset(pool, 0, sizeof(cstr_buff_pool));
+        pool->capacity = capacity;
+        pool->initial_size = initial_size;
+        pool->max_size = max_size;
+
+        if (capacity > 0) {
+            pool->buffers = (cstr_buff **) malloc(sizeof(cstr_buff *) * capacity);
+
+            if (pool->buffers == NULL) {
+                free(pool);
+                pool = NULL;
+            }
+        }
+    }
+
+    return pool;
+}
+
+void cstr_buff_pool_free(cstr_buff_pool *pool) {
+    while (pool->count > 0) {
+        cstr_buff_free(pool->buffers[--pool->count]);
+    }
+
+    free(pool->buffers);
+    free(pool);
+}
+
+/**
+* Returns an empty buffer, reusing a released one when there is one. NULL is
+* returned if a new buffer could not be allocated.
+*/
+cstr_buff * cstr_buff_pool_get(cstr_buff_pool *pool) {
+    cstr_buff *buffer;
+
+    if (pool->count > 0) {
+        pool->reused++;
+        return pool->buffers[--pool->count];
+    }
+
+    buffer = cstr_buff_new_growable(pool->initial_size, pool->max_size);
+
+    if (buffer != NULL) {
+        pool->created++;
+    }
+
+    return buffer;
+}
+
+/**
+* Hands a buffer back to the pool. Buffers that grew are shrunk back to the
+* initial size first so that the pool does not hold on to peak sized buffers.
+* The buffer is freed when the pool is full.
+*/
+void cstr_buff_pool_put(cstr_buff_pool *pool, cstr_buff *buffer) {
+    if (pool->count >= pool->capacity) {
+        cstr_buff_free(buffer);
+        return;
+    }
+
+    if (buffer->data->size > pool->initial_size) {
+        if (resize(buffer, pool->initial_size)) {
+            cstr_buff_free(buffer);
+            return;
+        }
+    }
+
+    cstr_buff_reset(buffer);
+    buffer->max_size = pool->max_size;
+    pool->buffers[pool->count++] = buffer;
+}
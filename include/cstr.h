@@ -9,7 +9,8 @@ extern "C" {
 
 // Errors
 typedef enum {
-    CSTR_BUFFER_OVERFLOW = 200
+    CSTR_BUFFER_OVERFLOW = 200,
+    CSTR_UNABLE_TO_ALLOCATE = 201
 } cstr_error;
 
 
@@ -22,8 +23,21 @@ typedef struct {
 typedef struct {
     cstr *data;
     size_t position;
+    size_t max_size;
 } cstr_buff;
 
+typedef struct {
+    cstr_buff **buffers;
+    size_t count;
+    size_t capacity;
+    size_t initial_size;
+    size_t max_size;
+
+    // Statistics
+    size_t created;
+    size_t reused;
+} cstr_buff_pool;
+
 
 // Functions
 
@@ -36,10 +50,20 @@ cstr * cstr_copy_from_char(char *src, size_t size);
 
 // Buffer
 cstr_buff * cstr_buff_new(size_t size);
+cstr_buff * cstr_buff_new_growable(size_t size, size_t max_size);
 void cstr_buff_free(cstr_buff *buffer);
 void cstr_buff_reset(cstr_buff *buffer);
 
 int cstr_buff_put(cstr_buff *buffer, char src);
+int cstr_buff_put_span(cstr_buff *buffer, const char *src, size_t size);
+int cstr_buff_reserve(cstr_buff *buffer, size_t size);
+
+// Buffer pool
+cstr_buff_pool * cstr_buff_pool_new(size_t capacity, size_t initial_size, size_t max_size);
+void cstr_buff_pool_free(cstr_buff_pool *pool);
+
+cstr_buff * cstr_buff_pool_get(cstr_buff_pool *pool);
+void cstr_buff_pool_put(cstr_buff_pool *pool, cstr_buff *buffer);
 
 #ifdef __cplusplus
 }
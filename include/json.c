@@ -0,0 +1,210 @@
+#include "json.h"
+#include "cstr.h"
+
+#include <stdint.h>
+#include <string.h>
+
+// The longest escape written for a single source byte sequence is a
+// surrogate pair: \uXXXX\uXXXX
+#define MAX_ESCAPE_SIZE     12
+
+static const char HEX_DIGITS[] = "0123456789abcdef";
+
+
+static size_t put_unicode_escape(char *dst, uint32_t codepoint) {
+    dst[0] = '\\';
+    dst[1] = 'u';
+    dst[2] = HEX_DIGITS[(codepoint >> 12) & 0xf];
+    dst[3] = HEX_DIGITS[(codepoint >> 8) & 0xf];
+    dst[4] = HEX_DIGITS[(codepoint >> 4) & 0xf];
+    dst[5] = HEX_DIGITS[codepoint & 0xf];
+
+    return 6;
+}
+
+static size_t put_escape(char *dst, uint32_t codepoint) {
+    switch (codepoint) {
+        case '"':
+            dst[1] = '"';
+            break;
+
+        case '\\':
+            dst[1] = '\\';
+            break;
+
+        case '\b':
+            dst[1] = 'b';
+            break;
+
+        case '\f':
+            dst[1] = 'f';
+            break;
+
+        case '\n':
+            dst[1] = 'n';
+            break;
+
+        case '\r':
+            dst[1] = 'r';
+            break;
+
+        case '\t':
+            dst[1] = 't';
+            break;
+
+        default:
+            if (codepoint >= 0x10000) {
+                // Characters outside of the BMP are written as a UTF-16
+                // surrogate pair
+                codepoint -= 0x10000;
+                put_unicode_escape(dst, 0xd800 | ((codepoint >> 10) & 0x3ff));
+                return 6 + put_unicode_escape(dst + 6, 0xdc00 | (codepoint & 0x3ff));
+            }
+
+            return put_unicode_escape(dst, codepoint);
+    }
+
+    dst[0] = '\\';
+    return 2;
+}
+
+/**
+* Decodes one UTF-8 sequence that starts with a non-ASCII byte. The rules
+* follow the Python 2 UTF-8 codec, which accepts encoded surrogates. Returns
+* the length of the sequence or 0 if it is invalid.
+*/
+static size_t decode_utf8(const unsigned char *src, size_t size, uint32_t *codepoint) {
+    const unsigned char lead = src[0];
+
+    if (lead >= 0xc2 && lead <= 0xdf) {
+        if (size < 2 || (src[1] & 0xc0) != 0x80) {
+            return 0;
+        }
+
+        *codepoint = ((lead & 0x1f) << 6) | (src[1] & 0x3f);
+        return 2;
+    }
+
+    if (lead >= 0xe0 && lead <= 0xef) {
+        if (size < 3 || (src[1] & 0xc0) != 0x80 || (src[2] & 0xc0) != 0x80) {
+            return 0;
+        }
+
+        if (lead == 0xe0 && src[1] < 0xa0) {
+            // Overlong
+            return 0;
+        }
+
+        *codepoint = ((lead & 0x0f) << 12) | ((src[1] & 0x3f) << 6) | (src[2] & 0x3f);
+        return 3;
+    }
+
+    if (lead >= 0xf0 && lead <= 0xf4) {
+        if (size < 4 || (src[1] & 0xc0) != 0x80 || (src[2] & 0xc0) != 0x80 ||
+                (src[3] & 0xc0) != 0x80) {
+            return 0;
+        }
+
+        if ((lead == 0xf0 && src[1] < 0x90) || (lead == 0xf4 && src[1] >= 0x90)) {
+            // Overlong or past the last code point
+            return 0;
+        }
+
+        *codepoint = ((lead & 0x07) << 18) | ((src[1] & 0x3f) << 12) |
+                     ((src[2] & 0x3f) << 6) | (src[3] & 0x3f);
+        return 4;
+    }
+
+    return 0;
+}
+
+int json_put_raw(cstr_buff *out, const char *src, size_t size) {
+    const int error = cstr_buff_reserve(out, size);
+
+    if (!error) {
+        memcpy(out->data->bytes + out->position, src, size);
+        out->position += size;
+    }
+
+    return error;
+}
+
+/**
+* Writes src as a quoted JSON string. The source must be UTF-8 and the output
+* matches simplejson with ensure_ascii set: printable ASCII is copied, the
+* usual short escapes are used and everything else is written as \uXXXX.
+*/
+int json_put_string(cstr_buff *out, const char *src, size_t size) {
+    const unsigned char *bytes = (const unsigned char *) src;
+    size_t index = 0;
+    char *dst;
+
+    if (cstr_buff_reserve(out, size + 2)) {
+        return CSTR_UNABLE_TO_ALLOCATE;
+    }
+
+    out->data->bytes[out->position++] = '"';
+
+    while (index < size) {
+        const unsigned char next = bytes[index];
+        uint32_t codepoint = next;
+        size_t read = 1;
+
+        if (next >= ' ' && next <= '~' && next != '"' && next != '\\') {
+            // Copy runs of characters that need no escaping. There is always
+            // room for the rest of the source plus the closing quote.
+            size_t run = index + 1;
+
+            while (run < size && bytes[run] >= ' ' && bytes[run] <= '~' &&
+                    bytes[run] != '"' && bytes[run] != '\\') {
+                run++;
+            }
+
+            memcpy(out->data->bytes + out->position, src + index, run - index);
+            out->position += run - index;
+            index = run;
+            continue;
+        }
+
+        if (next >= 0x80) {
+            read = decode_utf8(bytes + index, size - index, &codepoint);
+
+            if (read == 0) {
+                return JSON_INVALID_UTF8;
+            }
+        }
+
+        // Room for the escape, the rest of the source and the closing quote
+        if (cstr_buff_reserve(out, MAX_ESCAPE_SIZE + size - index + 1)) {
+            return CSTR_UNABLE_TO_ALLOCATE;
+        }
+
+        dst = out->data->bytes + out->position;
+        out->position += put_escape(dst, codepoint);
+        index += read;
+    }
+
+    out->data->bytes[out->position++] = '"';
+    return 0;
+}
+
+int json_put_uint(cstr_buff *out, unsigned long long value) {
+    char digits[20];
+    size_t count = 0;
+    size_t index;
+
+    do {
+        digits[count++] = '0' + (value % 10);
+        value /= 10;
+    } while (value > 0);
+
+    if (cstr_buff_reserve(out, count)) {
+        return CSTR_UNABLE_TO_ALLOCATE;
+    }
+
+    for (index = 0; index < count; index++) {
+        out->data->bytes[out->position++] = digits[count - index - 1];
+    }
+
+    return 0;
+}
@@ -0,0 +1,28 @@
+#ifndef json_h
+#define json_h
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+#include "cstr.h"
+#include <sys/types.h>
+
+// Errors
+typedef enum {
+    JSON_INVALID_UTF8 = 300
+} json_error;
+
+
+// Functions
+
+// All functions append to the buffer, growing it as needed, and return 0 on
+// success or an error code.
+int json_put_raw(cstr_buff *out, const char *src, size_t size);
+int json_put_string(cstr_buff *out, const char *src, size_t size);
+int json_put_uint(cstr_buff *out, unsigned long long value);
+
+#ifdef __cplusplus
+}
+#endif
+#endif
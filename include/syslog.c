@@ -13,6 +13,8 @@
 #define DEBUG_OUTPUT            0
 #define RFC3164_MAX_BYTES       1024
 #define RFC5424_MAX_BYTES       2048
+#define INITIAL_BUFFER_SIZE     256
+#define INITIAL_ARENA_SIZE      256
 #define MAX_BUFFER_SIZE         (RFC5424_MAX_BYTES * 32)
 
 #define IS_WS(c)            (c ==' ' || c == '\t' || c == '\r' || c == '\n')
@@ -21,6 +23,14 @@
 #define IS_NUM(c)           ((c) >= '0' && (c) <= '9')
 #define IS_ALPHANUM(c)      (IS_ALPHA(c) || IS_NUM(c))
 
+// Word at a time scanning helpers. HAS_LESS is true when any byte in the
+// word is less than n (n <= 128) and HAS_BYTE when any byte equals b.
+#define ONES_64             (~(uint64_t) 0 / 255)
+#define HIGHS_64            (ONES_64 * 128)
+#define HAS_ZERO(x)         (((x) - ONES_64) & ~(x) & HIGHS_64)
+#define HAS_LESS(x, n)      (((x) - ONES_64 * (n)) & ~(x) & HIGHS_64)
+#define HAS_BYTE(x, b)      HAS_ZERO((x) ^ (ONES_64 * (b)))
+
 // Typedefs
 typedef enum {
     ts_before,
@@ -51,7 +61,10 @@ typedef enum {
     s_sd_end,
 
     // Message Content
-    s_message
+    s_message,
+
+    // A message dropped by the priority filter
+    s_skip
 } syslog_state;
 
 typedef enum {
@@ -63,37 +76,249 @@ typedef enum {
 
 // Supporting functions
 void free_msg_head_fields(syslog_msg_head *head) {
-    if (head->timestamp != NULL) {
-        cstr_free(head->timestamp);
-        head->timestamp = NULL;
+    head->timestamp = NULL;
+    head->hostname = NULL;
+    head->appname = NULL;
+    head->processid = NULL;
+    head->messageid = NULL;
+
+    memset(head->fields, 0, sizeof(head->fields));
+    head->sd_raw = NULL;
+
+    if (head->arena != NULL) {
+        cstr_buff_reset(head->arena);
     }
+}
+
+void reset_msg_head(syslog_msg_head *head) {
+    free_msg_head_fields(head);
 
-    if (head->hostname != NULL) {
-        cstr_free(head->hostname);
-        head->hostname = NULL;
+    head->priority = 0;
+    head->version = 0;
+    head->facility = 0;
+    head->severity = 0;
+    head->has_epoch = 0;
+}
+
+/**
+* Reads count digits as a number, or returns -1 if any of them is not a digit.
+*/
+static int read_digits(const char *src, int count) {
+    int value = 0;
+    int i;
+
+    for (i = 0; i < count; i++) {
+        if (!IS_NUM(src[i])) {
+            return -1;
+        }
+
+        value = value * 10 + (src[i] - '0');
     }
 
-    if (head->appname != NULL) {
-        cstr_free(head->appname);
-        head->appname = NULL;
+    return value;
+}
+
+/**
+* Returns the number of days from 1970-01-01 to the given proleptic
+* Gregorian date.
+*/
+static int64_t days_from_civil(int year, int month, int day) {
+    int64_t era;
+    int year_of_era;
+    int day_of_year;
+    int day_of_era;
+
+    year -= month <= 2;
+    era = (year >= 0 ? year : year - 399) / 400;
+    year_of_era = (int) (year - era * 400);
+    day_of_year = (153 * (month + (month > 2 ? -3 : 9)) + 2) / 5 + day - 1;
+    day_of_era = year_of_era * 365 + year_of_era / 4 - year_of_era / 100 + day_of_year;
+
+    return era * 146097 + day_of_era - 719468;
+}
+
+static int days_in_month(int year, int month) {
+    static const int days[] = {31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31};
+
+    if (month == 2 && (year % 4 == 0 && (year % 100 != 0 || year % 400 == 0))) {
+        return 29;
     }
 
-    if (head->processid != NULL) {
-        cstr_free(head->processid);
-        head->processid = NULL;
+    return days[month - 1];
+}
+
+/**
+* Reads YYYY-MM-DDTHH:MM:SS as seconds since the epoch, or returns 0 if it
+* is not a valid date and time.
+*/
+static int read_date_time(const char *ts, int64_t *epoch) {
+    int year = read_digits(ts, 4);
+    int month = read_digits(ts + 5, 2);
+    int day = read_digits(ts + 8, 2);
+    int hour = read_digits(ts + 11, 2);
+    int minute = read_digits(ts + 14, 2);
+    int second = read_digits(ts + 17, 2);
+
+    if (ts[4] != '-' || ts[7] != '-' || (ts[10] != 'T' && ts[10] != 't') ||
+            ts[13] != ':' || ts[16] != ':') {
+        return 0;
     }
 
-    if (head->messageid != NULL) {
-        cstr_free(head->messageid);
-        head->messageid = NULL;
+    if (year < 0 || month < 1 || month > 12 || day < 1 ||
+            day > days_in_month(year, month) || hour < 0 || hour > 23 ||
+            minute < 0 || minute > 59 || second < 0 || second > 59) {
+        return 0;
     }
+
+    *epoch = days_from_civil(year, month, day) * 86400 +
+        hour * 3600 + minute * 60 + second;
+
+    return 1;
 }
 
-void reset_msg_head(syslog_msg_head *head) {
-    free_msg_head_fields(head);
+/**
+* Decodes an RFC 3339 timestamp, as RFC 5424 requires, into the epoch
+* fields of the message head. Timestamps in any other form, such as the
+* RFC 3164 ones, and those before 1970 are left without an epoch.
+*/
+static void decode_timestamp(syslog_parser *parser, const char *ts, size_t size) {
+    syslog_msg_head *head = parser->msg_head;
+    int64_t epoch;
+    uint32_t usec = 0;
+    size_t index = sizeof(parser->ts_prefix);
+    size_t fraction_end;
+    int offset;
+
+    // The shortest form is the date and time followed by Z
+    if (size <= index) {
+        return;
+    }
 
-    head->priority = 0;
-    head->version = 0;
+    if (parser->ts_cached && memcmp(ts, parser->ts_prefix, index) == 0) {
+        epoch = parser->ts_prefix_epoch;
+    } else if (read_date_time(ts, &epoch)) {
+        memcpy(parser->ts_prefix, ts, index);
+        parser->ts_prefix_epoch = epoch;
+        parser->ts_cached = 1;
+    } else {
+        return;
+    }
+
+    if (ts[index] == '.') {
+        // Up to six digits, as RFC 5424 allows, scaled to microseconds
+        fraction_end = ++index + 6;
+
+        while (index < size && index < fraction_end && IS_NUM(ts[index])) {
+            usec = usec * 10 + (ts[index++] - '0');
+        }
+
+        if (index == fraction_end - 6) {
+            return;
+        }
+
+        while (fraction_end > index) {
+            usec *= 10;
+            fraction_end--;
+        }
+    }
+
+    if (index + 1 == size && (ts[index] == 'Z' || ts[index] == 'z')) {
+        offset = 0;
+    } else if (index + 6 == size && (ts[index] == '+' || ts[index] == '-') &&
+            ts[index + 3] == ':') {
+        int hours = read_digits(ts + index + 1, 2);
+        int minutes = read_digits(ts + index + 4, 2);
+
+        if (hours < 0 || hours > 23 || minutes < 0 || minutes > 59) {
+            return;
+        }
+
+        offset = hours * 3600 + minutes * 60;
+
+        if (ts[index] == '-') {
+            offset = -offset;
+        }
+    } else {
+        return;
+    }
+
+    epoch -= offset;
+
+    if (epoch < 0) {
+        return;
+    }
+
+    head->epoch = epoch;
+    head->epoch_usec = usec;
+    head->has_epoch = 1;
+}
+
+/**
+* Makes room for up to size more bytes in the head's arena, growing it no
+* larger than its max_size. Field slots already set are moved along with the
+* arena when it grows. Returns the number of bytes there is room for, which is
+* less than size once the arena is full; like tokens in the parse buffer,
+* whatever does not fit is truncated.
+*/
+static size_t reserve_arena(syslog_msg_head *head, size_t size) {
+    cstr_buff *arena = head->arena;
+    size_t required = arena->position + size;
+    size_t new_size = arena->data->size;
+    size_t offsets[5] = {0};
+    size_t available;
+    char *bytes;
+    int i;
+
+    if (required > new_size && new_size < arena->max_size) {
+        while (new_size < required && new_size < arena->max_size) {
+            new_size *= 2;
+        }
+
+        if (new_size > arena->max_size) {
+            new_size = arena->max_size;
+        }
+
+        for (i = 0; i < 5; i++) {
+            if (head->fields[i].bytes != NULL) {
+                offsets[i] = head->fields[i].bytes - arena->data->bytes;
+            }
+        }
+
+        bytes = realloc(arena->data->bytes, new_size);
+
+        if (bytes != NULL) {
+            arena->data->bytes = bytes;
+            arena->data->size = new_size;
+
+            for (i = 0; i < 5; i++) {
+                if (head->fields[i].bytes != NULL) {
+                    head->fields[i].bytes = bytes + offsets[i];
+                }
+            }
+        }
+    }
+
+    available = arena->data->size - arena->position;
+    return size < available ? size : available;
+}
+
+/**
+* Copies a header field into the head's arena and returns the field slot
+* pointing at it. The field is truncated if the arena is full.
+*/
+static cstr * store_field(syslog_msg_head *head, int index, const char *src, size_t size) {
+    cstr_buff *arena = head->arena;
+    char *bytes;
+
+    size = reserve_arena(head, size);
+    bytes = arena->data->bytes + arena->position;
+    memcpy(bytes, src, size);
+    arena->position += size;
+
+    head->fields[index].bytes = bytes;
+    head->fields[index].size = size;
+
+    return &head->fields[index];
 }
 
 void on_cb(syslog_parser *parser, syslog_cb cb) {
@@ -153,6 +378,8 @@ char * get_state_name(syslog_state state) {
             return "sd_end";
         case s_message:
             return "message";
+        case s_skip:
+            return "skip";
 
         default:
             return "NOT A STATE";
@@ -181,39 +408,164 @@ void set_state(syslog_parser *parser, syslog_state next_state) {
 
 void set_str_field(syslog_parser *parser) {
     const cstr_buff *buffer = parser->buffer;
+    syslog_msg_head *head = parser->msg_head;
+    cstr **field;
+    int index;
+
+    switch (parser->state) {
+        case s_timestamp:
+            field = &head->timestamp;
+            index = 0;
+            break;
+
+        case s_hostname:
+            field = &head->hostname;
+            index = 1;
+            break;
 
-    cstr *value = cstr_copy_from_cstr(buffer->data, buffer->position);
+        case s_appname:
+            field = &head->appname;
+            index = 2;
+            break;
+
+        case s_processid:
+            field = &head->processid;
+            index = 3;
+            break;
 
-    if (value == NULL) {
-        parser->error = SLERR_UNABLE_TO_ALLOCATE;
+        case s_messageid:
+            field = &head->messageid;
+            index = 4;
+            break;
+
+        default:
+            cstr_buff_reset(parser->buffer);
+            return;
+    }
+
+    *field = store_field(head, index, buffer->data->bytes, buffer->position);
+
+    if (index == 0) {
+        decode_timestamp(parser, (*field)->bytes, (*field)->size);
+    }
+
+    cstr_buff_reset(parser->buffer);
+}
+
+static void advance_bytes(syslog_parser *parser, size_t count) {
+    if (parser->flags & F_COUNT_OCTETS) {
+        parser->octets_remaining -= count;
     } else {
-        switch (parser->state) {
-            case s_timestamp:
-                parser->msg_head->timestamp = value;
-                break;
+        parser->message_length += count;
+    }
+}
 
-            case s_hostname:
-                parser->msg_head->hostname = value;
-                break;
+/**
+* Returns the number of bytes at the start of data that are not whitespace.
+* All whitespace characters are below '!' so words without any such byte are
+* skipped without looking at each byte.
+*/
+static size_t span_until_ws(const char *data, size_t length) {
+    size_t index = 0;
+    uint64_t word;
 
-            case s_appname:
-                parser->msg_head->appname = value;
-                break;
+    while (index + sizeof(word) <= length) {
+        memcpy(&word, data + index, sizeof(word));
 
-            case s_processid:
-                parser->msg_head->processid = value;
-                break;
+        if (HAS_LESS(word, '!')) {
+            break;
+        }
 
-            case s_messageid:
-                parser->msg_head->messageid = value;
-                break;
+        index += sizeof(word);
+    }
 
-            default:
-                cstr_free(value);
+    while (index < length && !IS_WS(data[index])) {
+        index++;
+    }
+
+    return index;
+}
+
+/**
+* Returns the number of bytes at the start of data that may be copied into
+* an SD value before reaching a quote or an escape.
+*/
+static size_t span_until_sd_value_end(const char *data, size_t length) {
+    size_t index = 0;
+    uint64_t word;
+
+    while (index + sizeof(word) <= length) {
+        memcpy(&word, data + index, sizeof(word));
+
+        if (HAS_BYTE(word, '"') || HAS_BYTE(word, '\\')) {
+            break;
         }
 
-        cstr_buff_reset(parser->buffer);
+        index += sizeof(word);
+    }
+
+    while (index < length && data[index] != '"' && data[index] != '\\') {
+        index++;
+    }
+
+    return index;
+}
+
+/**
+* Fast path for states that copy bytes into the buffer until a delimiter is
+* found. The whole span up to the delimiter is copied at once and the
+* delimiter itself is left for the state machine. Returns the number of bytes
+* consumed.
+*/
+static size_t scan_token(syslog_parser *parser, const char *data, size_t length) {
+    const char *end;
+    size_t span;
+
+    if (parser->flags & F_RFC_3164) {
+        // RFC 3164 head tokens are short and end on more than whitespace
+        return 0;
+    }
+
+    switch (parser->state) {
+        case s_timestamp:
+        case s_hostname:
+        case s_appname:
+        case s_processid:
+        case s_messageid:
+        case s_sd_element:
+            span = span_until_ws(data, length);
+            break;
+
+        case s_sd_field:
+            end = memchr(data, '=', length);
+            span = end != NULL ? end - data : length;
+            break;
+
+        case s_sd_value:
+            if (parser->flags & F_ESCAPED) {
+                // The escaped byte is left to sd_value
+                return 0;
+            }
+
+            span = span_until_sd_value_end(data, length);
+
+            if (!parser->sd_keep_value) {
+                // Values the SD filter does not keep are never copied
+                advance_bytes(parser, span);
+                return span;
+            }
+            break;
+
+        default:
+            return 0;
     }
+
+    if (span > 0) {
+        cstr_buff_put_span(parser->buffer, data, span);
+        advance_bytes(parser, span);
+    }
+
+    return span;
 }
 
 /**
@@ -230,18 +582,16 @@ int read_message(syslog_parser *parser, const syslog_parser_settings *settings,
         parser->octets_remaining -= read;
         msg_complete = parser->octets_remaining == 0;
     } else {
-        int d_index;
-
         // If we're not counting octets then the \n character is EOF for the message
-        for (d_index = 0; d_index < length; d_index++) {
-            if (data[d_index] == '\n') {
-                msg_complete = true;
-                break;
-            }
+        const char *eom = memchr(data, '\n', length);
+
+        if (eom != NULL) {
+            msg_complete = true;
+            read = eom - data + 1;
+        } else {
+            read = length;
         }
 
-        // We've read index + 1 number of bytes
-        read = d_index + 1;
         parser->message_length += read;
     }
 
@@ -267,19 +617,179 @@ int read_message(syslog_parser *parser, const syslog_parser_settings *settings,
     return read;
 }
 
+/**
+* Passes over the rest of a message dropped by the priority filter without
+* calling back. Returns the number of bytes passed over.
+*/
+int skip_message(syslog_parser *parser, const char *data, size_t length) {
+    bool msg_complete = false;
+    int read;
+
+    if (parser->flags & F_COUNT_OCTETS) {
+        read = parser->octets_remaining >= length ? length : parser->octets_remaining;
+        parser->octets_remaining -= read;
+        msg_complete = parser->octets_remaining == 0;
+    } else {
+        const char *eom = memchr(data, '\n', length);
+
+        if (eom != NULL) {
+            msg_complete = true;
+            read = eom - data + 1;
+        } else {
+            read = length;
+        }
+
+        parser->message_length += read;
+    }
+
+    if (msg_complete) {
+        uslg_parser_reset(parser);
+    }
+
+    return read;
+}
+
+/**
+* Returns true if the filter drops messages with the priority just read.
+* Priorities past the last facility the filter knows of are always kept.
+*/
+static bool filter_drops(const syslog_parser *parser) {
+    const syslog_msg_head *head = parser->msg_head;
+
+    return parser->filter != NULL && head->facility < 32 &&
+        (parser->filter->drop[head->severity] >> head->facility) & 1;
+}
+
+/**
+* Returns the paths of the SD filter that name the element just read.
+*/
+static uint64_t sd_element_paths(const syslog_sd_filter *filter, const char *name, size_t size) {
+    uint64_t paths = 0;
+    size_t i;
+
+    for (i = 0; i < filter->count; i++) {
+        const syslog_sd_path *path = &filter->paths[i];
+
+        if (path->element_size == size && memcmp(path->element, name, size) == 0) {
+            paths |= (uint64_t) 1 << i;
+        }
+    }
+
+    return paths;
+}
+
+/**
+* Returns true if any of the given paths of the SD filter keeps the field
+* just read.
+*/
+static bool sd_field_kept(const syslog_sd_filter *filter, uint64_t paths, const char *name, size_t size) {
+    size_t i;
+
+    for (i = 0; paths != 0 && i < filter->count; i++, paths >>= 1) {
+        const syslog_sd_path *path = &filter->paths[i];
+
+        if ((paths & 1) && (path->field == NULL ||
+                (path->field_size == size && memcmp(path->field, name, size) == 0))) {
+            return true;
+        }
+    }
+
+    return false;
+}
+
+/**
+* Copies bytes of the structured data block into the arena after the head
+* fields. The block is truncated if the arena is full.
+*/
+static void put_sd_raw(syslog_parser *parser, const char *data, size_t size) {
+    syslog_msg_head *head = parser->msg_head;
+
+    size = reserve_arena(head, size);
+
+    if (size == 0) {
+        return;
+    }
+
+    memcpy(head->arena->data->bytes + head->arena->position, data, size);
+    head->arena->position += size;
+}
+
+/**
+* Ends the raw structured data block, leaving out the whitespace between it
+* and the message.
+*/
+static void close_sd_raw(syslog_parser *parser) {
+    syslog_msg_head *head = parser->msg_head;
+    const char *bytes = head->arena->data->bytes + parser->sd_raw_start;
+    size_t size = head->arena->position - parser->sd_raw_start;
+
+    while (size > 0 && IS_WS(bytes[size - 1])) {
+        size--;
+    }
+
+    head->sd_raw_span.bytes = (char *) bytes;
+    head->sd_raw_span.size = size;
+    head->sd_raw = &head->sd_raw_span;
+    parser->sd_raw_open = 0;
+}
+
+/**
+* Called with each byte that starts a token in the s_sd_start state. An
+* opening bracket starts or continues the structured data block and anything
+* else ends it. The block is copied once for each call of uslg_parser_exec
+* rather than byte by byte.
+*/
+static void track_sd_raw(syslog_parser *parser, const char *data, size_t index, char nb) {
+    if (nb == '[') {
+        if (!parser->sd_raw_open) {
+            parser->sd_raw_open = 1;
+            parser->sd_raw_start = parser->msg_head->arena->position;
+            parser->sd_raw_offset = index;
+        }
+    } else if (parser->sd_raw_open) {
+        put_sd_raw(parser, data + parser->sd_raw_offset, index - parser->sd_raw_offset);
+
+        if (!parser->error) {
+            close_sd_raw(parser);
+        }
+    }
+}
+
 int sd_value(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
+    if (!parser->sd_keep_value) {
+        // Values the SD filter does not keep are only read past
+        if (parser->flags & F_ESCAPED) {
+            parser->flags &= ~F_ESCAPED;
+        } else if (nb == '\\') {
+            parser->flags |= F_ESCAPED;
+        } else if (nb == '"') {
+            set_state(parser, s_sd_field_start);
+        }
+
+        return pa_advance;
+    }
+
+    if (parser->flags & F_ESCAPED) {
+        // RFC 5424 escapes '"', '\' and ']' in SD values. A backslash before
+        // anything else is an ordinary backslash.
+        parser->flags &= ~F_ESCAPED;
+
+        if (nb != '"' && nb != '\\' && nb != ']') {
+            cstr_buff_put(parser->buffer, '\\');
+        }
+
+        cstr_buff_put(parser->buffer, nb);
+        return pa_advance;
+    }
+
     switch (nb) {
         case '\\':
             parser->flags |= F_ESCAPED;
             break;
 
         case '"':
-            if (parser->flags & F_ESCAPED) {
-                parser->flags |= F_ESCAPED;
-            } else {
-                on_data_cb(parser, settings->on_sd_value);
-                set_state(parser, s_sd_field_start);
-            }
+            on_data_cb(parser, settings->on_sd_value);
+            set_state(parser, s_sd_field_start);
             break;
 
         default:
@@ -305,7 +815,16 @@ int sd_value_start(syslog_parser *parser, char nb) {
 int sd_field(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
     switch (nb) {
         case '=':
-            on_data_cb(parser, settings->on_sd_field);
+            parser->sd_keep_value = parser->sd_filter == NULL ||
+                sd_field_kept(parser->sd_filter, parser->sd_paths,
+                    parser->buffer->data->bytes, parser->buffer->position);
+
+            if (parser->sd_keep_value) {
+                on_data_cb(parser, settings->on_sd_field);
+            } else {
+                cstr_buff_reset(parser->buffer);
+            }
+
             set_state(parser, s_sd_value_start);
             break;
 
@@ -338,7 +857,17 @@ int sd_element(syslog_parser *parser, const syslog_parser_settings *settings, ch
     if (!IS_WS(nb)) {
         cstr_buff_put(parser->buffer, nb);
     } else {
-        on_data_cb(parser, settings->on_sd_element);
+        if (parser->sd_filter != NULL) {
+            parser->sd_paths = sd_element_paths(parser->sd_filter,
+                parser->buffer->data->bytes, parser->buffer->position);
+        }
+
+        if (parser->sd_filter == NULL || parser->sd_paths != 0) {
+            on_data_cb(parser, settings->on_sd_element);
+        } else {
+            cstr_buff_reset(parser->buffer);
+        }
+
         set_state(parser, s_sd_field_start);
     }
 
@@ -379,27 +908,181 @@ int parse_msg_head_part(syslog_parser *parser, syslog_state next_state, char nb)
     return pa_advance;
 }
 
-int version(syslog_parser *parser, char nb) {
-    int retval = pa_advance;
+/**
+* RFC 3164 support. A message is taken to be RFC 3164 when the priority is
+* not followed by a version of one to three digits and a space. Its head is read into the same fields as
+* an RFC 5424 head: the timestamp, the hostname, the tag as the appname and
+* the pid from the tag as the processid. The version is left at 0.
+*
+* The timestamp and hostname are optional in practice, so a first token that
+* does not start with a month name is read as the hostname and a hostname
+* token that turns out to be a tag is moved to the appname. A tag that is not
+* followed by a colon or a pid is the first word of the message and is passed
+* along as message content.
+*/
+static const char *RFC3164_MONTHS[] = {
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"
+};
 
-    if (IS_NUM(nb)) {
-        uint16_t nversion = parser->msg_head->version;
-        nversion *= 10;
-        nversion += nb - '0';
+#define RFC3164_TIMESTAMP_SIZE  15
+
+static bool is_month(const char *data) {
+    int index;
+
+    for (index = 0; index < 12; index++) {
+        if (memcmp(data, RFC3164_MONTHS[index], 3) == 0) {
+            return true;
+        }
+    }
+
+    return false;
+}
+
+static void head_complete(syslog_parser *parser, const syslog_parser_settings *settings) {
+    set_state(parser, s_message);
+    on_cb(parser, settings->on_msg_head_complete);
+}
+
+/**
+* Ends the head at a tag that was really the first word of the message. The
+* word is handed over as the first message part.
+*/
+static void tag_as_message(syslog_parser *parser, const syslog_parser_settings *settings) {
+    head_complete(parser, settings);
+
+    if (!parser->error && parser->buffer->position > 0) {
+        on_data_cb(parser, settings->on_msg_part);
+    }
+
+    cstr_buff_reset(parser->buffer);
+}
+
+static int rfc3164_timestamp(syslog_parser *parser, char nb) {
+    const char *stamp = parser->buffer->data->bytes;
+    size_t position = parser->buffer->position;
 
-        if (nversion < parser->msg_head->version|| nversion > 999) {
-            parser->error = SLERR_BAD_VERSION;
+    if (position < 3 && (IS_WS(nb) || nb == ':' || nb == '[')) {
+        // Too short to be a month so this is the hostname or the tag
+        parser->state = s_hostname;
+        return pa_rehash;
+    }
+
+    cstr_buff_put(parser->buffer, nb);
+    position++;
+
+    if ((position == 3 && !is_month(stamp)) || (position == 4 && nb != ' ')) {
+        // Words such as Decatur only start like a month
+        parser->state = s_hostname;
+    } else if (position == RFC3164_TIMESTAMP_SIZE) {
+        // Mmm dd hh:mm:ss with the day padded by a space
+        if (stamp[6] != ' ' || stamp[9] != ':' || stamp[12] != ':') {
+            parser->error = SLERR_BAD_TIMESTAMP;
         } else {
-            parser->msg_head->version = nversion;
+            set_str_field(parser);
+            set_state(parser, s_hostname);
         }
+    }
+
+    return pa_advance;
+}
+
+static int rfc3164_hostname(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
+    cstr_buff *buffer = parser->buffer;
+
+    if (nb == '[') {
+        // There was no hostname and this is a tag with a pid
+        parser->state = s_appname;
+        set_str_field(parser);
+        set_state(parser, s_processid);
+    } else if (!IS_WS(nb)) {
+        cstr_buff_put(buffer, nb);
+    } else if (buffer->position > 0 && buffer->data->bytes[buffer->position - 1] == ':') {
+        // There was no hostname and this is a tag
+        buffer->position--;
+        parser->state = s_appname;
+        set_str_field(parser);
+        head_complete(parser, settings);
     } else {
-        set_state(parser, s_timestamp);
+        set_str_field(parser);
+        set_state(parser, s_appname);
+    }
+
+    return pa_advance;
+}
+
+static int rfc3164_tag(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
+    int retval = pa_advance;
+
+    switch (nb) {
+        case '[':
+            set_str_field(parser);
+            set_state(parser, s_processid);
+            break;
+
+        case ':':
+            set_str_field(parser);
+            head_complete(parser, settings);
+            break;
+
+        default:
+            if (IS_WS(nb)) {
+                tag_as_message(parser, settings);
+                set_token_state(parser, ts_read);
+                retval = pa_rehash;
+            } else {
+                cstr_buff_put(parser->buffer, nb);
+            }
     }
 
     return retval;
 }
 
-int priority(syslog_parser *parser, char nb) {
+static int rfc3164_pid(syslog_parser *parser, char nb) {
+    if (nb == ']') {
+        set_str_field(parser);
+
+        // The messageid state reads the colon that ends the tag
+        set_state(parser, s_messageid);
+        set_token_state(parser, ts_read);
+    } else {
+        cstr_buff_put(parser->buffer, nb);
+    }
+
+    return pa_advance;
+}
+
+static int rfc3164_tag_end(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
+    head_complete(parser, settings);
+    return nb == ':' ? pa_advance : pa_rehash;
+}
+
+int version(syslog_parser *parser, char nb) {
+    cstr_buff *buffer = parser->buffer;
+
+    if (IS_NUM(nb) && buffer->position < 3) {
+        // The digits are kept in case they start an RFC 3164 hostname
+        cstr_buff_put(buffer, nb);
+        parser->msg_head->version = parser->msg_head->version * 10 + nb - '0';
+        return pa_advance;
+    }
+
+    if (IS_WS(nb) && buffer->position > 0) {
+        // An RFC 5424 version is one to three digits followed by a space
+        cstr_buff_reset(buffer);
+        set_state(parser, s_timestamp);
+        return pa_advance;
+    }
+
+    // Anything else is an RFC 3164 message, which may start with an IP
+    // address as its hostname. The digits read so far begin its first token.
+    parser->msg_head->version = 0;
+    parser->flags |= F_RFC_3164;
+    set_state(parser, s_timestamp);
+    return pa_rehash;
+}
+
+int priority(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
     if (IS_NUM(nb)) {
         uint16_t npriority = parser->msg_head->priority;
         npriority *= 10;
@@ -413,7 +1096,18 @@ int priority(syslog_parser *parser, char nb) {
     } else {
         switch (nb) {
             case '>':
-                set_state(parser, s_version);
+                parser->msg_head->facility = parser->msg_head->priority >> 3;
+                parser->msg_head->severity = parser->msg_head->priority & 7;
+
+                if (filter_drops(parser)) {
+                    // Nothing past the priority is read or called back
+                    parser->filter->dropped++;
+                    set_state(parser, s_skip);
+                    set_token_state(parser, ts_read);
+                } else {
+                    on_cb(parser, settings->on_msg_begin);
+                    set_state(parser, s_version);
+                }
                 break;
 
             default:
@@ -466,8 +1160,11 @@ int octet_count(syslog_parser *parser, char nb) {
     return retval;
 }
 
-int msg_start(syslog_parser *parser, const syslog_parser_settings *settings, char nb) {
-    on_cb(parser, settings->on_msg_begin);
+int msg_start(syslog_parser *parser, char nb) {
+    // The previous message head is kept until now so that it may be read
+    // after the message completes. The message only begins for the caller
+    // once its priority has passed the filter.
+    reset_msg_head(parser->msg_head);
 
     if (IS_NUM(nb)) {
         set_state(parser, s_octet_count);
@@ -484,8 +1181,28 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
     int error = 0;
     char next_byte;
 
+    if (parser->buffer == NULL) {
+        // The buffer was taken and not handed back
+        return SLERR_UNABLE_TO_ALLOCATE;
+    }
+
+    parser->msg_offset = 0;
+
     for (d_index = 0; d_index < length; d_index++) {
         int action = pa_none;
+
+#ifndef USLG_NO_FAST_PATH
+        // Copy whole token spans at once, leaving delimiters and anything
+        // unusual to the state machine below
+        if (parser->token_state == ts_read) {
+            d_index += scan_token(parser, data + d_index, length - d_index);
+
+            if (d_index >= length) {
+                break;
+            }
+        }
+#endif
+
         next_byte = data[d_index];
 
 #if DEBUG_OUTPUT
@@ -516,7 +1233,8 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
             // Parser state
             switch (parser->state) {
                 case s_msg_start:
-                    action = msg_start(parser, settings, next_byte);
+                    parser->msg_offset = d_index;
+                    action = msg_start(parser, next_byte);
                     break;
 
                 case s_octet_count:
@@ -528,7 +1246,7 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
                     break;
 
                 case s_priority:
-                    action = priority(parser, next_byte);
+                    action = priority(parser, settings, next_byte);
                     break;
 
                 case s_version:
@@ -536,26 +1254,54 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
                     break;
 
                 case s_timestamp:
-                    action = parse_msg_head_part(parser, s_hostname, next_byte);
+                    if (parser->flags & F_RFC_3164) {
+                        action = rfc3164_timestamp(parser, next_byte);
+                    } else {
+                        action = parse_msg_head_part(parser, s_hostname, next_byte);
+                    }
                     break;
 
                 case s_hostname:
-                    action = parse_msg_head_part(parser, s_appname, next_byte);
+                    if (parser->flags & F_RFC_3164) {
+                        action = rfc3164_hostname(parser, settings, next_byte);
+                    } else {
+                        action = parse_msg_head_part(parser, s_appname, next_byte);
+                    }
                     break;
 
                 case s_appname:
-                    action = parse_msg_head_part(parser, s_processid, next_byte);
+                    if (parser->flags & F_RFC_3164) {
+                        action = rfc3164_tag(parser, settings, next_byte);
+                    } else {
+                        action = parse_msg_head_part(parser, s_processid, next_byte);
+                    }
                     break;
 
                 case s_processid:
-                    action = parse_msg_head_part(parser, s_messageid, next_byte);
+                    if (parser->flags & F_RFC_3164) {
+                        action = rfc3164_pid(parser, next_byte);
+                    } else {
+                        action = parse_msg_head_part(parser, s_messageid, next_byte);
+                    }
                     break;
 
                 case s_messageid:
-                    action = parse_msg_head_part(parser, s_sd_start, next_byte);
+                    if (parser->flags & F_RFC_3164) {
+                        action = rfc3164_tag_end(parser, settings, next_byte);
+                    } else {
+                        action = parse_msg_head_part(parser, s_sd_start, next_byte);
+                    }
                     break;
 
                 case s_sd_start:
+                    if (parser->sd_filter != NULL) {
+                        track_sd_raw(parser, data, d_index, next_byte);
+
+                        if (parser->error) {
+                            break;
+                        }
+                    }
+
                     action = sd_start(parser, settings, next_byte);
                     break;
 
@@ -584,6 +1330,11 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
                     action = pa_rehash;
                     break;
 
+                case s_skip:
+                    d_index += skip_message(parser, data + d_index, length - d_index);
+                    action = pa_rehash;
+                    break;
+
                 default:
                     parser->error = SLERR_BAD_STATE;
             }
@@ -613,21 +1364,102 @@ int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settin
         }
     }
 
+    if (parser->sd_raw_open && !error) {
+        // The structured data block carries on into the next data
+        put_sd_raw(parser, data + parser->sd_raw_offset, length - parser->sd_raw_offset);
+        parser->sd_raw_offset = 0;
+
+        if (parser->error) {
+            error = parser->error;
+            uslg_parser_reset(parser);
+        }
+    }
+
     return error;
 }
 
 
 // Exported Functions
 
+/**
+* Ends the message being parsed at the end of the data read so far, as is
+* needed for transports such as UDP where the end of a datagram is the end of
+* the message. A message that has not reached its body or that is still
+* waiting on counted octets is reported as ending prematurely. The parser is
+* left ready for the next message.
+*/
+int uslg_parser_finish(syslog_parser *parser, const syslog_parser_settings *settings) {
+    int error;
+
+    if (parser->state == s_msg_start) {
+        // Nothing was read since the last message completed
+        return 0;
+    }
+
+    if (parser->state == s_skip) {
+        // A dropped message ends quietly unless octets are still owed
+        error = parser->octets_remaining > 0 ? SLERR_PREMATURE_MSG_END : 0;
+        uslg_parser_reset(parser);
+
+        return error;
+    }
+
+    if (parser->state == s_sd_start && parser->token_state == ts_before) {
+        // The message ended right after its structured data
+        if (parser->sd_raw_open) {
+            close_sd_raw(parser);
+        }
+
+        head_complete(parser, settings);
+    } else if (parser->flags & F_RFC_3164) {
+        if (parser->state == s_appname && parser->token_state == ts_read) {
+            // The message was a single word after the hostname
+            tag_as_message(parser, settings);
+        } else if (parser->state == s_messageid) {
+            // The message ended right after the pid
+            head_complete(parser, settings);
+        }
+    }
+
+    if (!parser->error) {
+        if (parser->state != s_message || parser->octets_remaining > 0) {
+            parser->error = SLERR_PREMATURE_MSG_END;
+        } else {
+            on_cb(parser, settings->on_msg_complete);
+        }
+    }
+
+    error = parser->error;
+    uslg_parser_reset(parser);
+
+    return error;
+}
+
+/**
+* Returns how many bytes at the end of the data given to the last call of
+* uslg_parser_exec belong to a message that is not yet complete.
+*/
+size_t uslg_parser_pending(const syslog_parser *parser, size_t length) {
+    if (parser->state == s_msg_start) {
+        return 0;
+    }
+
+    return length - parser->msg_offset;
+}
+
 void uslg_parser_reset(syslog_parser *parser) {
     parser->octets_read = 0;
     parser->octets_remaining = 0;
     parser->message_length = 0;
     parser->error = 0;
     parser->flags = 0;
+    parser->sd_raw_open = 0;
+    parser->sd_keep_value = 1;
+
+    if (parser->buffer != NULL) {
+        cstr_buff_reset(parser->buffer);
+    }
 
-    reset_msg_head(parser->msg_head);
-    cstr_buff_reset(parser->buffer);
     set_state(parser, s_msg_start);
     set_token_state(parser, ts_before);
 }
@@ -644,15 +1476,24 @@ int uslg_parser_init(syslog_parser *parser, void *app_data) {
     }
 
     memset(parser->msg_head, 0, sizeof(syslog_msg_head));
+    parser->msg_head->arena = cstr_buff_new_growable(
+        INITIAL_ARENA_SIZE, MAX_BUFFER_SIZE);
+
+    if (parser->msg_head->arena == NULL) {
+        free(parser->msg_head);
+        parser->msg_head = NULL;
+        return SLERR_UNABLE_TO_ALLOCATE;
+    }
 
     parser->app_data = app_data;
-    parser->buffer = cstr_buff_new(MAX_BUFFER_SIZE);
+    parser->buffer = cstr_buff_new_growable(INITIAL_BUFFER_SIZE, MAX_BUFFER_SIZE);
 
     if (parser->buffer == NULL) {
         // Allocating the buffer failed so let go
         // of the memory we just allocated for the
         // msg_head struct
-        free_msg_head_fields(parser->msg_head);
+        cstr_buff_free(parser->msg_head->arena);
+        free(parser->msg_head);
         parser->msg_head = NULL;
         return SLERR_UNABLE_TO_ALLOCATE;
     }
@@ -661,9 +1502,60 @@ int uslg_parser_init(syslog_parser *parser, void *app_data) {
     return 0;
 }
 
+/**
+* Caps the size the head arena may grow to, as with the parse buffer's
+* max_size. It is never capped below its initial size.
+*/
+void uslg_parser_limit_arena(syslog_parser *parser, size_t max_size) {
+    parser->msg_head->arena->max_size =
+        max_size > INITIAL_ARENA_SIZE ? max_size : INITIAL_ARENA_SIZE;
+}
+
+/**
+* Clears the head and shrinks its arena back to its initial size, so that a
+* parser reused for another connection does not keep memory grown for an
+* earlier one. The head fields must no longer be needed.
+*/
+void uslg_parser_shrink_arena(syslog_parser *parser) {
+    cstr_buff *arena = parser->msg_head->arena;
+    char *bytes;
+
+    reset_msg_head(parser->msg_head);
+
+    if (arena->data->size > INITIAL_ARENA_SIZE) {
+        bytes = realloc(arena->data->bytes, INITIAL_ARENA_SIZE);
+
+        if (bytes != NULL) {
+            arena->data->bytes = bytes;
+            arena->data->size = INITIAL_ARENA_SIZE;
+        }
+    }
+}
+
+/**
+* Takes the buffer away from a parser that sits between messages so that it
+* may be shared with other parsers while this one is idle. NULL is returned
+* while a message is being read since the buffer may then hold part of it.
+* A buffer must be set again before the parser next runs.
+*/
+cstr_buff * uslg_parser_take_buffer(syslog_parser *parser) {
+    cstr_buff *buffer = parser->buffer;
+
+    if (parser->state != s_msg_start || buffer == NULL || buffer->position > 0) {
+        return NULL;
+    }
+
+    parser->buffer = NULL;
+    return buffer;
+}
+
 void uslg_free_parser(syslog_parser *parser) {
-    free_msg_head_fields(parser->msg_head);
-    cstr_buff_free(parser->buffer);
+    cstr_buff_free(parser->msg_head->arena);
+
+    if (parser->buffer != NULL) {
+        cstr_buff_free(parser->buffer);
+    }
+
     free(parser->msg_head);
     free(parser);
 }
@@ -697,6 +1589,9 @@ char * uslg_error_string(int error) {
         case SLERR_PREMATURE_MSG_END:
             return "The syslog message was ended with an unescaped delimeter before the parser could reach the message token.";
 
+        case SLERR_BAD_TIMESTAMP:
+            return "The RFC 3164 timestamp was bad or malformed.";
+
         case SLERR_BAD_STATE:
             return "The parser was in a bad state. This should not happen.";
 
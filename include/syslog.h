@@ -14,11 +14,18 @@ extern "C" {
 typedef struct syslog_parser syslog_parser;
 typedef struct syslog_msg_head syslog_msg_head;
 typedef struct syslog_parser_settings syslog_parser_settings;
+typedef struct syslog_priority_filter syslog_priority_filter;
+typedef struct syslog_sd_path syslog_sd_path;
+typedef struct syslog_sd_filter syslog_sd_filter;
 
 typedef int (*syslog_cb) (syslog_parser *parser);
 typedef int (*syslog_data_cb) (syslog_parser *parser, const char *data, size_t len);
 
 
+// The most element.field paths an SD filter may hold
+#define USLG_MAX_SD_PATHS 64
+
+
 // Enumerations
 enum flags {
     F_RFC_3164       = 1 << 0,
@@ -38,12 +45,13 @@ enum USYSLOG_ERROR {
     SLERR_BAD_SD_FIELD = 7,
     SLERR_BAD_SD_VALUE = 8,
     SLERR_PREMATURE_MSG_END = 9,
+    SLERR_BAD_TIMESTAMP = 10,
 
     SLERR_BAD_STATE = 100,
     SLERR_USER_ERROR = 101,
 
     SLERR_BUFFER_OVERFLOW = CSTR_BUFFER_OVERFLOW,
-    SLERR_UNABLE_TO_ALLOCATE = 201
+    SLERR_UNABLE_TO_ALLOCATE = CSTR_UNABLE_TO_ALLOCATE
 };
 
 
@@ -53,11 +61,31 @@ struct syslog_msg_head {
     uint16_t priority;
     uint16_t version;
 
+    // The priority split into its facility and severity
+    uint8_t facility;
+    uint8_t severity;
+
+    // The RFC 3339 timestamp as UTC seconds and microseconds since the
+    // epoch, only set when has_epoch is
+    uint8_t has_epoch;
+    uint32_t epoch_usec;
+    int64_t epoch;
+
     cstr *timestamp;
     cstr *hostname;
     cstr *appname;
     cstr *processid;
     cstr *messageid;
+
+    // The string fields above point into fields, whose bytes are stored
+    // in the arena. Both are reused for every message.
+    cstr fields[5];
+    cstr_buff *arena;
+
+    // The whole structured data block as it was read, only kept while an
+    // SD filter is in use. It points into the arena after the fields.
+    cstr *sd_raw;
+    cstr sd_raw_span;
 };
 
 struct syslog_parser_settings {
@@ -70,6 +98,31 @@ struct syslog_parser_settings {
     syslog_cb         on_msg_complete;
 };
 
+struct syslog_priority_filter {
+    // Bit n of drop[severity] is set when messages of facility n with that
+    // severity are skipped
+    uint32_t drop[8];
+
+    // Messages skipped by all of the parsers using the filter
+    size_t dropped;
+};
+
+struct syslog_sd_path {
+    const char *element;
+    size_t element_size;
+
+    // NULL keeps every field of the element
+    const char *field;
+    size_t field_size;
+};
+
+struct syslog_sd_filter {
+    // The structured data values passed to on_sd_value. Elements and fields
+    // that no path names are not called back at all.
+    syslog_sd_path paths[USLG_MAX_SD_PATHS];
+    size_t count;
+};
+
 struct syslog_parser {
     // Parser fields
     unsigned char flags : 4;
@@ -90,6 +143,35 @@ struct syslog_parser {
     // Buffer
     cstr_buff *buffer;
 
+    // Optional filter checked as soon as the priority is read
+    syslog_priority_filter *filter;
+
+    // Optional whitelist of structured data values, checked as each
+    // element and field name is read
+    syslog_sd_filter *sd_filter;
+
+    // Bit n is set when path n of the SD filter names the element being
+    // read, and sd_keep_value when the value being read is passed on
+    uint64_t sd_paths;
+    unsigned char sd_keep_value;
+
+    // While the structured data block is kept raw, where it began in the
+    // arena and in the data given to the current call of uslg_parser_exec
+    unsigned char sd_raw_open;
+    size_t sd_raw_start;
+    size_t sd_raw_offset;
+
+    // Where the message being read began in the data given to the last
+    // call of uslg_parser_exec, or 0 when it began in earlier data
+    size_t msg_offset;
+
+    // The date and time to the second of the last decoded timestamp and its
+    // epoch before the offset is applied. Consecutive messages nearly always
+    // share them.
+    char ts_prefix[19];
+    unsigned char ts_cached;
+    int64_t ts_prefix_epoch;
+
     // Optionally settable application data pointer
     void *app_data;
 };
@@ -99,7 +181,12 @@ void uslg_parser_reset(syslog_parser *parser);
 void uslg_free_parser(syslog_parser *parser);
 
 int uslg_parser_init(syslog_parser *parser, void *app_data);
+cstr_buff * uslg_parser_take_buffer(syslog_parser *parser);
+void uslg_parser_limit_arena(syslog_parser *parser, size_t max_size);
+void uslg_parser_shrink_arena(syslog_parser *parser);
 int uslg_parser_exec(syslog_parser *parser, const syslog_parser_settings *settings, const char *data, size_t length);
+int uslg_parser_finish(syslog_parser *parser, const syslog_parser_settings *settings);
+size_t uslg_parser_pending(const syslog_parser *parser, size_t length);
 
 char * uslg_error_string(int error);
 
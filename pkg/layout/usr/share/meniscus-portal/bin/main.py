@@ -2,9 +2,20 @@ import signal
 
 import portal.config as config
 
+from portal.input.syslog import (
+    BinaryEncoder, BufferPool, InternCache, JsonEncoder, ParserPool,
+    PriorityFilter, SdFilter, set_intern_cache, set_priority_filter,
+    set_sd_filter)
 from portal.log import get_logger, get_log_manager
-from portal.server import SyslogServer, start_io, stop_io
-from portal.transport import SyslogToZeroMQHandler, ZeroMQCaster
+from portal.metrics import MetricsServer
+from portal.pipeline import SenderPool
+from portal.routing import RoutingSink, RuleSet
+from portal.server import (
+    SyslogServer, SyslogUdpServer, check_worker_addresses, periodic,
+    set_max_host_labels, start_io, stop_io, task_id, worker_address)
+from portal.sharding import ShardedCaster, ShardingSink
+from portal.transport import (
+    SyslogToZeroMQHandler, ZeroMQCaster, ZeroMQStreamCaster)
 
 
 def stop(signum, frame):
@@ -21,9 +32,6 @@ _LOG = get_logger(__name__)
 
 
 if __name__ == '__main__':
-    # Set up the zmq message caster
-    caster = ZeroMQCaster(config.core.zmq_bind_host)
-
     ssl_options = None
 
     cert_file = config.ssl.cert_file
@@ -36,12 +44,222 @@ if __name__ == '__main__':
 
         _LOG.debug('SSL enabled: {}'.format(ssl_options))
 
-    # Set up the syslog server
+    # The UDP socket, if any, is bound before forking so that every worker
+    # reads from it
+    udp_server = None
+
+    if config.core.syslog_udp_bind_host is not None:
+        udp_server = SyslogUdpServer(
+            config.core.syslog_udp_bind_host,
+            None,
+            recv_buffer_size=config.udp.recv_buffer_size,
+            batch_size=config.udp.batch_size,
+            max_datagram_size=config.udp.max_datagram_size,
+            zero_copy=True)
+        udp_server.bind()
+
+    # As is the metrics endpoint so that any worker may answer
+    metrics_server = None
+
+    if config.metrics.bind_host is not None:
+        metrics_server = MetricsServer(
+            config.metrics.bind_host,
+            snapshot_dir=config.metrics.snapshot_dir,
+            snapshot_interval=config.metrics.snapshot_interval_ms / 1000.0)
+        metrics_server.bind()
+
+    set_max_host_labels(config.metrics.max_host_labels)
+
+    # Repeated header values are shared rather than allocated per message
+    if config.parser.intern_cache_size > 0:
+        set_intern_cache(InternCache(config.parser.intern_cache_size))
+    else:
+        set_intern_cache(None)
+
+    # Messages with unwanted priorities are skipped by the C parser
+    if config.parser.drop_priorities:
+        set_priority_filter(PriorityFilter(
+            drop=config.parser.drop_priorities,
+            keep=config.parser.keep_priorities))
+
+    # Routing rules are compiled once and shared by every handler
+    rules = None
+
+    if config.rules:
+        rules = RuleSet.from_config(config.rules)
+
+    # Only whitelisted structured data values are read by the C parser,
+    # along with those the rules and the shard key need
+    if config.parser.sd_fields:
+        sd_fields = list(config.parser.sd_fields)
+
+        if rules is not None:
+            sd_fields.extend(
+                '{}.{}'.format(element, field)
+                for rule in rules.rules for element, field, p in rule.sd)
+
+        if config.transport.shard_bind_hosts:
+            sd_fields.extend(
+                key for key in config.transport.shard_key if '.' in key)
+
+        set_sd_filter(SdFilter(sorted(set(sd_fields))))
+
+    # Idle connections hand their parse buffers back to a shared pool
+    buffer_pool = None
+
+    if config.parser.buffer_pool_size > 0:
+        buffer_pool = BufferPool(
+            capacity=config.parser.buffer_pool_size,
+            initial_size=config.parser.buffer_size,
+            max_size=config.parser.buffer_max_size)
+
+    # Parsers of closed connections are reset and reused by new ones
+    parser_pool = None
+
+    if config.parser.pool_size > 0:
+        parser_pool = ParserPool(
+            capacity=config.parser.pool_size, buffer_pool=buffer_pool)
+
+    # Shards are named by their configured address so that every process
+    # hashes keys the same way
+    shard_hosts = [
+        ('{}:{}'.format(*host), host)
+        for host in config.transport.shard_bind_hosts]
+
+    # Every worker binds the port after the previous worker's for each zmq
+    # endpoint, so the endpoints must be spaced at least processes apart
+    zmq_hosts = [config.core.zmq_bind_host]
+    zmq_hosts.extend(host for name, host in shard_hosts)
+
+    if rules is not None:
+        zmq_hosts.extend(rules.routes)
+
+    try:
+        check_worker_addresses(zmq_hosts, config.core.processes)
+    except ValueError as ex:
+        _LOG.error(ex)
+        raise SystemExit(str(ex))
+
+    # Set up the syslog server. With more than one process configured this
+    # forks the workers and only returns in the worker processes. The zmq
+    # handler copies message parts as it receives them so it can be handed
+    # zero-copy spans.
     syslog_server = SyslogServer(
         config.core.syslog_bind_host,
-        SyslogToZeroMQHandler(caster),
-        ssl_options)
-    syslog_server.start()
+        None,
+        ssl_options,
+        zero_copy=True,
+        buffer_pool=buffer_pool,
+        parser_pool=parser_pool)
+    syslog_server.start(config.core.processes)
+
+    # Stop reading from clients while downstream workers can't keep up
+    def add_listeners(destination):
+        destination.add_listener(syslog_server)
+
+        if udp_server is not None:
+            destination.add_listener(udp_server)
+
+        return destination
+
+    if config.transport.sender_threads > 0:
+        # Parse on the I/O loop and send from a pool of threads. Each pool
+        # binds its zmq socket when started, after forking.
+        def new_sender_pool(address):
+            sender_pool = SenderPool(
+                worker_address(address),
+                wire_format=config.transport.format,
+                threads=config.transport.sender_threads,
+                queue_size=config.transport.sender_queue_size,
+                batch_size=config.transport.batch_size,
+                sndhwm=config.transport.sndhwm)
+            sender_pool.start()
+            return sender_pool
+
+        if shard_hosts:
+            record_sink = ShardingSink(
+                [(name, new_sender_pool(host)) for name, host in shard_hosts],
+                config.transport.shard_key,
+                config.transport.shard_replicas)
+        else:
+            record_sink = new_sender_pool(config.core.zmq_bind_host)
+
+        add_listeners(record_sink)
+
+        if rules is not None:
+            record_sink = RoutingSink(rules, record_sink, dict(
+                (route, add_listeners(new_sender_pool(route)))
+                for route in rules.routes))
+
+        syslog_server.record_sink = record_sink
+
+        if udp_server is not None:
+            udp_server.record_sink = record_sink
+            udp_server.start()
+    else:
+        # Set up the zmq message caster. This must happen after forking since
+        # zmq contexts can not be shared across processes.
+        batch_latency_ms = config.transport.batch_latency_ms
+
+        caster_options = dict(
+            batch_size=config.transport.batch_size,
+            batch_bytes=config.transport.batch_bytes,
+            batch_latency=batch_latency_ms / 1000.0,
+            sndhwm=config.transport.sndhwm)
+
+        def new_caster(address):
+            if config.transport.caster == 'stream':
+                caster = ZeroMQStreamCaster(
+                    worker_address(address),
+                    max_queue=config.transport.max_queue,
+                    **caster_options)
+            else:
+                caster = ZeroMQCaster(
+                    worker_address(address), **caster_options)
+
+            # Make sure batches go out even when traffic stops
+            if caster.batching:
+                periodic(caster.flush_expired, batch_latency_ms)
+
+            return caster
+
+        if shard_hosts:
+            caster = ShardedCaster(
+                [(name, new_caster(host)) for name, host in shard_hosts],
+                config.transport.shard_key,
+                config.transport.shard_replicas)
+        else:
+            caster = new_caster(config.core.zmq_bind_host)
+
+        add_listeners(caster)
+        routes = dict()
+
+        if rules is not None:
+            routes = dict(
+                (route, add_listeners(new_caster(route)))
+                for route in rules.routes)
+
+        # Every connection gets its own handler since handlers hold the
+        # message being built. Encoding finishes within a single callback so
+        # the handlers share one encoder.
+        if config.transport.format == 'binary':
+            encoder = BinaryEncoder()
+        else:
+            encoder = JsonEncoder()
+
+        syslog_server.delegate_factory = lambda: SyslogToZeroMQHandler(
+            caster, config.transport.format, encoder, rules, routes)
+
+        # UDP gets a handler of its own too
+        if udp_server is not None:
+            udp_server.msg_delegate = SyslogToZeroMQHandler(
+                caster, config.transport.format, rules=rules, routes=routes)
+            udp_server.start()
+
+    if metrics_server is not None:
+        worker_id = task_id()
+        metrics_server.start(
+            'worker-{}'.format(worker_id if worker_id is not None else 0))
 
     # Take over SIGTERM and SIGINT
     signal.signal(signal.SIGTERM, stop)
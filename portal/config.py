@@ -1,4 +1,5 @@
 import os.path
+import re
 
 from ConfigParser import ConfigParser
 
@@ -7,12 +8,58 @@ _CFG_DEFAULTS = {
     'core': {
         'processes': 1,
         'syslog_bind_host': 'localhost:5140',
+        'syslog_udp_bind_host': None,
         'zmq_bind_host': 'localhost:5000'
     },
+    'transport': {
+        'batch_size': 1,
+        'batch_bytes': 65536,
+        'batch_latency_ms': 10,
+        'format': 'json',
+        'sndhwm': 1000,
+        'caster': 'nonblocking',
+        'max_queue': 1000,
+        'sender_threads': 0,
+        'sender_queue_size': 1024,
+        'shard_bind_hosts': None,
+        'shard_key': 'meniscus.tenant, hostname',
+        'shard_replicas': 100
+    },
+    'parser': {
+        'buffer_size': 256,
+        'buffer_max_size': 65536,
+        'buffer_pool_size': 1024,
+        'pool_size': 1024,
+        'intern_cache_size': 4096,
+        'drop_priorities': None,
+        'keep_priorities': None,
+        'sd_fields': None
+    },
+    'udp': {
+        'recv_buffer_size': None,
+        'batch_size': 32,
+        'max_datagram_size': 65535
+    },
+    'metrics': {
+        'bind_host': None,
+        'snapshot_dir': None,
+        'snapshot_interval_ms': 1000,
+        'max_host_labels': 256
+    },
     'ssl': {
         'cert_file': None,
         'key_file': None
     },
+    'rule': {
+        'action': None,
+        'tag': None,
+        'route': None,
+        'hostname': None,
+        'appname': None,
+        'processid': None,
+        'messageid': None,
+        'sd': None
+    },
     'logging': {
         'console': True,
         'logfile': None,
@@ -33,6 +80,33 @@ def _host_tuple(host_str):
     return None
 
 
+def _selector_list(selectors_str):
+    if selectors_str:
+        return [part.strip() for part in selectors_str.split(',')
+                if part.strip()]
+    return list()
+
+
+# A regular expression between slashes may itself hold commas
+_PATTERN = re.compile(r'\s*(/.*?/(?=\s*(?:,|$))|[^,]*)\s*(?:,|$)')
+
+
+def split_patterns(patterns_str):
+    """
+    Splits a comma separated list of rule patterns. Commas within a regular
+    expression between slashes, such as /^ci\d{1,3}\./, do not split it.
+    """
+    return [match.group(1).strip()
+            for match in _PATTERN.finditer(patterns_str)
+            if match.group(1).strip()]
+
+
+def _pattern_list(patterns_str):
+    if patterns_str:
+        return split_patterns(patterns_str)
+    return None
+
+
 def load_config(location='/etc/meniscus-portal/portal.conf'):
     if not os.path.isfile(location):
         raise Exception(
@@ -48,8 +122,15 @@ class PortalConfiguration(object):
     """
     def __init__(self, cfg):
         self.core = CoreConfiguration(cfg)
+        self.transport = TransportConfiguration(cfg)
+        self.parser = ParserConfiguration(cfg)
+        self.udp = UdpConfiguration(cfg)
+        self.metrics = MetricsConfiguration(cfg)
         self.ssl = SSLConfiguration(cfg)
         self.logging = LoggingConfiguration(cfg)
+        self.rules = [
+            RuleConfiguration(cfg, section) for section in cfg.sections()
+            if section.startswith(_RULE_PREFIX)]
 
     def __getattr__(self, name):
         return None
@@ -118,7 +199,8 @@ class CoreConfiguration(ConfigurationObject):
     def processes(self):
         """
         Returns the number of processes Portal should spin up to handle
-        messages. If unset, this defaults to 1.
+        messages. A value of 0 starts one process per CPU. If unset, this
+        defaults to 1.
 
         Example
         --------
@@ -139,12 +221,28 @@ class CoreConfiguration(ConfigurationObject):
         """
         return _host_tuple(self._get('syslog_bind_host'))
 
+    @property
+    def syslog_udp_bind_host(self):
+        """
+        Returns a tuple of host and port that portal should listen on for
+        syslog messages sent over UDP. UDP is disabled if left unset.
+
+        Example
+        --------
+        syslog_udp_bind_host = localhost:5140
+        """
+        return _host_tuple(self._get('syslog_udp_bind_host'))
+
     @property
     def zmq_bind_host(self):
         """
         Returns a tuple of  host and port that portal is expected to bind
         to when accepting upstream worker connections. This option defaults
-        to localhost:5140 if left unset.
+        to localhost:5000 if left unset.
+
+        When more than one process is configured, each process binds its own
+        endpoint. The first process binds the configured port and every
+        following process binds the next port up.
 
         Example
         --------
@@ -153,6 +251,394 @@ class CoreConfiguration(ConfigurationObject):
         return _host_tuple(self._get('zmq_bind_host'))
 
 
+class TransportConfiguration(ConfigurationObject):
+    """
+    Class mapping for the Portal configuration section 'transport'
+    """
+    @property
+    def batch_size(self):
+        """
+        Returns the most messages Portal should send downstream as one zmq
+        multipart message. A value of 1 disables batching. If unset, this
+        defaults to 1.
+
+        Example
+        --------
+        batch_size = 64
+        """
+        return self._getint('batch_size')
+
+    @property
+    def batch_bytes(self):
+        """
+        Returns the byte count at which a batch is sent regardless of how
+        many messages it holds. If unset, this defaults to 65536.
+
+        Example
+        --------
+        batch_bytes = 65536
+        """
+        return self._getint('batch_bytes')
+
+    @property
+    def batch_latency_ms(self):
+        """
+        Returns the most milliseconds a message may wait in a batch before
+        the batch is sent. If unset, this defaults to 10.
+
+        Example
+        --------
+        batch_latency_ms = 10
+        """
+        return self._getint('batch_latency_ms')
+
+    @property
+    def format(self):
+        """
+        Returns the wire format Portal should send messages downstream in.
+        This value may be either json or binary. Receivers read both formats,
+        so they should be upgraded before casters are switched to binary. If
+        unset, this defaults to json.
+
+        Example
+        --------
+        format = binary
+        """
+        return self._get('format')
+
+    @property
+    def sndhwm(self):
+        """
+        Returns the number of messages zmq may queue for downstream workers
+        before Portal stops reading from syslog clients until the queue has
+        room again. If unset, this defaults to 1000.
+
+        Example
+        --------
+        sndhwm = 1000
+        """
+        return self._getint('sndhwm')
+
+    @property
+    def caster(self):
+        """
+        Returns how Portal should send messages downstream. This value may be
+        either nonblocking, which tries each send right away and keeps a
+        backlog while zmq is full, or stream, which queues every send on the
+        I/O loop and writes it once the socket is writable. If unset, this
+        defaults to nonblocking.
+
+        Example
+        --------
+        caster = stream
+        """
+        return self._get('caster')
+
+    @property
+    def max_queue(self):
+        """
+        Returns the number of sends the stream caster may queue before Portal
+        stops reading from syslog clients. Only used when caster is set to
+        stream. If unset, this defaults to 1000.
+
+        Example
+        --------
+        max_queue = 1000
+        """
+        return self._getint('max_queue')
+
+    @property
+    def sender_threads(self):
+        """
+        Returns the number of threads each Portal process should serialize
+        and send messages downstream from. When set above 0 the I/O loop only
+        parses messages and hands them to the sender threads through a
+        bounded queue; the caster and batch_bytes settings are not used. If
+        unset, this defaults to 0, which sends from the I/O loop.
+
+        Example
+        --------
+        sender_threads = 2
+        """
+        return self._getint('sender_threads')
+
+    @property
+    def sender_queue_size(self):
+        """
+        Returns the number of parsed messages that may wait for a sender
+        thread before Portal stops reading from syslog clients. Only used
+        when sender_threads is above 0. If unset, this defaults to 1024.
+
+        Example
+        --------
+        sender_queue_size = 1024
+        """
+        return self._getint('sender_queue_size')
+
+    @property
+    def shard_bind_hosts(self):
+        """
+        Returns the list of host tuples Portal should spread messages over
+        by their shard key in place of zmq_bind_host. Every message with the
+        same key is sent from the same endpoint, so downstream workers that
+        connect to one endpoint see all of its keys. As with zmq_bind_host,
+        every worker process adds its task id to the port, so the ports of
+        these hosts, zmq_bind_host and rule routes must be spaced at least
+        processes apart; Portal refuses to start otherwise. If unset,
+        messages are not sharded.
+
+        Example
+        --------
+        shard_bind_hosts = 127.0.0.1:6000, 127.0.0.1:6100
+        """
+        return [_host_tuple(host) for host in
+                _selector_list(self._get('shard_bind_hosts'))]
+
+    @property
+    def shard_key(self):
+        """
+        Returns the list of fields that messages are sharded by, tried in
+        order. Each is either a head field such as hostname or a structured
+        data field given as element.field. Messages with none of the fields
+        all go to one endpoint. If unset, this defaults to meniscus.tenant,
+        hostname.
+
+        Example
+        --------
+        shard_key = meniscus.tenant, hostname
+        """
+        return _selector_list(self._get('shard_key'))
+
+    @property
+    def shard_replicas(self):
+        """
+        Returns the number of points each endpoint has on the consistent
+        hash ring. More points spread keys more evenly. If unset, this
+        defaults to 100.
+
+        Example
+        --------
+        shard_replicas = 100
+        """
+        return self._getint('shard_replicas')
+
+
+class ParserConfiguration(ConfigurationObject):
+    """
+    Class mapping for the Portal configuration section 'parser'
+    """
+    @property
+    def buffer_size(self):
+        """
+        Returns the size in bytes that the buffers syslog tokens are collected
+        in start at. Buffers grow as longer tokens are read. If unset, this
+        defaults to 256.
+
+        Example
+        --------
+        buffer_size = 256
+        """
+        return self._getint('buffer_size')
+
+    @property
+    def buffer_max_size(self):
+        """
+        Returns the size in bytes that a token buffer may grow to. Longer
+        tokens, such as very long structured data values, are truncated. If
+        unset, this defaults to 65536.
+
+        Example
+        --------
+        buffer_max_size = 65536
+        """
+        return self._getint('buffer_max_size')
+
+    @property
+    def buffer_pool_size(self):
+        """
+        Returns the number of token buffers each Portal process keeps for
+        reuse. Connections only hold a buffer while they are in the middle of
+        a message, so idle connections share the pool. A value of 0 gives
+        every connection a buffer of its own for its whole life. If unset,
+        this defaults to 1024.
+
+        Example
+        --------
+        buffer_pool_size = 1024
+        """
+        return self._getint('buffer_pool_size')
+
+    @property
+    def pool_size(self):
+        """
+        Returns the number of parsers from closed connections each Portal
+        process keeps for new connections to reuse. A value of 0 builds a
+        new parser for every connection. If unset, this defaults to 1024.
+
+        Example
+        --------
+        pool_size = 1024
+        """
+        return self._getint('pool_size')
+
+    @property
+    def intern_cache_size(self):
+        """
+        Returns the number of slots in the cache each Portal process keeps
+        of repeated header values, such as hostnames, appnames, message ids
+        and structured data names, so that they are not allocated for every
+        message. This must be a power of two. A value of 0 turns the cache
+        off. If unset, this defaults to 4096.
+
+        Example
+        --------
+        intern_cache_size = 4096
+        """
+        return self._getint('intern_cache_size')
+
+    @property
+    def drop_priorities(self):
+        """
+        Returns the list of facility.severity selectors for messages that are
+        dropped as soon as their priority is read, before any other part of
+        them is parsed. Names or numbers may be used and * matches any; a
+        severity matches only itself. If unset, no messages are dropped.
+
+        Example
+        --------
+        drop_priorities = *.debug, local7.info
+        """
+        return _selector_list(self._get('drop_priorities'))
+
+    @property
+    def keep_priorities(self):
+        """
+        Returns the list of facility.severity selectors for messages that are
+        kept even though drop_priorities matches them. If unset, there are no
+        exceptions.
+
+        Example
+        --------
+        keep_priorities = auth.debug
+        """
+        return _selector_list(self._get('keep_priorities'))
+
+    @property
+    def sd_fields(self):
+        """
+        Returns the list of element.field paths of the structured data
+        values Portal should pass on, or element.* for every field of an
+        element. The values of other fields are never read into memory and
+        the whole structured data block is sent as sd_raw instead. Fields
+        that routing rules and shard_key read are always kept. If unset,
+        every value is kept.
+
+        Example
+        --------
+        sd_fields = meniscus.tenant, meniscus.token
+        """
+        return _selector_list(self._get('sd_fields'))
+
+
+class UdpConfiguration(ConfigurationObject):
+    """
+    Class mapping for the Portal configuration section 'udp'
+    """
+    @property
+    def recv_buffer_size(self):
+        """
+        Returns the size in bytes to request for the kernel receive buffer of
+        the UDP socket. The kernel may cap this at net.core.rmem_max. If
+        unset, the system default is used.
+
+        Example
+        --------
+        recv_buffer_size = 8388608
+        """
+        return self._getint('recv_buffer_size')
+
+    @property
+    def batch_size(self):
+        """
+        Returns the most datagrams Portal reads from the socket before
+        parsing them. If unset, this defaults to 32.
+
+        Example
+        --------
+        batch_size = 32
+        """
+        return self._getint('batch_size')
+
+    @property
+    def max_datagram_size(self):
+        """
+        Returns the largest datagram in bytes that Portal reads without
+        truncating. If unset, this defaults to 65535.
+
+        Example
+        --------
+        max_datagram_size = 65535
+        """
+        return self._getint('max_datagram_size')
+
+
+class MetricsConfiguration(ConfigurationObject):
+    """
+    Class mapping for the Portal configuration section 'metrics'
+    """
+    @property
+    def bind_host(self):
+        """
+        Returns a tuple of host and port that portal should serve its metrics
+        on over HTTP. Metrics are served at /metrics in the Prometheus text
+        format and at /metrics.json as JSON. The endpoint is disabled if left
+        unset.
+
+        Example
+        --------
+        bind_host = localhost:9140
+        """
+        return _host_tuple(self._get('bind_host'))
+
+    @property
+    def snapshot_dir(self):
+        """
+        Returns the directory each Portal process writes its metrics to so
+        that the endpoint can report the sum over all processes. Only the
+        metrics of the process answering a request are reported if unset.
+
+        Example
+        --------
+        snapshot_dir = /var/lib/meniscus-portal/metrics
+        """
+        return self._get('snapshot_dir')
+
+    @property
+    def snapshot_interval_ms(self):
+        """
+        Returns how often in milliseconds each process writes its metrics to
+        the snapshot directory. If unset, this defaults to 1000.
+
+        Example
+        --------
+        snapshot_interval_ms = 1000
+        """
+        return self._getint('snapshot_interval_ms')
+
+    @property
+    def max_host_labels(self):
+        """
+        Returns how many distinct source hosts each Portal process labels its
+        received message metrics with. Messages from any further hosts are
+        counted under the host label "other". If unset, this defaults to 256.
+
+        Example
+        --------
+        max_host_labels = 256
+        """
+        return self._getint('max_host_labels')
+
+
 class SSLConfiguration(ConfigurationObject):
     """
     Class mapping for the Portal configuration section 'ssl'
@@ -212,3 +698,114 @@ class LoggingConfiguration(ConfigurationObject):
         unset this value defaults to WARNING.
         """
         return self._get('verbosity')
+
+
+_RULE_PREFIX = 'rule:'
+
+
+class RuleConfiguration(ConfigurationObject):
+    """
+    Class mapping for a Portal routing rule section. Each section named
+    'rule:<name>' declares one rule; rules are applied in the order they
+    appear in the file. Values are read without interpolation so that
+    patterns may hold '%'.
+    """
+    def __init__(self, cfg, section):
+        self._section = section
+        super(RuleConfiguration, self).__init__(cfg)
+
+    def _format_namespace(self):
+        return self._section
+
+    def _get_default(self, option):
+        return _CFG_DEFAULTS['rule'].get(option)
+
+    def _get(self, option):
+        if self._has_option(option):
+            return self._cfg.get(self._namespace, option, raw=True)
+        else:
+            return self._get_default(option)
+
+    @property
+    def name(self):
+        """
+        Returns the name of the rule, which is the section name without its
+        'rule:' prefix.
+        """
+        return self._section[len(_RULE_PREFIX):]
+
+    @property
+    def action(self):
+        """
+        Returns what is done with matching messages: drop, tag or route.
+
+        Example
+        --------
+        action = drop
+        """
+        return self._get('action')
+
+    @property
+    def tag(self):
+        """
+        Returns the tag added to matching messages when the action is tag.
+
+        Example
+        --------
+        tag = noisy
+        """
+        return self._get('tag')
+
+    @property
+    def route(self):
+        """
+        Returns the host and port to send matching messages to when the
+        action is route. As with zmq_bind_host, every worker process adds its
+        task id to the port.
+
+        Example
+        --------
+        route = localhost:5100
+        """
+        return _host_tuple(self._get('route'))
+
+    @property
+    def fields(self):
+        """
+        Returns a dictionary of the head fields the rule matches on to the
+        list of patterns each is matched against. A pattern is an exact
+        value, a prefix ending in * or a regular expression between slashes,
+        which may contain commas. Any of hostname, appname, processid and
+        messageid may be given.
+
+        Example
+        --------
+        appname = CRON, anacron
+        hostname = build-*, /^ci\d{1,3}\./
+        """
+        fields = dict()
+
+        for name in ('hostname', 'appname', 'processid', 'messageid'):
+            patterns = _pattern_list(self._get(name))
+
+            if patterns is not None:
+                fields[name] = patterns
+        return fields
+
+    @property
+    def sd(self):
+        """
+        Returns the list of structured data conditions of the rule, one per
+        line. Each is written element.field = patterns with the patterns as
+        for the head fields.
+
+        Example
+        --------
+        sd = meta.tenant = acme, globex
+             origin.software = rsyslogd
+        """
+        lines = self._get('sd')
+
+        if not lines:
+            return list()
+        return [line.strip() for line in lines.splitlines() if line.strip()]
@@ -9,23 +9,96 @@ cdef extern from "cstr.h":
     ctypedef struct cstr_buff:
         cstr *data
         size_t position
+        size_t max_size
+
+    ctypedef struct cstr_buff_pool:
+        size_t count
+        size_t capacity
+        size_t initial_size
+        size_t max_size
+        size_t created
+        size_t reused
+
+    cstr_buff * cstr_buff_new(size_t size)
+    void cstr_buff_free(cstr_buff *buffer)
+    void cstr_buff_reset(cstr_buff *buffer)
+    int cstr_buff_reserve(cstr_buff *buffer, size_t size)
+
+    cstr_buff_pool * cstr_buff_pool_new(size_t capacity, size_t initial_size, size_t max_size)
+    void cstr_buff_pool_free(cstr_buff_pool *pool)
+    cstr_buff * cstr_buff_pool_get(cstr_buff_pool *pool)
+    void cstr_buff_pool_put(cstr_buff_pool *pool, cstr_buff *buffer)
+
+
+cdef extern from "json.h":
+
+    enum: JSON_INVALID_UTF8
+
+    int json_put_raw(cstr_buff *out, char *src, size_t size)
+    int json_put_string(cstr_buff *out, char *src, size_t size)
+    int json_put_uint(cstr_buff *out, unsigned long long value)
 
 
 cdef extern from "syslog.h":
 
+    enum: USLG_MAX_SD_PATHS
+
+    enum USYSLOG_ERROR:
+        SLERR_UNCAUGHT
+        SLERR_BAD_OCTET_COUNT
+        SLERR_BAD_PRIORITY_START
+        SLERR_BAD_PRIORITY
+        SLERR_BAD_VERSION
+        SLERR_BAD_SD_START
+        SLERR_BAD_SD_FIELD
+        SLERR_BAD_SD_VALUE
+        SLERR_PREMATURE_MSG_END
+        SLERR_BAD_TIMESTAMP
+        SLERR_BAD_STATE
+        SLERR_USER_ERROR
+        SLERR_BUFFER_OVERFLOW
+        SLERR_UNABLE_TO_ALLOCATE
+
     cdef struct syslog_msg_head:
         uint16_t priority
         uint16_t version
 
+        uint8_t facility
+        uint8_t severity
+
+        uint8_t has_epoch
+        uint32_t epoch_usec
+        int64_t epoch
+
         cstr *timestamp
         cstr *hostname
         cstr *appname
         cstr *processid
         cstr *messageid
 
+        cstr *sd_raw
+        cstr_buff *arena
+
+    cdef struct syslog_priority_filter:
+        uint32_t drop[8]
+        size_t dropped
+
+    cdef struct syslog_sd_path:
+        const char *element
+        size_t element_size
+        const char *field
+        size_t field_size
+
+    cdef struct syslog_sd_filter:
+        syslog_sd_path paths[USLG_MAX_SD_PATHS]
+        size_t count
+
     cdef struct syslog_parser:
         syslog_msg_head *msg_head
         size_t message_length
+        cstr_buff *buffer
+        syslog_priority_filter *filter
+        syslog_sd_filter *sd_filter
         void *app_data
 
     ctypedef int (*syslog_cb) (syslog_parser *parser)
@@ -44,6 +117,11 @@ cdef extern from "syslog.h":
     void uslg_free_parser(syslog_parser *parser)
 
     int uslg_parser_init(syslog_parser *parser, void *app_data)
-    int uslg_parser_exec(syslog_parser *parser, syslog_parser_settings *settings, char *data, size_t length) except 101
+    cstr_buff * uslg_parser_take_buffer(syslog_parser *parser)
+    void uslg_parser_limit_arena(syslog_parser *parser, size_t max_size)
+    void uslg_parser_shrink_arena(syslog_parser *parser)
+    int uslg_parser_exec(syslog_parser *parser, syslog_parser_settings *settings, char *data, size_t length) nogil except 101
+    int uslg_parser_finish(syslog_parser *parser, syslog_parser_settings *settings) nogil except 101
+    size_t uslg_parser_pending(syslog_parser *parser, size_t length)
 
     char * uslg_error_string(int error)
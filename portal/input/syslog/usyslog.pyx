@@ -1,6 +1,10 @@
-from libc.string cimport strlen
+from libc.string cimport memcmp, memcpy, memset, strlen
 from libc.stdlib cimport malloc, free
 from cpython cimport bool, PyBytes_FromStringAndSize, PyBytes_FromString
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+
+cimport cython
 
 import os
 
@@ -14,11 +18,39 @@ class SyslogError(Exception):
         return self.msg
 
 
+# Short names for the USYSLOG_ERROR codes a ParsingError may carry
+ERROR_NAMES = {
+    SLERR_UNCAUGHT: 'uncaught',
+    SLERR_BAD_OCTET_COUNT: 'bad_octet_count',
+    SLERR_BAD_PRIORITY_START: 'bad_priority_start',
+    SLERR_BAD_PRIORITY: 'bad_priority',
+    SLERR_BAD_VERSION: 'bad_version',
+    SLERR_BAD_SD_START: 'bad_sd_start',
+    SLERR_BAD_SD_FIELD: 'bad_sd_field',
+    SLERR_BAD_SD_VALUE: 'bad_sd_value',
+    SLERR_PREMATURE_MSG_END: 'premature_msg_end',
+    SLERR_BAD_TIMESTAMP: 'bad_timestamp',
+    SLERR_BAD_STATE: 'bad_state',
+    SLERR_USER_ERROR: 'user_error',
+    SLERR_BUFFER_OVERFLOW: 'buffer_overflow',
+    SLERR_UNABLE_TO_ALLOCATE: 'unable_to_allocate'
+}
+
+
 class ParsingError(SyslogError):
 
-    def __init__(self, msg, cause):
+    def __init__(self, msg, cause, records=None, code=None):
         super(ParsingError, self).__init__(msg)
         self.cause = cause
+        self.records = records
+        self.code = code
+
+    @property
+    def code_name(self):
+        """
+        Returns the short name of the USYSLOG_ERROR code, or 'unknown'.
+        """
+        return ERROR_NAMES.get(self.code, 'unknown')
 
     def __str__(self):
         try:
@@ -32,6 +64,338 @@ class ParsingError(SyslogError):
             return str(ex)
 
 
+cdef class InternCache(object):
+    """
+    InternCache hands back the same bytes object for header values that
+    repeat, such as hostnames, appnames, message ids and structured data
+    names, so that repeated values are not allocated and hashed again for
+    every message. Values are looked up by their raw bytes before any object
+    is made.
+
+    The cache is a fixed table of size slots, a power of two, indexed by a
+    hash of the value. A value that lands in a taken slot replaces the one
+    there, which bounds the cache without any bookkeeping. Values longer
+    than max_length are never cached.
+    """
+
+    cdef list _slots
+    cdef size_t _mask
+    cdef readonly size_t size
+    cdef readonly size_t max_length
+
+    # Statistics
+    cdef readonly size_t hits
+    cdef readonly size_t misses
+
+    def __init__(self, size_t size=4096, size_t max_length=64):
+        if size == 0 or size & (size - 1):
+            raise ValueError('Size must be a power of two')
+
+        self._slots = [None] * size
+        self._mask = size - 1
+        self.size = size
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._slots = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bytes value):
+        """
+        Returns the cached object equal to the given bytes, caching it if
+        there is none.
+        """
+        return self.intern(PyBytes_AS_STRING(value), PyBytes_GET_SIZE(value))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef object intern(self, char *data, size_t size):
+        cdef size_t index
+        cdef object cached
+
+        if size > self.max_length:
+            return PyBytes_FromStringAndSize(data, size)
+
+        index = _fnv1a(data, size) & self._mask
+        cached = self._slots[index]
+
+        if (cached is not None and PyBytes_GET_SIZE(cached) == size and
+                memcmp(PyBytes_AS_STRING(cached), data, size) == 0):
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        cached = PyBytes_FromStringAndSize(data, size)
+        self._slots[index] = cached
+        return cached
+
+
+cdef inline size_t _fnv1a(char *data, size_t size):
+    cdef size_t hash = 2166136261u
+    cdef size_t index
+
+    for index in range(size):
+        hash = (hash ^ <unsigned char> data[index]) * 16777619u
+
+    return hash
+
+
+# Shared by every parser in the process. Parsers only run their callbacks
+# while holding the GIL so they may share it across threads.
+cdef InternCache _interns = InternCache()
+
+
+def get_intern_cache():
+    """
+    Returns the process wide InternCache or None when interning is off.
+    """
+    return _interns
+
+
+def set_intern_cache(InternCache cache):
+    """
+    Replaces the process wide InternCache. Passing None turns interning off.
+    """
+    global _interns
+    _interns = cache
+
+
+cdef inline object _intern(char *data, size_t size):
+    if _interns is None:
+        return PyBytes_FromStringAndSize(data, size)
+    return _interns.intern(data, size)
+
+
+FACILITIES = {
+    'kern': 0, 'user': 1, 'mail': 2, 'daemon': 3, 'auth': 4, 'syslog': 5,
+    'lpr': 6, 'news': 7, 'uucp': 8, 'cron': 9, 'authpriv': 10, 'ftp': 11,
+    'ntp': 12, 'security': 13, 'console': 14, 'solaris-cron': 15,
+    'local0': 16, 'local1': 17, 'local2': 18, 'local3': 19, 'local4': 20,
+    'local5': 21, 'local6': 22, 'local7': 23
+}
+
+SEVERITIES = {
+    'emerg': 0, 'alert': 1, 'crit': 2, 'err': 3, 'warning': 4, 'notice': 5,
+    'info': 6, 'debug': 7
+}
+
+DEF _ALL_FACILITIES = 0xFFFFFF
+
+
+cdef int _selector_code(object name, dict names, int limit) except -1:
+    cdef int code
+
+    if name in names:
+        return names[name]
+
+    try:
+        code = int(name)
+    except ValueError:
+        code = -1
+
+    if code < 0 or code >= limit:
+        raise ValueError('Unknown name {!r} in selector'.format(name))
+    return code
+
+
+cdef class PriorityFilter(object):
+    """
+    PriorityFilter picks the messages that parsers skip by their facility
+    and severity. It is checked as soon as a message's priority is read and
+    the rest of a dropped message is passed over without any callbacks, so
+    dropped messages never become Python objects.
+
+    Selectors are written facility.severity with the names syslog uses for
+    them, or their numbers, and * for any, as in *.debug or local7.*. Unlike
+    syslog.conf a severity selects only itself, not the ones above it. The
+    keep selectors are applied after the drop selectors so that they can
+    make exceptions to them.
+    """
+
+    cdef syslog_priority_filter _cfilter
+
+    def __init__(self, drop=(), keep=()):
+        memset(&self._cfilter, 0, sizeof(self._cfilter))
+
+        for selector in drop:
+            self.drop(selector)
+
+        for selector in keep:
+            self.keep(selector)
+
+    cdef int _apply(self, object selector, bint dropping) except -1:
+        cdef uint32_t facilities
+        cdef int severity
+
+        try:
+            facility, severity_name = selector.strip().split('.')
+        except ValueError:
+            raise ValueError('Selector {!r} is not facility.severity'.format(
+                selector))
+
+        if facility == '*':
+            facilities = _ALL_FACILITIES
+        else:
+            facilities = 1 << _selector_code(facility, FACILITIES, 24)
+
+        for severity in range(8):
+            if (severity_name == '*' or
+                    severity == _selector_code(severity_name, SEVERITIES, 8)):
+                if dropping:
+                    self._cfilter.drop[severity] |= facilities
+                else:
+                    self._cfilter.drop[severity] &= ~facilities
+
+        return 0
+
+    def drop(self, selector):
+        """
+        Drops the messages the selector matches.
+        """
+        self._apply(selector, True)
+
+    def keep(self, selector):
+        """
+        Keeps the messages the selector matches.
+        """
+        self._apply(selector, False)
+
+    def drops(self, int facility, int severity):
+        """
+        Returns True if messages of the given facility and severity codes
+        are dropped.
+        """
+        if facility < 0 or facility > 31 or severity < 0 or severity > 7:
+            return False
+        return bool(self._cfilter.drop[severity] >> facility & 1)
+
+    property dropped:
+        """
+        The number of messages dropped by the parsers using the filter.
+        """
+        def __get__(self):
+            return self._cfilter.dropped
+
+
+# No filter is used unless one is set
+cdef PriorityFilter _priority_filter = None
+
+
+def get_priority_filter():
+    """
+    Returns the process wide PriorityFilter or None when no messages are
+    dropped.
+    """
+    return _priority_filter
+
+
+def set_priority_filter(PriorityFilter priority_filter):
+    """
+    Replaces the process wide PriorityFilter. Passing None keeps every
+    message.
+    """
+    global _priority_filter
+    _priority_filter = priority_filter
+
+
+cdef class SdFilter(object):
+    """
+    SdFilter is a whitelist of the structured data values that parsers pass
+    on. Paths are written element.field, or element.* for every field of an
+    element. The parser checks element and field names against the paths as
+    it reads them and values that no path names are never copied or turned
+    into Python objects. While a filter is in use every message head also
+    keeps its whole structured data block as read in sd_raw.
+    """
+
+    cdef syslog_sd_filter _cfilter
+
+    # The bytes the C paths point into
+    cdef list _names
+
+    def __init__(self, paths=()):
+        memset(&self._cfilter, 0, sizeof(self._cfilter))
+        self._names = list()
+
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        """
+        Keeps the values the path names.
+        """
+        cdef syslog_sd_path *cpath
+        cdef bytes element
+        cdef bytes field
+
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+
+        element, dot, field = path.strip().rpartition('.')
+
+        if not element or not field:
+            raise ValueError('SD path {!r} is not element.field'.format(path))
+
+        if self._cfilter.count >= USLG_MAX_SD_PATHS:
+            raise ValueError('An SD filter holds at most {} paths'.format(
+                USLG_MAX_SD_PATHS))
+
+        cpath = &self._cfilter.paths[self._cfilter.count]
+        cpath.element = element
+        cpath.element_size = len(element)
+
+        if field == '*':
+            cpath.field = NULL
+            cpath.field_size = 0
+        else:
+            cpath.field = field
+            cpath.field_size = len(field)
+
+        self._names.append((element, field))
+        self._cfilter.count += 1
+
+    property paths:
+        """
+        The paths of the filter as element.field strings.
+        """
+        def __get__(self):
+            return ['{}.{}'.format(element, field)
+                    for element, field in self._names]
+
+    def keeps(self, element, field):
+        """
+        Returns True if the value of the given element and field is kept.
+        """
+        for path_element, path_field in self._names:
+            if path_element == element and path_field in ('*', field):
+                return True
+        return False
+
+
+# Every structured data value is passed on unless a filter is set
+cdef SdFilter _sd_filter = None
+
+
+def get_sd_filter():
+    """
+    Returns the process wide SdFilter or None when every structured data
+    value is kept.
+    """
+    return _sd_filter
+
+
+def set_sd_filter(SdFilter sd_filter):
+    """
+    Replaces the process wide SdFilter. Passing None keeps every structured
+    data value.
+    """
+    global _sd_filter
+    _sd_filter = sd_filter
+
+
 class SyslogMessageHandler(object):
 
     def __init__(self):
@@ -48,34 +412,252 @@ class SyslogMessageHandler(object):
         pass
 
 
-class SyslogMessageHead(object):
+cdef class SyslogMessageHead(object):
+    """
+    The head of a syslog message. While attached to a parser, the header
+    fields are read from the parser's C state and only turned into Python
+    objects when first accessed. The same instance is reset and reused for
+    every message read by its parser. Fields stay readable after the message
+    completes until the parser begins reading the next message.
+    """
+
+    cdef syslog_msg_head *_chead
+    cdef bint _complete
+
+    # Materialized fields, None until first accessed or set
+    cdef object _priority
+    cdef object _version
+    cdef object _timestamp
+    cdef object _hostname
+    cdef object _appname
+    cdef object _processid
+    cdef object _messageid
+    cdef object _sd
+
+    # The raw structured data block, which may be None once read
+    cdef bint _sd_raw_read
+    cdef object _sd_raw
+
+    # Epoch fields, which may be None once read
+    cdef bint _epoch_read
+    cdef object _epoch
+    cdef object _epoch_usec
+
+    cdef public object current_sde
+    cdef public object current_sd_field
 
     def __init__(self):
+        self._chead = NULL
         self.reset()
 
-    def reset(self):
-        self.priority = ''
-        self.version = ''
-        self.timestamp = ''
-        self.hostname = ''
-        self.appname = ''
-        self.processid = ''
-        self.messageid = ''
-        self.sd = dict()
+    cpdef reset(self):
+        self._complete = False
+        self._priority = None
+        self._version = None
+        self._timestamp = None
+        self._hostname = None
+        self._appname = None
+        self._processid = None
+        self._messageid = None
+        self._epoch_read = False
+        self._epoch = None
+        self._epoch_usec = None
+        self._sd = None
+        self._sd_raw_read = False
+        self._sd_raw = None
         self.current_sde = None
         self.current_sd_field = None
 
+    cdef void _attach(self, syslog_msg_head *chead):
+        self._chead = chead
+
+    cdef void _detach(self):
+        # Materialize everything before letting go of the C state since it
+        # is about to be reused or freed
+        self.priority
+        self.version
+        self.timestamp
+        self.hostname
+        self.appname
+        self.processid
+        self.messageid
+        self._read_epoch()
+        self.sd_raw
+        self._chead = NULL
+
+    cdef void _set_complete(self):
+        self._complete = True
+
+    cdef void _read_epoch(self):
+        if self._epoch_read or not self._readable():
+            return
+
+        if self._chead.has_epoch:
+            self._epoch = self._chead.epoch
+            self._epoch_usec = self._chead.epoch_usec
+
+        self._epoch_read = True
+
+    cdef bint _readable(self):
+        return self._complete and self._chead != NULL
+
+    property priority:
+        def __get__(self):
+            if self._priority is None:
+                if not self._readable():
+                    return ''
+                self._priority = str(self._chead.priority)
+            return self._priority
+
+        def __set__(self, value):
+            self._priority = value
+
+    property version:
+        def __get__(self):
+            if self._version is None:
+                if not self._readable():
+                    return ''
+                self._version = str(self._chead.version)
+            return self._version
+
+        def __set__(self, value):
+            self._version = value
+
+    property facility:
+        """
+        The facility code of the priority, or None when it is unset.
+        """
+        def __get__(self):
+            if self._priority is None and self._readable():
+                return self._chead.facility
+            return _priority_part(self.priority, True)
+
+    property severity:
+        """
+        The severity code of the priority, or None when it is unset.
+        """
+        def __get__(self):
+            if self._priority is None and self._readable():
+                return self._chead.severity
+            return _priority_part(self.priority, False)
+
+    property timestamp:
+        def __get__(self):
+            if self._timestamp is None:
+                if not self._readable():
+                    return ''
+                self._timestamp = _cstr_to_bytes(self._chead.timestamp)
+            return self._timestamp
+
+        def __set__(self, value):
+            self._timestamp = value
+
+    property hostname:
+        def __get__(self):
+            if self._hostname is None:
+                if not self._readable():
+                    return ''
+                self._hostname = _cstr_to_interned(self._chead.hostname)
+            return self._hostname
+
+        def __set__(self, value):
+            self._hostname = value
+
+    property appname:
+        def __get__(self):
+            if self._appname is None:
+                if not self._readable():
+                    return ''
+                self._appname = _cstr_to_interned(self._chead.appname)
+            return self._appname
+
+        def __set__(self, value):
+            self._appname = value
+
+    property processid:
+        def __get__(self):
+            if self._processid is None:
+                if not self._readable():
+                    return ''
+                self._processid = _cstr_to_bytes(self._chead.processid)
+            return self._processid
+
+        def __set__(self, value):
+            self._processid = value
+
+    property messageid:
+        def __get__(self):
+            if self._messageid is None:
+                if not self._readable():
+                    return ''
+                self._messageid = _cstr_to_interned(self._chead.messageid)
+            return self._messageid
+
+        def __set__(self, value):
+            self._messageid = value
+
+    property epoch:
+        """
+        The timestamp as whole seconds since the epoch in UTC, or None if
+        the timestamp is not in the RFC 3339 form or is before 1970.
+        """
+        def __get__(self):
+            self._read_epoch()
+            return self._epoch
+
+        def __set__(self, value):
+            self._read_epoch()
+            self._epoch_read = True
+            self._epoch = value
+
+    property epoch_usec:
+        """
+        The microseconds past epoch, or None when epoch is None.
+        """
+        def __get__(self):
+            self._read_epoch()
+            return self._epoch_usec
+
+        def __set__(self, value):
+            self._read_epoch()
+            self._epoch_read = True
+            self._epoch_usec = value
+
+    property sd:
+        def __get__(self):
+            if self._sd is None:
+                self._sd = dict()
+            return self._sd
+
+        def __set__(self, value):
+            self._sd = value
+
+    property sd_raw:
+        """
+        The whole structured data block as it was read, or None when no
+        SdFilter was in use or the message had no structured data.
+        """
+        def __get__(self):
+            if not self._sd_raw_read and self._readable():
+                self._sd_raw = _cstr_to_bytes_or_none(self._chead.sd_raw)
+                self._sd_raw_read = True
+            return self._sd_raw
+
+        def __set__(self, value):
+            self._sd_raw_read = True
+            self._sd_raw = value
+
     def get_sd(self, name):
         return self.sd.get(name)
 
-    def create_sde(self, sd_name):
+    cpdef create_sde(self, sd_name):
         self.current_sde = dict()
         self.sd[sd_name] = self.current_sde
 
-    def set_sd_field(self, sd_field_name):
+    cpdef set_sd_field(self, sd_field_name):
         self.current_sd_field = sd_field_name
 
-    def set_sd_value(self, value):
+    cpdef set_sd_value(self, value):
         self.current_sde[self.current_sd_field] = value
 
     def as_dict(self):
@@ -88,41 +670,707 @@ class SyslogMessageHead(object):
             'appname': str(self.appname),
             'processid': str(self.processid),
             'messageid': str(self.messageid),
+            'facility': self.facility,
+            'severity': self.severity,
+            'epoch': self.epoch,
+            'epoch_usec': self.epoch_usec,
             'sd': sd_copy
         }
 
-        for sd_name in self.sd:
-            sd_copy[sd_name] = dict()
-            for sd_fieldname in self.sd[sd_name]:
-                value = self.sd[sd_name][sd_fieldname]
-                sd_copy[sd_name][sd_fieldname] = value.decode('utf-8')
+        # Only heads parsed with an SD filter have an sd_raw
+        if self.sd_raw is not None:
+            dictionary['sd_raw'] = self.sd_raw.decode('utf-8')
+
+        if self._sd:
+            for sd_name in self._sd:
+                sd_copy[sd_name] = dict()
+                for sd_fieldname in self._sd[sd_name]:
+                    value = self._sd[sd_name][sd_fieldname]
+                    sd_copy[sd_name][sd_fieldname] = value.decode('utf-8')
+        return dictionary
+
+
+cdef object _priority_part(object priority, bint facility):
+    if priority is None or priority == '':
+        return None
+
+    priority = int(priority)
+    return priority >> 3 if facility else priority & 7
+
+
+cdef class SyslogRecord(SyslogMessageHead):
+    """
+    A completed syslog message as returned by Parser.parse_batch. A record
+    is detached from the parser and holds the message head, the message body
+    as bytes and the length of the message.
+    """
+
+    cdef public object message
+    cdef public object msg_length
+
+    def __init__(self):
+        SyslogMessageHead.__init__(self)
+        self.message = None
+        self.msg_length = 0
+
+    cdef void _append(self, char *data, size_t size):
+        if self.message is None:
+            self.message = PyBytes_FromStringAndSize(data, size)
+        else:
+            if not isinstance(self.message, bytearray):
+                self.message = bytearray(self.message)
+            self.message.extend(PyBytes_FromStringAndSize(data, size))
+
+    cdef void _finish(self, size_t msg_length):
+        self._detach()
+        self.msg_length = msg_length
+
+        if self.message is None:
+            self.message = b''
+        elif isinstance(self.message, bytearray):
+            self.message = bytes(self.message)
+
+    def as_dict(self):
+        dictionary = SyslogMessageHead.as_dict(self)
+        dictionary['message'] = self.message.decode('utf-8')
+        dictionary['msg_length'] = self.msg_length
         return dictionary
 
 
+cdef inline object _cstr_to_bytes(cstr *value):
+    if value == NULL:
+        return ''
+    return PyBytes_FromStringAndSize(value.bytes, value.size)
+
+
+cdef inline object _cstr_to_bytes_or_none(cstr *value):
+    if value == NULL:
+        return None
+    return PyBytes_FromStringAndSize(value.bytes, value.size)
+
+
+cdef inline object _cstr_to_interned(cstr *value):
+    if value == NULL:
+        return ''
+    return _intern(value.bytes, value.size)
+
+
+# Field codes for JsonEncoder
+DEF _JSON_PRIORITY = 0
+DEF _JSON_VERSION = 1
+DEF _JSON_TIMESTAMP = 2
+DEF _JSON_HOSTNAME = 3
+DEF _JSON_APPNAME = 4
+DEF _JSON_PROCESSID = 5
+DEF _JSON_MESSAGEID = 6
+DEF _JSON_SD = 7
+DEF _JSON_MESSAGE = 8
+DEF _JSON_MSG_LENGTH = 9
+DEF _JSON_EPOCH = 10
+DEF _JSON_EPOCH_USEC = 11
+DEF _JSON_FACILITY = 12
+DEF _JSON_SEVERITY = 13
+DEF _JSON_SD_RAW = 14
+DEF _JSON_MAX_KEYS = 16
+
+# Key layouts for documents without and with an sd_raw, as the key order
+# of the dictionary differs between them
+DEF _JSON_LAYOUTS = 2
+
+cdef int _json_key_count[_JSON_LAYOUTS]
+cdef int _json_key_codes[_JSON_LAYOUTS][_JSON_MAX_KEYS]
+cdef char *_json_key_prefixes[_JSON_LAYOUTS][_JSON_MAX_KEYS]
+cdef size_t _json_key_prefix_sizes[_JSON_LAYOUTS][_JSON_MAX_KEYS]
+cdef list _json_key_prefix_objects = list()
+
+
+cdef int _json_check(int error) except -1:
+    if error == JSON_INVALID_UTF8:
+        raise UnicodeError(
+            'Unable to encode message as JSON: data is not valid UTF-8')
+    elif error:
+        raise MemoryError()
+    return 0
+
+
+cdef int _json_put_pystr(cstr_buff *out, bytes value) except -1:
+    return _json_check(json_put_string(
+        out, PyBytes_AS_STRING(value), PyBytes_GET_SIZE(value)))
+
+
+cdef int _json_put_utf8(cstr_buff *out, object value) except -1:
+    cdef Py_buffer view
+
+    if isinstance(value, bytes):
+        return _json_put_pystr(out, value)
+
+    if isinstance(value, unicode):
+        return _json_put_pystr(out, value.encode('utf-8'))
+
+    PyObject_GetBuffer(value, &view, PyBUF_SIMPLE)
+
+    try:
+        return _json_check(json_put_string(out, <char *> view.buf, view.len))
+    finally:
+        PyBuffer_Release(&view)
+
+
+cdef int _json_put_head_str(cstr_buff *out, SyslogMessageHead head,
+                            object cached, int code) except -1:
+    cdef cstr *value = NULL
+
+    if cached is not None:
+        return _json_put_pystr(out, str(cached))
+
+    if head._readable():
+        if code == _JSON_TIMESTAMP:
+            value = head._chead.timestamp
+        elif code == _JSON_HOSTNAME:
+            value = head._chead.hostname
+        elif code == _JSON_APPNAME:
+            value = head._chead.appname
+        elif code == _JSON_PROCESSID:
+            value = head._chead.processid
+        elif code == _JSON_MESSAGEID:
+            value = head._chead.messageid
+
+    if value == NULL:
+        return _json_check(json_put_raw(out, '""', 2))
+    return _json_check(json_put_string(out, value.bytes, value.size))
+
+
+cdef int _json_put_head_int(cstr_buff *out, SyslogMessageHead head,
+                            object cached, int code) except -1:
+    if cached is not None:
+        return _json_put_pystr(out, str(cached))
+
+    if not head._readable():
+        return _json_check(json_put_raw(out, '""', 2))
+
+    _json_check(json_put_raw(out, '"', 1))
+    if code == _JSON_PRIORITY:
+        _json_check(json_put_uint(out, head._chead.priority))
+    else:
+        _json_check(json_put_uint(out, head._chead.version))
+    return _json_check(json_put_raw(out, '"', 1))
+
+
+cdef int _json_put_epoch(cstr_buff *out, SyslogMessageHead head,
+                         int code) except -1:
+    cdef object value
+
+    if not head._epoch_read:
+        if not head._readable() or not head._chead.has_epoch:
+            return _json_check(json_put_raw(out, 'null', 4))
+
+        if code == _JSON_EPOCH:
+            return _json_check(json_put_uint(out, head._chead.epoch))
+        return _json_check(json_put_uint(out, head._chead.epoch_usec))
+
+    value = head._epoch if code == _JSON_EPOCH else head._epoch_usec
+
+    if value is None:
+        return _json_check(json_put_raw(out, 'null', 4))
+    if type(value) in (int, long) and value >= 0:
+        return _json_check(json_put_uint(out, value))
+
+    value = str(value)
+    return _json_check(json_put_raw(out, value, len(value)))
+
+
+cdef int _json_put_priority_part(cstr_buff *out, SyslogMessageHead head,
+                                 int code) except -1:
+    cdef object value
+
+    if head._priority is None and head._readable():
+        if code == _JSON_FACILITY:
+            return _json_check(json_put_uint(out, head._chead.facility))
+        return _json_check(json_put_uint(out, head._chead.severity))
+
+    value = _priority_part(head.priority, code == _JSON_FACILITY)
+
+    if value is None:
+        return _json_check(json_put_raw(out, 'null', 4))
+    if value >= 0:
+        return _json_check(json_put_uint(out, value))
+
+    value = str(value)
+    return _json_check(json_put_raw(out, value, len(value)))
+
+
+cdef inline bint _has_sd_raw(SyslogMessageHead head):
+    if head._sd_raw_read:
+        return head._sd_raw is not None
+    return head._readable() and head._chead.sd_raw != NULL
+
+
+cdef int _json_put_sd_raw(cstr_buff *out, SyslogMessageHead head) except -1:
+    # Only called for heads with an sd_raw
+    cdef cstr *value
+
+    if head._sd_raw_read:
+        return _json_put_utf8(out, head._sd_raw)
+
+    value = head._chead.sd_raw
+    return _json_check(json_put_string(out, value.bytes, value.size))
+
+
+cdef dict _json_key_order(dict source):
+    # Dictionaries built by inserting the same keys in the same order as
+    # SyslogMessageHead.as_dict() iterate in the same order as its copies
+    cdef dict ordered = dict()
+
+    for key in source:
+        ordered[key] = None
+    return ordered
+
+
+cdef int _json_put_sd(cstr_buff *out, dict sd) except -1:
+    cdef bint first_element = True
+    cdef bint first_field
+
+    if not sd:
+        return _json_check(json_put_raw(out, '{}', 2))
+
+    _json_check(json_put_raw(out, '{', 1))
+
+    for sd_name in _json_key_order(sd):
+        if not first_element:
+            _json_check(json_put_raw(out, ', ', 2))
+        first_element = False
+
+        _json_put_utf8(out, sd_name)
+        _json_check(json_put_raw(out, ': {', 3))
+
+        sde = sd[sd_name]
+        first_field = True
+
+        for sd_fieldname in _json_key_order(sde):
+            if not first_field:
+                _json_check(json_put_raw(out, ', ', 2))
+            first_field = False
+
+            _json_put_utf8(out, sd_fieldname)
+            _json_check(json_put_raw(out, ': ', 2))
+            _json_put_utf8(out, sde[sd_fieldname])
+
+        _json_check(json_put_raw(out, '}', 1))
+
+    return _json_check(json_put_raw(out, '}', 1))
+
+
+cdef class JsonEncoder(object):
+    """
+    JsonEncoder writes a syslog message as JSON straight from the parser's
+    state into a reusable buffer. The output is byte for byte what
+    simplejson.dumps returns for the dictionary of SyslogMessageHead.as_dict()
+    with the decoded message and its length added as 'message' and
+    'msg_length', without building that dictionary or decoding any strings.
+    """
+
+    cdef cstr_buff *_buffer
+
+    def __cinit__(self):
+        self._buffer = cstr_buff_new(4096)
+
+        if self._buffer == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        if self._buffer != NULL:
+            cstr_buff_free(self._buffer)
+            self._buffer = NULL
+
+    def encode(self, SyslogMessageHead msg_head not None, message, msg_length):
+        """
+        Returns the JSON document for the given message head, message body
+        and message length. The body may be any buffer-protocol object
+        holding UTF-8 or a unicode string.
+        """
+        cdef cstr_buff *out = self._buffer
+        cdef int layout = _has_sd_raw(msg_head)
+        cdef int index
+        cdef int code
+
+        cstr_buff_reset(out)
+
+        for index in range(_json_key_count[layout]):
+            _json_check(json_put_raw(
+                out, _json_key_prefixes[layout][index],
+                _json_key_prefix_sizes[layout][index]))
+            code = _json_key_codes[layout][index]
+
+            if code == _JSON_PRIORITY:
+                _json_put_head_int(out, msg_head, msg_head._priority, code)
+            elif code == _JSON_VERSION:
+                _json_put_head_int(out, msg_head, msg_head._version, code)
+            elif code == _JSON_TIMESTAMP:
+                _json_put_head_str(out, msg_head, msg_head._timestamp, code)
+            elif code == _JSON_HOSTNAME:
+                _json_put_head_str(out, msg_head, msg_head._hostname, code)
+            elif code == _JSON_APPNAME:
+                _json_put_head_str(out, msg_head, msg_head._appname, code)
+            elif code == _JSON_PROCESSID:
+                _json_put_head_str(out, msg_head, msg_head._processid, code)
+            elif code == _JSON_MESSAGEID:
+                _json_put_head_str(out, msg_head, msg_head._messageid, code)
+            elif code == _JSON_SD:
+                _json_put_sd(out, msg_head._sd)
+            elif code == _JSON_SD_RAW:
+                _json_put_sd_raw(out, msg_head)
+            elif code == _JSON_MESSAGE:
+                _json_put_utf8(out, message)
+            elif code == _JSON_EPOCH or code == _JSON_EPOCH_USEC:
+                _json_put_epoch(out, msg_head, code)
+            elif code == _JSON_FACILITY or code == _JSON_SEVERITY:
+                _json_put_priority_part(out, msg_head, code)
+            elif code == _JSON_MSG_LENGTH:
+                if type(msg_length) in (int, long) and msg_length >= 0:
+                    _json_check(json_put_uint(out, msg_length))
+                else:
+                    _json_check(json_put_raw(
+                        out, str(msg_length), len(str(msg_length))))
+
+        _json_check(json_put_raw(out, '}', 1))
+        return PyBytes_FromStringAndSize(out.data.bytes, out.position)
+
+
+def _init_json_keys():
+    codes = {
+        'priority': _JSON_PRIORITY,
+        'version': _JSON_VERSION,
+        'timestamp': _JSON_TIMESTAMP,
+        'hostname': _JSON_HOSTNAME,
+        'appname': _JSON_APPNAME,
+        'processid': _JSON_PROCESSID,
+        'messageid': _JSON_MESSAGEID,
+        'sd': _JSON_SD,
+        'message': _JSON_MESSAGE,
+        'msg_length': _JSON_MSG_LENGTH,
+        'epoch': _JSON_EPOCH,
+        'epoch_usec': _JSON_EPOCH_USEC,
+        'facility': _JSON_FACILITY,
+        'severity': _JSON_SEVERITY,
+        'sd_raw': _JSON_SD_RAW
+    }
+
+    for layout in range(_JSON_LAYOUTS):
+        # Build the same dictionary the zmq handler serializes to learn the
+        # order simplejson will write its keys in
+        template = SyslogMessageHead().as_dict()
+
+        if layout:
+            template['sd_raw'] = u''
+
+        template['message'] = u''
+        template['msg_length'] = 0
+
+        for index, key in enumerate(template):
+            prefix = '{}"{}": '.format('{' if index == 0 else ', ', key)
+            _json_key_prefix_objects.append(prefix)
+            _json_key_codes[layout][index] = codes[key]
+            _json_key_prefixes[layout][index] = prefix
+            _json_key_prefix_sizes[layout][index] = len(prefix)
+            _json_key_count[layout] = index + 1
+
+_init_json_keys()
+
+
+# Binary wire format written by BinaryEncoder, see portal.wire for the layout
+DEF _BIN_MAGIC = 0xFE
+DEF _BIN_VERSION = 3
+DEF _BIN_HEADER_SIZE = 44
+DEF _BIN_FIELD_LENGTHS = 10
+DEF _BIN_SD_LENGTH = 20
+DEF _BIN_BODY_LENGTH = 24
+DEF _BIN_EPOCH = 28
+DEF _BIN_EPOCH_USEC = 36
+DEF _BIN_SD_RAW_LENGTH = 40
+DEF _BIN_MAX_U16 = 0xFFFF
+DEF _BIN_MAX_U32 = 0xFFFFFFFF
+DEF _BIN_UNSET = 0xFFFF
+DEF _BIN_UNSET_EPOCH = 0xFFFFFFFFFFFFFFFF
+
+BINARY_MAGIC = _BIN_MAGIC
+BINARY_VERSION = _BIN_VERSION
+BINARY_HEADER_SIZE = _BIN_HEADER_SIZE
+
+
+cdef inline void _bin_set_u16(char *dst, size_t value):
+    dst[0] = <char> (value & 0xFF)
+    dst[1] = <char> ((value >> 8) & 0xFF)
+
+
+cdef inline void _bin_set_u32(char *dst, size_t value):
+    dst[0] = <char> (value & 0xFF)
+    dst[1] = <char> ((value >> 8) & 0xFF)
+    dst[2] = <char> ((value >> 16) & 0xFF)
+    dst[3] = <char> ((value >> 24) & 0xFF)
+
+
+cdef inline void _bin_set_u64(char *dst, uint64_t value):
+    _bin_set_u32(dst, value & 0xFFFFFFFF)
+    _bin_set_u32(dst + 4, value >> 32)
+
+
+cdef int _bin_reserve(cstr_buff *out, size_t size) except -1:
+    if cstr_buff_reserve(out, size):
+        raise MemoryError()
+    return 0
+
+
+cdef int _bin_put_bytes(cstr_buff *out, char *src, size_t size) except -1:
+    _bin_reserve(out, size)
+    memcpy(out.data.bytes + out.position, src, size)
+    out.position += size
+    return 0
+
+
+cdef int _bin_put_value(cstr_buff *out, object value, size_t limit) except -1:
+    # Writes a length prefixed value, two bytes of length when the limit fits
+    # in 16 bits and four bytes otherwise
+    cdef Py_buffer view
+    cdef size_t prefix = 2 if limit == _BIN_MAX_U16 else 4
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    PyObject_GetBuffer(value, &view, PyBUF_SIMPLE)
+
+    try:
+        if <size_t> view.len > limit:
+            raise ValueError(
+                'Unable to encode value of {} bytes'.format(view.len))
+
+        _bin_reserve(out, prefix)
+        if prefix == 2:
+            _bin_set_u16(out.data.bytes + out.position, view.len)
+        else:
+            _bin_set_u32(out.data.bytes + out.position, view.len)
+        out.position += prefix
+
+        return _bin_put_bytes(out, <char *> view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+
+
+cdef size_t _bin_put_head_str(cstr_buff *out, SyslogMessageHead head,
+                              object cached, int code) except? 0:
+    cdef cstr *value = NULL
+    cdef bytes text
+
+    if cached is not None:
+        text = str(cached)
+        _bin_put_bytes(out, PyBytes_AS_STRING(text), PyBytes_GET_SIZE(text))
+        return PyBytes_GET_SIZE(text)
+
+    if head._readable():
+        if code == _JSON_TIMESTAMP:
+            value = head._chead.timestamp
+        elif code == _JSON_HOSTNAME:
+            value = head._chead.hostname
+        elif code == _JSON_APPNAME:
+            value = head._chead.appname
+        elif code == _JSON_PROCESSID:
+            value = head._chead.processid
+        elif code == _JSON_MESSAGEID:
+            value = head._chead.messageid
+
+    if value == NULL:
+        return 0
+
+    _bin_put_bytes(out, value.bytes, value.size)
+    return value.size
+
+
+cdef size_t _bin_head_int(SyslogMessageHead head, object cached,
+                          int code) except? 0:
+    cdef size_t value
+
+    if cached is not None:
+        if cached == '':
+            return _BIN_UNSET
+
+        value = int(cached)
+        if value >= _BIN_UNSET:
+            raise ValueError('Unable to encode {}'.format(cached))
+        return value
+
+    if not head._readable():
+        return _BIN_UNSET
+
+    if code == _JSON_PRIORITY:
+        return head._chead.priority
+    return head._chead.version
+
+
+cdef int _bin_set_epoch(char *dst, SyslogMessageHead head) except -1:
+    cdef uint64_t epoch = _BIN_UNSET_EPOCH
+    cdef uint32_t usec = 0
+
+    if head._epoch_read:
+        if head._epoch is not None:
+            epoch = head._epoch
+            usec = head._epoch_usec or 0
+    elif head._readable() and head._chead.has_epoch:
+        epoch = head._chead.epoch
+        usec = head._chead.epoch_usec
+
+    _bin_set_u64(dst + _BIN_EPOCH, epoch)
+    _bin_set_u32(dst + _BIN_EPOCH_USEC, usec)
+    return 0
+
+
+cdef size_t _bin_put_sd_raw(cstr_buff *out, SyslogMessageHead head) except? 0:
+    # Returns the length written, or _BIN_MAX_U32 when there is no raw block
+    cdef cstr *value = NULL
+    cdef bytes text
+    cdef Py_ssize_t value_size
+
+    if head._sd_raw_read:
+        if head._sd_raw is None:
+            return _BIN_MAX_U32
+
+        text = head._sd_raw
+        value_size = PyBytes_GET_SIZE(text)
+
+        if <size_t> value_size >= _BIN_MAX_U32:
+            raise ValueError(
+                'Unable to encode value of {} bytes'.format(value_size))
+
+        _bin_put_bytes(out, PyBytes_AS_STRING(text), value_size)
+        return value_size
+
+    if head._readable():
+        value = head._chead.sd_raw
+
+    if value == NULL:
+        return _BIN_MAX_U32
+
+    if value.size >= _BIN_MAX_U32:
+        raise ValueError(
+            'Unable to encode value of {} bytes'.format(value.size))
+
+    _bin_put_bytes(out, value.bytes, value.size)
+    return value.size
+
+
+cdef int _bin_put_sd(cstr_buff *out, dict sd) except -1:
+    if not sd:
+        return 0
+
+    for sd_name in _json_key_order(sd):
+        sde = sd[sd_name]
+        _bin_put_value(out, sd_name, _BIN_MAX_U16)
+
+        _bin_reserve(out, 2)
+        _bin_set_u16(out.data.bytes + out.position, len(sde))
+        out.position += 2
+
+        for sd_fieldname in _json_key_order(sde):
+            _bin_put_value(out, sd_fieldname, _BIN_MAX_U16)
+            _bin_put_value(out, sde[sd_fieldname], _BIN_MAX_U32)
+
+    return 0
+
+
+cdef class BinaryEncoder(object):
+    """
+    BinaryEncoder writes the head of a syslog message in Portal's binary
+    wire format straight from the parser's state. The message body is not
+    copied into the header; it travels as its own zmq frame so that it can
+    be sent without a copy.
+    """
+
+    cdef cstr_buff *_buffer
+
+    def __cinit__(self):
+        self._buffer = cstr_buff_new(1024)
+
+        if self._buffer == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        if self._buffer != NULL:
+            cstr_buff_free(self._buffer)
+            self._buffer = NULL
+
+    def encode(self, SyslogMessageHead msg_head not None, size_t body_length,
+               size_t msg_length):
+        """
+        Returns the binary header for the given message head, the length of
+        the body frame that follows it and the message length.
+        """
+        cdef cstr_buff *out = self._buffer
+        cdef size_t length
+        cdef int index
+        cdef list cached = [
+            msg_head._timestamp, msg_head._hostname, msg_head._appname,
+            msg_head._processid, msg_head._messageid]
+
+        if body_length > _BIN_MAX_U32 or msg_length > _BIN_MAX_U32:
+            raise ValueError('Unable to encode message of {} bytes'.format(
+                max(body_length, msg_length)))
+
+        cstr_buff_reset(out)
+        _bin_reserve(out, _BIN_HEADER_SIZE)
+        out.position = _BIN_HEADER_SIZE
+
+        (<unsigned char *> out.data.bytes)[0] = _BIN_MAGIC
+        (<unsigned char *> out.data.bytes)[1] = _BIN_VERSION
+        _bin_set_u16(out.data.bytes + 2, _bin_head_int(
+            msg_head, msg_head._priority, _JSON_PRIORITY))
+        _bin_set_u16(out.data.bytes + 4, _bin_head_int(
+            msg_head, msg_head._version, _JSON_VERSION))
+        _bin_set_u32(out.data.bytes + 6, msg_length)
+        _bin_set_epoch(out.data.bytes, msg_head)
+
+        for index in range(5):
+            length = _bin_put_head_str(
+                out, msg_head, cached[index], _JSON_TIMESTAMP + index)
+
+            if length > _BIN_MAX_U16:
+                raise ValueError(
+                    'Unable to encode field of {} bytes'.format(length))
+
+            _bin_set_u16(
+                out.data.bytes + _BIN_FIELD_LENGTHS + index * 2, length)
+
+        length = out.position
+        _bin_put_sd(out, msg_head._sd)
+        _bin_set_u32(
+            out.data.bytes + _BIN_SD_LENGTH, out.position - length)
+        _bin_set_u32(out.data.bytes + _BIN_SD_RAW_LENGTH,
+                     _bin_put_sd_raw(out, msg_head))
+        _bin_set_u32(out.data.bytes + _BIN_BODY_LENGTH, body_length)
+
+        return PyBytes_FromStringAndSize(out.data.bytes, out.position)
+
+
 cdef int on_msg_begin(syslog_parser *parser) except -1:
-    cdef object parser_data = <object> parser.app_data
+    cdef ParserData parser_data = <ParserData> parser.app_data
     parser_data.msg_head.reset()
     return 0
 
 
 cdef int on_sd_element(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
-    cdef object pystr = PyBytes_FromStringAndSize(data, size)
+    cdef ParserData parser_data = <ParserData> parser.app_data
+    cdef object pystr = _intern(data, size)
 
     parser_data.msg_head.create_sde(pystr)
     return 0
 
 
 cdef int on_sd_field(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
-    cdef object pystr = PyBytes_FromStringAndSize(data, size)
+    cdef ParserData parser_data = <ParserData> parser.app_data
+    cdef object pystr = _intern(data, size)
 
     parser_data.msg_head.set_sd_field(pystr)
     return 0
 
 
 cdef int on_sd_value(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
+    cdef ParserData parser_data = <ParserData> parser.app_data
     cdef object pystr = PyBytes_FromStringAndSize(data, size)
 
     parser_data.msg_head.set_sd_value(pystr)
@@ -130,67 +1378,300 @@ cdef int on_sd_value(syslog_parser *parser, char *data, size_t size) except -1:
 
 
 cdef int on_msg_head_complete(syslog_parser *parser) except -1:
-    cdef object parser_data = <object> parser.app_data
+    cdef ParserData parser_data = <ParserData> parser.app_data
 
-    parser_data.msg_head.priority = str(parser.msg_head.priority)
-    parser_data.msg_head.version = str(parser.msg_head.version)
+    # Header fields are materialized lazily from the C state
+    parser_data.msg_head._set_complete()
+    parser_data.head_shared = True
+    parser_data.msg_handler.on_msg_head(parser_data.msg_head)
+    return 0
 
-    parser_data.msg_head.timestamp = PyBytes_FromStringAndSize(
-        parser.msg_head.timestamp.bytes,
-        parser.msg_head.timestamp.size)
 
-    parser_data.msg_head.hostname = PyBytes_FromStringAndSize(
-        parser.msg_head.hostname.bytes,
-        parser.msg_head.hostname.size)
+cdef int on_msg_part(syslog_parser *parser, char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+    cdef object pystr
+    cdef size_t offset
+
+    if (parser_data.zero_copy and parser_data.input_view is not None and
+            data != parser.buffer.data.bytes):
+        # Message parts point into the buffer handed to read() unless the
+        # parser passes on a word of its own, such as an RFC 3164 tag that
+        # turned out to be the start of the message
+        offset = data - parser_data.input_base
+        pystr = parser_data.input_view[offset:offset + size]
+    else:
+        pystr = PyBytes_FromStringAndSize(data, size)
 
-    parser_data.msg_head.appname = PyBytes_FromStringAndSize(
-        parser.msg_head.appname.bytes,
-        parser.msg_head.appname.size)
+    parser_data.msg_handler.on_msg_part(pystr)
+    return 0
 
-    parser_data.msg_head.processid = PyBytes_FromStringAndSize(
-        parser.msg_head.processid.bytes,
-        parser.msg_head.processid.size)
 
-    parser_data.msg_head.messageid = PyBytes_FromStringAndSize(
-        parser.msg_head.messageid.bytes,
-        parser.msg_head.messageid.size)
+cdef int on_msg_complete(syslog_parser *parser) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
 
-    parser_data.msg_handler.on_msg_head(parser_data.msg_head)
+    parser_data.messages += 1
+    parser_data.msg_handler.on_msg_complete(parser.message_length)
     return 0
 
 
-cdef int on_msg_part(syslog_parser *parser, char *data, size_t size) except -1:
-    cdef object parser_data = <object> parser.app_data
-    cdef object pystr = PyBytes_FromStringAndSize(data, size)
+cdef int on_batch_msg_begin(syslog_parser *parser) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+    cdef SyslogRecord record = SyslogRecord()
 
-    parser_data.msg_handler.on_msg_part(pystr)
+    record._attach(parser.msg_head)
+    parser_data.record = record
     return 0
 
 
-cdef int on_msg_complete(syslog_parser *parser) except -1:
-    cdef object parser_data = <object> parser.app_data
+cdef int on_batch_sd_element(syslog_parser *parser, char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
 
-    parser_data.msg_handler.on_msg_complete(parser.message_length)
+    parser_data.record.create_sde(_intern(data, size))
+    return 0
+
+
+cdef int on_batch_sd_field(syslog_parser *parser, char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+
+    parser_data.record.set_sd_field(_intern(data, size))
     return 0
 
 
+cdef int on_batch_sd_value(syslog_parser *parser, char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+
+    parser_data.record.set_sd_value(PyBytes_FromStringAndSize(data, size))
+    return 0
+
+
+cdef int on_batch_msg_head_complete(syslog_parser *parser) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+
+    parser_data.record._set_complete()
+    return 0
+
+
+cdef int on_batch_msg_part(syslog_parser *parser, char *data, size_t size) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+
+    parser_data.record._append(data, size)
+    return 0
+
+
+cdef int on_batch_msg_complete(syslog_parser *parser) except -1:
+    cdef ParserData parser_data = <ParserData> parser.app_data
+
+    parser_data.record._finish(parser.message_length)
+    parser_data.records.append(parser_data.record)
+    parser_data.messages += 1
+    parser_data.record = None
+    return 0
+
+
+# Batch parsing callbacks are the same for every parser
+cdef syslog_parser_settings _BATCH_SETTINGS
+_BATCH_SETTINGS.on_msg_begin = <syslog_cb> on_batch_msg_begin
+_BATCH_SETTINGS.on_sd_element = <syslog_data_cb> on_batch_sd_element
+_BATCH_SETTINGS.on_sd_field = <syslog_data_cb> on_batch_sd_field
+_BATCH_SETTINGS.on_sd_value = <syslog_data_cb> on_batch_sd_value
+_BATCH_SETTINGS.on_msg_head_complete = <syslog_cb> on_batch_msg_head_complete
+_BATCH_SETTINGS.on_msg_part = <syslog_data_cb> on_batch_msg_part
+_BATCH_SETTINGS.on_msg_complete = <syslog_cb> on_batch_msg_complete
+
+
+cdef class BufferPool(object):
+    """
+    BufferPool keeps the buffers that parsers collect tokens in while they
+    are not in use. A parser given a pool only holds a buffer while it is in
+    the middle of a message and hands it back once the message completes, so
+    idle connections cost no buffer at all.
+
+    Buffers start at initial_size bytes and grow as needed up to max_size;
+    tokens longer than that are truncated. Up to capacity released buffers
+    are kept for reuse, shrunk back to initial_size, and any more are freed.
+
+    A pool is not thread safe. Parsers sharing one must be used from the same
+    thread.
+    """
+
+    cdef cstr_buff_pool *_pool
+
+    def __cinit__(self, size_t capacity=1024, size_t initial_size=256,
+                  size_t max_size=65536):
+        if initial_size < 2 or max_size < initial_size:
+            raise ValueError(
+                'Buffers must start at 2 bytes or more and may not start '
+                'above their max_size')
+
+        self._pool = cstr_buff_pool_new(capacity, initial_size, max_size)
+
+        if self._pool == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        if self._pool != NULL:
+            cstr_buff_pool_free(self._pool)
+            self._pool = NULL
+
+    property pooled:
+        """
+        The number of released buffers held for reuse.
+        """
+        def __get__(self):
+            return self._pool.count
+
+    property created:
+        """
+        The number of buffers allocated by the pool.
+        """
+        def __get__(self):
+            return self._pool.created
+
+    property reused:
+        """
+        The number of times a released buffer was handed out again.
+        """
+        def __get__(self):
+            return self._pool.reused
+
+    property capacity:
+        def __get__(self):
+            return self._pool.capacity
+
+    property initial_size:
+        def __get__(self):
+            return self._pool.initial_size
+
+    property max_size:
+        def __get__(self):
+            return self._pool.max_size
+
+
+cdef class ParserPool(object):
+    """
+    ParserPool keeps parsers from closed connections so that new connections
+    can reuse them instead of building new ones. Parsers are reset when they
+    are given back and handed out again by take() with the message handler
+    of the new connection. Up to capacity parsers are kept; any more are
+    left to be freed.
+
+    Parsers created by the pool use its buffer_pool, if any. Like BufferPool
+    it is not thread safe.
+    """
+
+    cdef list _parsers
+    cdef readonly size_t capacity
+    cdef readonly BufferPool buffer_pool
+
+    # Statistics
+    cdef readonly size_t created
+    cdef readonly size_t reused
+
+    def __init__(self, size_t capacity=1024, BufferPool buffer_pool=None):
+        self._parsers = list()
+        self.capacity = capacity
+        self.buffer_pool = buffer_pool
+        self.created = 0
+        self.reused = 0
+
+    property pooled:
+        """
+        The number of parsers held for reuse.
+        """
+        def __get__(self):
+            return len(self._parsers)
+
+    cpdef Parser take(self, msg_handler=None, bint zero_copy=False):
+        """
+        Returns a parser ready to read a new connection that passes messages
+        to the given handler.
+        """
+        cdef Parser parser
+
+        if self._parsers:
+            parser = self._parsers.pop()
+            parser._pooled = False
+            parser._data.msg_handler = msg_handler
+            parser._data.zero_copy = zero_copy
+            self.reused += 1
+            return parser
+
+        self.created += 1
+        return Parser(msg_handler, zero_copy, self.buffer_pool)
+
+    cpdef give(self, Parser parser):
+        """
+        Resets the parser and keeps it for reuse. The parser must not be
+        used again by the caller.
+        """
+        if parser._pooled or len(self._parsers) >= self.capacity:
+            return
+
+        parser._recycle()
+        parser._pooled = True
+        self._parsers.append(parser)
+
+
 cdef class Parser(object):
+    """
+    Parser wraps the C syslog parser and passes parsed messages to a
+    SyslogMessageHandler.
+
+    When zero_copy is set, message parts are handed to on_msg_part as
+    memoryview spans over the buffer given to read() instead of new bytes
+    objects. A span is only valid for the length of the callback; handlers
+    that need the data afterwards must copy it. A message that sits within a
+    single read() buffer is always delivered as one span.
+
+    Instead of read(), parse_batch() may be used to parse a whole buffer and
+    get back the completed messages as a list of SyslogRecord instances. The
+    message handler is not called in that case and may be left unset.
+
+    Without a buffer_pool the parser keeps a buffer of its own for its whole
+    life. It starts small and grows to 64 KiB as longer tokens are read.
+    Header fields and raw structured data kept for the message head are
+    truncated at the same size, which is the buffer_pool max_size if any.
+    """
 
     cdef syslog_parser_settings *_cparser_settings
     cdef syslog_parser *_cparser
-    cdef object _data
+    cdef ParserData _data
+    cdef BufferPool _buffer_pool
+    cdef PriorityFilter _filter
+    cdef SdFilter _sd_filter
+    cdef bint _pooled
 
-    def __init__(self, msg_handler):
+    def __init__(self, msg_handler=None, zero_copy=False, buffer_pool=None):
         self._data = ParserData(msg_handler)
+        self._data.zero_copy = zero_copy
+        self._buffer_pool = buffer_pool
 
         # Init the parser
         self._cparser = <syslog_parser *> malloc(sizeof(syslog_parser))
-        uslg_parser_init(self._cparser, <void *> self._data)
+
+        if self._cparser == NULL:
+            raise MemoryError()
+
+        if uslg_parser_init(self._cparser, <void *> self._data):
+            free(self._cparser)
+            self._cparser = NULL
+            raise MemoryError()
+
+        self._data.msg_head._attach(self._cparser.msg_head)
+        self._release_buffer()
+
+        # Head fields are truncated at the same size as tokens
+        if buffer_pool is not None:
+            uslg_parser_limit_arena(
+                self._cparser, (<BufferPool> buffer_pool)._pool.max_size)
 
         # Init our callbacks
         self._cparser_settings = <syslog_parser_settings *> malloc(
             sizeof(syslog_parser_settings))
 
+        if self._cparser_settings == NULL:
+            raise MemoryError()
+
         self._cparser_settings.on_msg_begin = <syslog_cb> on_msg_begin
         self._cparser_settings.on_sd_element = <syslog_data_cb> on_sd_element
         self._cparser_settings.on_sd_field = <syslog_data_cb> on_sd_field
@@ -201,42 +1682,273 @@ cdef class Parser(object):
 
     def __dealloc__(self):
         if self._cparser != NULL:
+            # Handlers may hold on to the message head past the life of
+            # the parser
+            if self._data is not None and self._data.msg_head is not None:
+                self._data.msg_head._detach()
+
+            if self._buffer_pool is not None and self._cparser.buffer != NULL:
+                cstr_buff_pool_put(
+                    self._buffer_pool._pool, self._cparser.buffer)
+                self._cparser.buffer = NULL
+
             uslg_free_parser(self._cparser)
             self._cparser = NULL
 
+        if self._cparser_settings != NULL:
+            free(self._cparser_settings)
+            self._cparser_settings = NULL
+
+    cdef void _recycle(self):
+        cdef SyslogMessageHead head
+        cdef ParserData data = self._data
+
+        data.msg_handler = None
+        data.exception = None
+        data.messages = 0
+        data.record = None
+        data.records = None
+
+        uslg_parser_reset(self._cparser)
+        self._release_buffer()
+
+        # A head never handed to a handler can be reset in place. Otherwise
+        # it is detached for whoever may still hold it and replaced.
+        head = data.msg_head
+
+        if data.head_shared:
+            head._detach()
+            data.msg_head = SyslogMessageHead()
+            data.msg_head._attach(self._cparser.msg_head)
+            data.head_shared = False
+        else:
+            head.reset()
+
+        # The head no longer points into the arena, which may have grown
+        # for a long message of the last connection
+        uslg_parser_shrink_arena(self._cparser)
+
+    cdef int _acquire_buffer(self) except -1:
+        if self._cparser.buffer == NULL:
+            self._cparser.buffer = cstr_buff_pool_get(self._buffer_pool._pool)
+
+            if self._cparser.buffer == NULL:
+                raise MemoryError()
+
+        return 0
+
+    cdef void _release_buffer(self):
+        cdef cstr_buff *buffer
+
+        if self._buffer_pool is not None:
+            buffer = uslg_parser_take_buffer(self._cparser)
+
+            if buffer != NULL:
+                cstr_buff_pool_put(self._buffer_pool._pool, buffer)
+
+    cdef void _use_filter(self):
+        # Held so that the filter outlives any exec that points at it
+        self._filter = _priority_filter
+
+        if self._filter is None:
+            self._cparser.filter = NULL
+        else:
+            self._cparser.filter = &self._filter._cfilter
+
+        self._sd_filter = _sd_filter
+
+        if self._sd_filter is None:
+            self._cparser.sd_filter = NULL
+        else:
+            self._cparser.sd_filter = &self._sd_filter._cfilter
+
+    property holds_buffer:
+        """
+        Whether the parser currently holds a parse buffer.
+        """
+        def __get__(self):
+            return self._cparser.buffer != NULL
+
+    property arena_size:
+        """
+        The bytes allocated to keep the message head fields.
+        """
+        def __get__(self):
+            return self._cparser.msg_head.arena.data.size
+
     def read(self, data):
-        if isinstance(data, str):
-            strval = data
-        elif isinstance(data, bytearray):
-            strval = str(data)
-        elif isinstance(data, unicode):
-            strval = data.encode('utf-8')
+        """
+        Parses the given data. Any object that supports the buffer protocol,
+        such as str, bytearray or memoryview, is read in place without being
+        copied. Unicode is encoded as UTF-8 first.
+        """
+        cdef Py_buffer view
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self._acquire_buffer()
+        PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
 
         try:
+            if self._data.zero_copy:
+                self._data.input_base = <char *> view.buf
+                self._data.input_view = memoryview(data)
+
+            self._use_filter()
             result = uslg_parser_exec(
                 self._cparser,
                 self._cparser_settings,
-                strval,
-                len(strval))
-        except Exception as ex:
-            raise
+                <char *> view.buf,
+                view.len)
+        finally:
+            self._data.input_base = NULL
+            self._data.input_view = None
+            PyBuffer_Release(&view)
+            self._release_buffer()
+
+        if result:
+            error_pystr = PyBytes_FromString(uslg_error_string(result))
+
+            raise ParsingError(
+                msg=error_pystr,
+                cause=self._data.exception,
+                code=result)
+
+    def read_datagram(self, data):
+        """
+        Parses the given data as one whole message, as sent over UDP, and
+        completes it at the end of the data even when it is not terminated by
+        a newline or an octet count. Data left over from a previous read() is
+        treated as the start of the same message.
+        """
+        self.read(data)
+        self._acquire_buffer()
+
+        try:
+            result = uslg_parser_finish(
+                self._cparser, self._cparser_settings)
+        finally:
+            self._release_buffer()
+
+        if result:
+            error_pystr = PyBytes_FromString(uslg_error_string(result))
+
+            raise ParsingError(
+                msg=error_pystr,
+                cause=self._data.exception,
+                code=result)
+
+    def parse_batch(self, data, final=False):
+        """
+        Parses the given data and returns a tuple of the messages completed
+        within it and the number of trailing bytes that belong to a message
+        that is not yet complete. The parser holds on to that partial message
+        and finishes it with the data passed to the next call.
+
+        When final is set the data is the end of the message, as with a UDP
+        datagram, and the message being parsed is completed as read_datagram
+        does.
+
+        If the data is malformed a ParsingError is raised; the messages
+        completed before the error are available as its records attribute.
+        """
+        cdef Py_buffer view
+        cdef size_t pending = 0
+        cdef int result = 0
+        cdef char *buf
+        cdef size_t length
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self._acquire_buffer()
+        PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+        records = list()
+        buf = <char *> view.buf
+        length = view.len
+
+        try:
+            self._data.input_base = buf
+            self._data.records = records
+            self._use_filter()
+
+            result = uslg_parser_exec(
+                self._cparser, &_BATCH_SETTINGS, buf, length)
+
+            if not result and final:
+                result = uslg_parser_finish(self._cparser, &_BATCH_SETTINGS)
+
+            pending = uslg_parser_pending(self._cparser, length)
+        finally:
+            self._data.input_base = NULL
+            self._data.records = None
+            PyBuffer_Release(&view)
+            self._release_buffer()
 
         if result:
+            self._data.record = None
             error_pystr = PyBytes_FromString(uslg_error_string(result))
 
             raise ParsingError(
                 msg=error_pystr,
-                cause=self._data.exception)
+                cause=self._data.exception,
+                records=records,
+                code=result)
+
+        return records, pending
+
+    property messages:
+        """
+        The number of messages completed over the life of the parser.
+        """
+        def __get__(self):
+            return self._data.messages
 
     def reset(self):
+        self._data.record = None
+        self._data.msg_head._detach()
         uslg_parser_reset(self._cparser)
-        self._data.msg_handler.msg_head = None
+        self._release_buffer()
+
+        if self._data.msg_handler is not None:
+            self._data.msg_handler.msg_head = None
+
         self._data.msg_head = SyslogMessageHead()
+        self._data.msg_head._attach(self._cparser.msg_head)
+        self._data.head_shared = False
+
+
+cdef class ParserData(object):
+
+    cdef public object msg_handler
+    cdef public SyslogMessageHead msg_head
+    cdef public object exception
+
+    # Set once msg_head has been handed to the message handler
+    cdef bint head_shared
+    cdef public bint zero_copy
+
+    # Messages completed over the life of the parser
+    cdef public size_t messages
 
+    # The buffer currently being read when zero_copy is set or when
+    # parsing a batch
+    cdef char *input_base
+    cdef object input_view
 
-class ParserData(object):
+    # Batch parsing state
+    cdef SyslogRecord record
+    cdef list records
 
     def __init__(self, msg_handler):
         self.msg_handler = msg_handler
         self.msg_head = SyslogMessageHead()
         self.exception = None
+        self.head_shared = False
+        self.zero_copy = False
+        self.messages = 0
+        self.input_base = NULL
+        self.input_view = None
+        self.record = None
+        self.records = None
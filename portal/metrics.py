@@ -0,0 +1,564 @@
+"""
+The metrics module keeps counters, gauges and latency histograms for the
+ingestion pipeline and serves them over HTTP as JSON or in the Prometheus
+text format.
+
+Metrics are registered once, usually when the object they describe is
+created, and the returned metric is kept and updated directly so that
+recording a value is a single attribute update. Labels are given as keyword
+arguments and each distinct set of labels is its own metric.
+
+Each worker process keeps its own registry. When a snapshot directory is
+configured every worker writes its metrics there periodically, and whichever
+worker answers an HTTP request sums the snapshots of all workers with its own
+live metrics.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import PeriodicCallback
+from tornado.netutil import bind_sockets
+
+from portal.log import get_logger
+
+
+_LOG = get_logger(__name__)
+
+# Latency buckets in seconds, from 50 microseconds up to 5 seconds
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Buckets for sizes and counts, such as the bytes read over a connection, in
+# powers of ten from 1 up to a billion
+COUNT_BUCKETS = tuple(10 ** exponent for exponent in range(10))
+
+# Snapshots older than this many snapshot intervals are left out of the
+# aggregate, as are any left behind by workers that no longer exist
+_STALE_INTERVALS = 5
+
+_CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4'
+_CONTENT_TYPE_JSON = 'application/json'
+
+
+class Counter(object):
+    """
+    A value that only goes up, such as a count of messages. A counter may be
+    given a function returning a total kept elsewhere, in which case its
+    value is whatever the function returns when a snapshot is taken.
+    """
+
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class Gauge(object):
+    """
+    A value that goes up and down, such as a queue depth. A gauge may be
+    given a function, in which case its value is whatever the function
+    returns when a snapshot is taken.
+    """
+
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def sample(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class Histogram(object):
+    """
+    Counts observed values into fixed buckets and keeps their sum, as
+    Prometheus histograms do. Bucket counts are kept per bucket here and
+    only made cumulative when formatted. A histogram may be observed from
+    several threads, such as by sender threads and the IOLoop at once.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def sample(self):
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'counts': list(self.counts),
+                'sum': self.sum,
+                'count': self.count
+            }
+
+
+_KINDS = {
+    'counter': Counter,
+    'gauge': Gauge,
+    'histogram': Histogram
+}
+
+
+class MetricsRegistry(object):
+    """
+    MetricsRegistry holds every metric of a process by name and labels.
+    """
+
+    def __init__(self):
+        # name -> (kind, help, {sorted label items: metric})
+        self._families = dict()
+
+    def counter(self, name, help='', fn=None, **labels):
+        """
+        Returns the counter with the given name and labels, creating it the
+        first time it is asked for. A function given as fn replaces the
+        function of an existing counter.
+        """
+        return self._get_with_fn('counter', name, help, fn, labels)
+
+    def gauge(self, name, help='', fn=None, **labels):
+        """
+        Returns the gauge with the given name and labels, creating it the
+        first time it is asked for. A function given as fn replaces the
+        function of an existing gauge.
+        """
+        return self._get_with_fn('gauge', name, help, fn, labels)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Returns the histogram with the given name and labels, creating it
+        with the given buckets the first time it is asked for.
+        """
+        return self._get('histogram', name, help, labels, buckets)
+
+    def remove(self, name, **labels):
+        """
+        Forgets the metric with the given name and labels, such as a gauge
+        whose function refers to an object that has gone away.
+        """
+        family = self._families.get(name)
+
+        if family is not None:
+            family[2].pop(_label_key(labels), None)
+
+    def clear(self):
+        """
+        Forgets every metric.
+        """
+        self._families.clear()
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric as a dictionary that may be
+        serialized as JSON, merged with merge_snapshots and formatted with
+        format_prometheus.
+        """
+        snapshot = dict()
+
+        for name, (kind, help, metrics) in self._families.items():
+            samples = list()
+
+            for key, metric in metrics.items():
+                try:
+                    value = metric.sample()
+                except Exception as ex:
+                    _LOG.debug('Unable to sample {}: {}'.format(name, ex))
+                    continue
+
+                samples.append({'labels': dict(key), 'value': value})
+
+            snapshot[name] = {'type': kind, 'help': help, 'samples': samples}
+
+        return snapshot
+
+    def _get_with_fn(self, kind, name, help, fn, labels):
+        metric = self._get(kind, name, help, labels)
+
+        if fn is not None:
+            metric.fn = fn
+
+        return metric
+
+    def _get(self, kind, name, help, labels, *args):
+        family = self._families.get(name)
+
+        if family is None:
+            family = (kind, help, dict())
+            self._families[name] = family
+        elif family[0] != kind:
+            raise ValueError('{} is already registered as a {}'.format(
+                name, family[0]))
+
+        key = _label_key(labels)
+        metric = family[2].get(key)
+
+        if metric is None:
+            metric = _KINDS[kind](*args)
+            family[2][key] = metric
+
+        return metric
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def merge_snapshots(snapshots):
+    """
+    Sums a list of snapshots, such as those of several worker processes,
+    into one. Samples with the same name and labels are added together;
+    histograms are added bucket by bucket.
+    """
+    merged = dict()
+
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.get(name)
+
+            if target is None:
+                target = {
+                    'type': family['type'],
+                    'help': family['help'],
+                    'samples': list()
+                }
+                merged[name] = target
+                index = dict()
+                target['_index'] = index
+            else:
+                index = target['_index']
+
+            for sample in family['samples']:
+                key = _label_key(sample['labels'])
+                existing = index.get(key)
+
+                if existing is None:
+                    existing = {
+                        'labels': dict(sample['labels']),
+                        'value': _copy_value(sample['value'])
+                    }
+                    index[key] = existing
+                    target['samples'].append(existing)
+                else:
+                    existing['value'] = _add_values(
+                        existing['value'], sample['value'])
+
+    for family in merged.values():
+        del family['_index']
+
+    return merged
+
+
+def _copy_value(value):
+    if isinstance(value, dict):
+        return dict(value, counts=list(value['counts']))
+    return value
+
+
+def _add_values(left, right):
+    if isinstance(left, dict):
+        if left['buckets'] != right['buckets']:
+            # Histograms created with different buckets can't be added
+            return left
+
+        return {
+            'buckets': left['buckets'],
+            'counts': [a + b for a, b in zip(left['counts'], right['counts'])],
+            'sum': left['sum'] + right['sum'],
+            'count': left['count'] + right['count']
+        }
+    return left + right
+
+
+def format_prometheus(snapshot):
+    """
+    Formats a snapshot in the Prometheus text exposition format.
+    """
+    lines = list()
+
+    for name in sorted(snapshot):
+        family = snapshot[name]
+
+        if family['help']:
+            lines.append('# HELP {} {}'.format(name, family['help']))
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+
+        for sample in family['samples']:
+            labels = sample['labels']
+            value = sample['value']
+
+            if family['type'] != 'histogram':
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(labels), _format_number(value)))
+                continue
+
+            cumulative = 0
+            bounds = [_format_number(b) for b in value['buckets']] + ['+Inf']
+
+            for bound, count in zip(bounds, value['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(dict(labels, le=bound)), cumulative))
+
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), _format_number(value['sum'])))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), value['count']))
+
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())))
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class SnapshotStore(object):
+    """
+    SnapshotStore writes the snapshot of one worker process to a directory
+    shared by all workers and reads back the snapshots of the others.
+    """
+
+    def __init__(self, directory, name, interval=1.0):
+        """
+        :param directory: The directory snapshots are written to
+        :param name: The name this process's snapshot is written under
+        :param interval: Seconds between snapshots, used to tell when the
+        snapshot of another process is stale
+        """
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, '{}.json'.format(self.name))
+
+    def write(self, snapshot):
+        """
+        Writes the given snapshot, replacing the previous one atomically.
+        """
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+
+        try:
+            with open(temp_path, 'w') as out:
+                json.dump({'pid': os.getpid(), 'metrics': snapshot}, out)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as ex:
+            _LOG.warning('Unable to write metrics snapshot: {}'.format(ex))
+
+    def read_others(self):
+        """
+        Returns the fresh snapshots written by other processes.
+        """
+        snapshots = list()
+        oldest = time.time() - self.interval * _STALE_INTERVALS
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return snapshots
+
+        for filename in names:
+            path = os.path.join(self.directory, filename)
+
+            if not filename.endswith('.json') or path == self.path:
+                continue
+
+            try:
+                if os.path.getmtime(path) < oldest:
+                    continue
+
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (IOError, OSError, ValueError):
+                continue
+
+            if _pid_alive(snapshot.get('pid')):
+                snapshots.append(snapshot['metrics'])
+
+        return snapshots
+
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class MetricsHandler(web.RequestHandler):
+    """
+    Serves the aggregated metrics. Requests for /metrics.json, or with
+    ?format=json, are answered with JSON and everything else with the
+    Prometheus text format.
+    """
+
+    def initialize(self, registry, store=None):
+        self.registry = registry
+        self.store = store
+
+    def get(self):
+        snapshots = [self.registry.snapshot()]
+
+        if self.store is not None:
+            snapshots.extend(self.store.read_others())
+
+        snapshot = merge_snapshots(snapshots)
+
+        if (self.request.path.endswith('.json') or
+                self.get_argument('format', None) == 'json'):
+            self.set_header('Content-Type', _CONTENT_TYPE_JSON)
+            self.write(json.dumps(snapshot, sort_keys=True))
+        else:
+            self.set_header('Content-Type', _CONTENT_TYPE_TEXT)
+            self.write(format_prometheus(snapshot))
+
+
+def metrics_application(registry, store=None):
+    """
+    Returns a tornado web application serving the metrics of the given
+    registry at /metrics and /metrics.json.
+    """
+    options = dict(registry=registry, store=store)
+
+    return web.Application([
+        (r'/metrics', MetricsHandler, options),
+        (r'/metrics\.json', MetricsHandler, options)
+    ])
+
+
+class MetricsServer(object):
+    """
+    MetricsServer serves the metrics endpoint from the I/O loop. Like the
+    UDP server its socket is bound before forking so that any worker may
+    answer. When given a snapshot directory each worker writes its snapshot
+    there every snapshot_interval seconds so that the answer covers all of
+    them.
+    """
+
+    def __init__(self, address, registry=None, snapshot_dir=None,
+                 snapshot_interval=1.0):
+        """
+        :param address: (host, port) to listen on
+        :param registry: The MetricsRegistry to serve; the process registry
+        if unset
+        :param snapshot_dir: Optional directory shared by the workers
+        :param snapshot_interval: Seconds between snapshots
+        """
+        self.address = address
+        self.registry = registry if registry is not None else get_registry()
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.sockets = None
+        self.store = None
+        self.http_server = None
+        self._writer = None
+
+    def bind(self):
+        """
+        Binds the listening sockets. This is done before forking so that all
+        worker processes accept on them.
+        """
+        self.sockets = bind_sockets(int(self.address[1]), self.address[0])
+
+    def start(self, name):
+        """
+        Starts serving on the I/O loop and writing snapshots.
+
+        :param name: The name this worker's snapshot is written under
+        """
+        if self.sockets is None:
+            self.bind()
+
+        if self.snapshot_dir is not None:
+            if not os.path.isdir(self.snapshot_dir):
+                os.makedirs(self.snapshot_dir)
+
+            self.store = SnapshotStore(
+                self.snapshot_dir, name, self.snapshot_interval)
+            self._writer = PeriodicCallback(
+                self.write_snapshot, self.snapshot_interval * 1000)
+            self._writer.start()
+
+        self.http_server = HTTPServer(
+            metrics_application(self.registry, self.store))
+        self.http_server.add_sockets(self.sockets)
+        _LOG.info('Metrics server ready!')
+
+    def write_snapshot(self):
+        if self.store is not None:
+            self.store.write(self.registry.snapshot())
+
+    def stop(self):
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+
+        if self.http_server is not None:
+            self.http_server.stop()
+            self.http_server = None
+
+
+_REGISTRY = MetricsRegistry()
+
+
+def get_registry():
+    """
+    Returns the metrics registry of this process.
+    """
+    return _REGISTRY
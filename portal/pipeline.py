@@ -0,0 +1,368 @@
+"""
+The pipeline module moves the serialization and sending of parsed syslog
+messages off of the I/O loop. In pipeline mode the I/O loop only parses
+client data into records and hands them to a bounded queue. Sender threads
+take records from the queue, serialize them and push them downstream over
+ZeroMQ. Parsing, building records and serializing all hold the GIL; pyzmq
+releases it while it sends, so only the sends themselves run alongside the
+I/O loop.
+"""
+
+import collections
+import threading
+import time
+import Queue
+
+import zmq
+from tornado.ioloop import IOLoop
+
+from portal.log import get_logger
+from portal.metrics import get_registry
+from portal.input.syslog import BinaryEncoder, JsonEncoder, ParsingError
+
+
+_LOG = get_logger(__name__)
+
+_STOP = object()
+
+
+class BatchReader(object):
+    """
+    BatchReader parses client data with Parser.parse_batch and submits the
+    completed records to a SenderPool. It takes the place of a parser as the
+    reader of a TornadoConnection.
+    """
+
+    def __init__(self, parser, sink):
+        """
+        :param parser: An instance of the Parser class
+        :param sink: An object with a submit method taking a list of records,
+        such as a SenderPool
+        """
+        self.parser = parser
+        self.sink = sink
+
+    @property
+    def messages(self):
+        """
+        Returns the number of messages parsed so far.
+        """
+        return self.parser.messages
+
+    def read(self, data):
+        """
+        Parses the given data and submits any records completed within it.
+        """
+        try:
+            records, pending = self.parser.parse_batch(data)
+        except ParsingError as ex:
+            if ex.records:
+                self.sink.submit(ex.records)
+            raise
+
+        if records:
+            self.sink.submit(records)
+
+
+class SenderPool(object):
+    """
+    SenderPool serializes records and sends them downstream from a pool of
+    threads. Records are submitted from the I/O loop into a queue that holds
+    at most queue_size records. Each sender thread takes up to batch_size
+    records at a time, serializes them as JSON or in the binary wire format
+    and sends them as one zmq message over a PUSH socket of its own. The
+    thread sockets connect to an inproc PULL socket that a proxy thread
+    forwards from to the bound PUSH socket, so no thread waits on another's
+    send. Sends block in the sender threads, never on the I/O loop.
+
+    When the queue is full, records are held back in order and listeners
+    added with add_listener have their on_saturated method called. The held
+    records are retried on the I/O loop every retry_interval seconds and
+    listeners have their on_drained method called once all of them are
+    queued.
+
+    The time from records being submitted to being sent and the time each
+    send takes are recorded in the portal_parse_to_send_seconds and
+    portal_caster_send_seconds histograms.
+    """
+
+    def __init__(self, bind_host_tuple, wire_format='json', threads=1,
+                 queue_size=1024, batch_size=1, sndhwm=None,
+                 retry_interval=0.005):
+        """
+        :param bind_host_tuple: (host, port), for example ('127.0.0.1', '5000')
+        :param wire_format: Either 'json' or 'binary'
+        :param threads: The number of sender threads
+        :param queue_size: The most records waiting for a sender thread
+        :param batch_size: The most records sent as one zmq message
+        :param sndhwm: Optional send high-water mark for the zmq socket
+        :param retry_interval: Seconds between attempts to queue held back
+        records. None leaves retrying to explicit drain calls.
+        """
+        if wire_format not in ('json', 'binary'):
+            raise ValueError(
+                'Unknown wire format: {}'.format(wire_format))
+
+        self.bind_host = 'tcp://{0}:{1}'.format(*bind_host_tuple)
+        self.wire_format = wire_format
+        self.thread_count = threads
+        self.batch_size = batch_size
+        self.sndhwm = sndhwm
+        self.retry_interval = retry_interval
+
+        self.context = None
+        self.socket = None
+        self.started = False
+        self._address = 'inproc://portal-sender-{}'.format(id(self))
+        self._control = None
+        self._proxy = None
+        self.sent = 0
+        self.saturated = False
+
+        self._queue = Queue.Queue(queue_size)
+        self._held = collections.deque()
+        self._threads = list()
+        self._listeners = list()
+        self._lock = threading.Lock()
+        self._retry_scheduled = False
+
+        registry = get_registry()
+        self._parse_to_send = registry.histogram(
+            'portal_parse_to_send_seconds',
+            'Seconds from a message head being parsed to its send')
+        self._send_latency = registry.histogram(
+            'portal_caster_send_seconds', 'Seconds spent sending to zmq')
+        registry.gauge(
+            'portal_sender_queue_depth', 'Records waiting to be sent',
+            fn=lambda: self.queue_depth, endpoint=self.bind_host)
+        registry.counter(
+            'portal_sender_records_total', 'Records sent by sender threads',
+            fn=lambda: self.sent, endpoint=self.bind_host)
+
+    @property
+    def queue_depth(self):
+        """
+        Returns the number of records waiting to be sent.
+        """
+        return self._queue.qsize() + len(self._held)
+
+    def add_listener(self, listener):
+        """
+        Adds a listener to be told when the pool saturates and drains. The
+        listener must have on_saturated and on_drained methods.
+        """
+        self._listeners.append(listener)
+
+    def start(self):
+        """
+        Binds the zmq PUSH socket and starts the proxy and sender threads.
+        This must happen after forking.
+        """
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUSH)
+
+        if self.sndhwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+
+        self.socket.bind(self.bind_host)
+
+        # The sender threads push to the proxy over inproc and the proxy is
+        # told to stop over a PAIR socket
+        frontend = self.context.socket(zmq.PULL)
+        frontend.bind(self._address)
+        control = self.context.socket(zmq.PAIR)
+        control.bind(self._address + '-control')
+        self._control = self.context.socket(zmq.PAIR)
+        self._control.connect(self._address + '-control')
+
+        self._proxy = threading.Thread(
+            target=self._forward, args=(frontend, control),
+            name='portal-sender-proxy')
+        self._proxy.daemon = True
+        self._proxy.start()
+
+        for index in range(self.thread_count):
+            thread = threading.Thread(
+                target=self._run, name='portal-sender-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self.started = True
+
+    def submit(self, records):
+        """
+        Queues records to be sent. This is meant to be called from the I/O
+        loop and never blocks.
+        """
+        # Records are queued along with when they were submitted
+        submitted = time.time()
+        entries = [(submitted, record) for record in records]
+
+        if self._held:
+            self._held.extend(entries)
+            return
+
+        for index, entry in enumerate(entries):
+            try:
+                self._queue.put_nowait(entry)
+            except Queue.Full:
+                self._held.extend(entries[index:])
+                self._saturate()
+                return
+
+    def drain(self):
+        """
+        Queues as many held back records as there is room for. Returns True
+        once none are held back.
+        """
+        while self._held:
+            try:
+                self._queue.put_nowait(self._held[0])
+            except Queue.Full:
+                self._schedule_retry()
+                return False
+            self._held.popleft()
+
+        if self.saturated:
+            self.saturated = False
+
+            for listener in self._listeners:
+                listener.on_drained()
+
+        return True
+
+    def close(self, timeout=5):
+        """
+        Stops the sender threads once the queue is empty and closes the zmq
+        socket.
+        """
+        if not self.started:
+            return
+
+        if self._held:
+            _LOG.warning('Closing with {} records held back'.format(
+                len(self._held)))
+            self._held.clear()
+
+        for thread in self._threads:
+            self._queue.put(_STOP)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._control.send(b'TERMINATE')
+        self._proxy.join(timeout)
+        self._control.close()
+
+        self.socket.close()
+        self.context.destroy()
+        self.socket = None
+        self.context = None
+        self._control = None
+        self._proxy = None
+        self._threads = list()
+        self.started = False
+
+    def _saturate(self):
+        if not self.saturated:
+            self.saturated = True
+
+            for listener in self._listeners:
+                listener.on_saturated()
+
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        if self._retry_scheduled or self.retry_interval is None:
+            return
+
+        self._retry_scheduled = True
+        IOLoop.current().call_later(self.retry_interval, self._retry)
+
+    def _retry(self):
+        self._retry_scheduled = False
+
+        if self.started:
+            self.drain()
+
+    def _forward(self, frontend, control):
+        zmq.proxy_steerable(frontend, self.socket, None, control)
+
+        # The sender threads have stopped by the time the proxy is told to,
+        # but what they sent last may not have been forwarded yet
+        while True:
+            try:
+                frames = frontend.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+
+            self.socket.send_multipart(frames, copy=False)
+
+        frontend.close()
+        control.close()
+
+    def _run(self):
+        if self.wire_format == 'binary':
+            encoder = BinaryEncoder()
+        else:
+            encoder = JsonEncoder()
+
+        socket = self.context.socket(zmq.PUSH)
+        socket.connect(self._address)
+        running = True
+
+        while running:
+            entries = list()
+            entry = self._queue.get()
+
+            # Each thread takes exactly one stop sentinel, so a batch ends
+            # at the first one and leaves the rest to the other threads
+            while entry is not _STOP:
+                entries.append(entry)
+
+                if len(entries) == self.batch_size:
+                    break
+
+                try:
+                    entry = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+            running = entry is not _STOP
+
+            if entries:
+                try:
+                    self._send(socket, encoder, entries)
+                except Exception as ex:
+                    _LOG.exception(ex)
+
+        socket.close()
+
+    def _send(self, socket, encoder, entries):
+        frames = list()
+
+        for submitted, record in entries:
+            if self.wire_format == 'binary':
+                frames.append(encoder.encode(
+                    record, len(record.message), record.msg_length))
+                frames.append(record.message)
+            else:
+                frames.append(encoder.encode(
+                    record, record.message, record.msg_length))
+
+        start = time.time()
+
+        if len(frames) == 1:
+            socket.send(frames[0])
+        else:
+            socket.send_multipart(frames, copy=False)
+
+        now = time.time()
+        self._send_latency.observe(now - start)
+
+        for submitted, record in entries:
+            self._parse_to_send.observe(now - submitted)
+
+        with self._lock:
+            self.sent += len(entries)
@@ -0,0 +1,435 @@
+"""
+The routing module decides what becomes of each parsed syslog message before
+any work is spent serializing it. Rules are declared in portal.conf as
+'rule:<name>' sections and compiled at startup. Each rule matches on head
+fields and structured data and then drops, tags or routes the messages it
+matches:
+
+    [rule:cron]
+    appname = CRON, anacron
+    action = drop
+
+    [rule:ci]
+    hostname = build-*, /^ci\\d+\\./
+    action = tag
+    tag = ci
+
+    [rule:acme]
+    sd = meta.tenant = acme
+    action = route
+    route = localhost:5100
+
+A pattern is an exact value, a prefix ending in * or a regular expression
+between slashes, which is searched for anywhere in the value. A rule matches
+when every field it names matches any of its patterns. Rules are tried in
+order; tag rules carry on to the rules after them while the first drop or
+route rule to match decides the message. Messages no rule decides go to the
+default destination.
+
+Tags are added to the message's structured data as the comma separated
+'tags' field of the 'portal' element so that they reach downstream workers
+in either wire format.
+"""
+
+import operator
+import re
+
+from portal.config import split_patterns
+from portal.metrics import get_registry
+
+
+DROP = 'drop'
+TAG = 'tag'
+ROUTE = 'route'
+
+# Returned by RuleSet.apply for messages that are dropped
+DROPPED = object()
+
+TAG_ELEMENT = 'portal'
+TAG_FIELD = 'tags'
+
+HEAD_FIELDS = ('hostname', 'appname', 'processid', 'messageid')
+
+
+class RuleError(Exception):
+    """
+    Raised when a rule can not be compiled.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class Matcher(object):
+    """
+    Matcher finds which rules match a value of one field. Every rule is a
+    bit in the masks it returns. Exact values are looked up in a dictionary
+    and prefixes in a dictionary for each prefix length, so a value costs one
+    lookup per distinct length however many rules there are. Regular
+    expressions are joined into one pattern that is tried first so that
+    values none of them match cost a single search. Expressions anchored
+    with ^ are joined apart from the rest and only tried at the start of the
+    value.
+    """
+
+    __slots__ = ('exact', 'prefixes', 'expressions', 'anchored', 'floating',
+                 'always')
+
+    def __init__(self):
+        self.exact = dict()
+        self.prefixes = dict()
+        self.expressions = list()
+        self.anchored = None
+        self.floating = None
+
+        # Rules with no condition on the field
+        self.always = 0
+
+    def add(self, bit, patterns):
+        """
+        Adds the rule with the given bit as matching any of the patterns.
+        """
+        expressions = list()
+
+        for pattern in patterns:
+            if len(pattern) > 1 and pattern[0] == '/' and pattern[-1] == '/':
+                expressions.append(pattern[1:-1])
+            elif pattern.endswith('*'):
+                prefixes = self.prefixes.setdefault(len(pattern) - 1, dict())
+                prefixes[pattern[:-1]] = prefixes.get(pattern[:-1], 0) | bit
+            else:
+                self.exact[pattern] = self.exact.get(pattern, 0) | bit
+
+        for expression in expressions:
+            # Only a lone branch is known to be anchored by a leading ^
+            anchored = expression.startswith('^') and '|' not in expression
+            self.expressions.append((
+                _compile_expressions([expression]), bit, anchored))
+
+    def compile(self):
+        """
+        Readies the matcher once every rule has been added.
+        """
+        if not isinstance(self.prefixes, tuple):
+            self.prefixes = tuple(sorted(self.prefixes.iteritems()))
+
+        anchored = [expression.pattern
+                    for expression, bit, is_anchored in self.expressions
+                    if is_anchored]
+        floating = [expression.pattern
+                    for expression, bit, is_anchored in self.expressions
+                    if not is_anchored]
+
+        if anchored:
+            self.anchored = _compile_expressions(anchored)
+
+        if floating:
+            self.floating = _compile_expressions(floating)
+
+    def match(self, value):
+        """
+        Returns the mask of the rules that the value matches.
+        """
+        mask = self.always | self.exact.get(value, 0)
+
+        for length, prefixes in self.prefixes:
+            mask |= prefixes.get(value[:length], 0)
+
+        if ((self.anchored is not None and
+                self.anchored.match(value) is not None) or
+                (self.floating is not None and
+                 self.floating.search(value) is not None)):
+            for expression, bit, anchored in self.expressions:
+                if anchored:
+                    found = expression.match(value)
+                else:
+                    found = expression.search(value)
+
+                if found is not None:
+                    mask |= bit
+
+        return mask
+
+
+def _compile_expressions(expressions):
+    try:
+        return re.compile('|'.join(
+            '(?:{})'.format(expression) for expression in expressions))
+    except re.error as ex:
+        raise RuleError('Bad pattern in {}: {}'.format(
+            ', '.join(expressions), ex))
+
+
+class Rule(object):
+    """
+    Rule is a routing rule as declared. The number of messages it has
+    matched is kept in hits.
+    """
+
+    def __init__(self, name, action, fields=None, sd=None, tag=None,
+                 route=None):
+        """
+        :param name: The name of the rule
+        :param action: One of drop, tag or route
+        :param fields: A dictionary of head field names to lists of patterns
+        :param sd: A list of (element, field, patterns) tuples
+        :param tag: The tag to add when the action is tag
+        :param route: The destination key when the action is route
+        """
+        if action not in (DROP, TAG, ROUTE):
+            raise RuleError('Rule {} has unknown action {!r}'.format(
+                name, action))
+
+        if action == TAG and not tag:
+            raise RuleError('Rule {} tags without a tag'.format(name))
+
+        if action == ROUTE and route is None:
+            raise RuleError('Rule {} routes without a route'.format(name))
+
+        fields = fields or dict()
+
+        for field in fields:
+            if field not in HEAD_FIELDS:
+                raise RuleError('Rule {} matches unknown field {}'.format(
+                    name, field))
+
+        if not fields and not sd:
+            raise RuleError('Rule {} has nothing to match on'.format(name))
+
+        self.name = name
+        self.action = action
+        self.tag = tag
+        self.route = route
+        self.fields = fields
+        self.sd = list(sd or ())
+        self.hits = 0
+
+
+_EMPTY = dict()
+
+
+class RuleSet(object):
+    """
+    RuleSet applies its rules in order to parsed message heads. The rules
+    are compiled into a Matcher for each field that any of them look at, so
+    a message costs a few lookups per field rather than a test per rule.
+    Every rule's hits are published as the portal_rule_hits_total counter
+    labelled with the rule's name.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: A list of Rule instances
+        """
+        names = set()
+
+        for rule in rules:
+            if rule.name in names:
+                raise RuleError('Rule {} is declared twice'.format(rule.name))
+            names.add(rule.name)
+
+        self.rules = tuple(rules)
+        self._all = (1 << len(self.rules)) - 1
+        self._by_bit = dict(
+            (1 << index, rule) for index, rule in enumerate(self.rules))
+
+        fields = dict()
+        sd = dict()
+
+        for index, rule in enumerate(self.rules):
+            for field, patterns in rule.fields.iteritems():
+                fields.setdefault(field, Matcher()).add(1 << index, patterns)
+
+            for element, field, patterns in rule.sd:
+                sd.setdefault((element, field), Matcher()).add(
+                    1 << index, patterns)
+
+        # Rules without a condition on a field match whatever it holds
+        for index, rule in enumerate(self.rules):
+            for field, matcher in fields.iteritems():
+                if field not in rule.fields:
+                    matcher.always |= 1 << index
+
+            sd_keys = set((element, field) for element, field, p in rule.sd)
+
+            for key, matcher in sd.iteritems():
+                if key not in sd_keys:
+                    matcher.always |= 1 << index
+
+        for matcher in fields.values() + sd.values():
+            matcher.compile()
+
+        self._fields = tuple(
+            (operator.attrgetter(field), matcher)
+            for field, matcher in sorted(fields.iteritems()))
+        self._sd = tuple(
+            (element, field, matcher)
+            for (element, field), matcher in sorted(sd.iteritems()))
+
+        registry = get_registry()
+
+        for rule in self.rules:
+            registry.counter(
+                'portal_rule_hits_total', 'Messages matched by each rule',
+                fn=lambda rule=rule: rule.hits, rule=rule.name)
+
+    @classmethod
+    def from_config(cls, rule_configs):
+        """
+        Compiles the rules of the given list of RuleConfiguration instances.
+        """
+        return cls([_compile(rule_config) for rule_config in rule_configs])
+
+    @property
+    def routes(self):
+        """
+        Returns the set of destinations that the rules route to.
+        """
+        return set(rule.route for rule in self.rules if rule.action == ROUTE)
+
+    def matching(self, msg_head):
+        """
+        Returns the rules that match the message head in order.
+        """
+        mask = self._match(msg_head)
+        rules = list()
+
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            rules.append(self._by_bit[bit])
+
+        return rules
+
+    def _match(self, msg_head):
+        mask = self._all
+
+        for getter, matcher in self._fields:
+            mask &= matcher.match(getter(msg_head))
+
+            if not mask:
+                return 0
+
+        if self._sd:
+            sd = msg_head.sd
+
+            for element, field, matcher in self._sd:
+                value = sd.get(element, _EMPTY).get(field)
+
+                if value is None:
+                    mask &= matcher.always
+                else:
+                    mask &= matcher.match(value)
+
+                if not mask:
+                    return 0
+
+        return mask
+
+    def apply(self, msg_head):
+        """
+        Applies the rules to the message head, adding any tags to its
+        structured data. Returns DROPPED if the message is dropped, the route
+        of the rule that routed it or None if it goes to the default
+        destination.
+        """
+        mask = self._match(msg_head)
+
+        # The lowest bit is the first rule in the file
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            rule = self._by_bit[bit]
+            rule.hits += 1
+
+            if rule.action == TAG:
+                add_tag(msg_head, rule.tag)
+            elif rule.action == DROP:
+                return DROPPED
+            else:
+                return rule.route
+
+        return None
+
+
+class RoutingSink(object):
+    """
+    RoutingSink applies a RuleSet to records on their way to a record sink,
+    such as a SenderPool. Dropped records are let go, routed records are
+    submitted to the sink for their route and the rest to the default sink.
+    It takes the place of the sink it wraps.
+    """
+
+    def __init__(self, rules, sink, routes=None):
+        """
+        :param rules: A RuleSet
+        :param sink: The default sink
+        :param routes: A dictionary of every route of the rules to its sink
+        """
+        routes = routes or dict()
+        missing = rules.routes.difference(routes)
+
+        if missing:
+            raise RuleError('No sink for routes {}'.format(
+                ', '.join(str(route) for route in missing)))
+
+        self.rules = rules
+        self.sink = sink
+        self.routes = routes
+
+    def submit(self, records):
+        """
+        Applies the rules to the records and submits each to its sink.
+        """
+        default = list()
+        routed = dict()
+        apply_rules = self.rules.apply
+
+        for record in records:
+            route = apply_rules(record)
+
+            if route is None:
+                default.append(record)
+            elif route is not DROPPED:
+                routed.setdefault(route, list()).append(record)
+
+        if default:
+            self.sink.submit(default)
+
+        for route, route_records in routed.iteritems():
+            self.routes[route].submit(route_records)
+
+
+def add_tag(msg_head, tag):
+    """
+    Adds a tag to the structured data of the message head.
+    """
+    element = msg_head.sd.setdefault(TAG_ELEMENT, dict())
+    tags = element.get(TAG_FIELD)
+    element[TAG_FIELD] = tag if not tags else '{},{}'.format(tags, tag)
+
+
+def _compile(rule_config):
+    sd = list()
+
+    for line in rule_config.sd:
+        path, separator, patterns = line.partition('=')
+        element, dot, field = path.strip().rpartition('.')
+
+        if not separator or not element or not field:
+            raise RuleError(
+                'Rule {} has bad sd condition {!r}, expected '
+                'element.field = patterns'.format(rule_config.name, line))
+
+        sd.append((element, field, split_patterns(patterns)))
+
+    return Rule(
+        rule_config.name,
+        rule_config.action,
+        fields=rule_config.fields,
+        sd=sd,
+        tag=rule_config.tag,
+        route=rule_config.route)
@@ -1,35 +1,189 @@
+import errno
+import os
+import socket
+import time
+
 from portal.log import get_logger
 
-from tornado.ioloop import IOLoop
+from tornado import process
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
 from tornado.tcpserver import TCPServer
 
-from portal.input.syslog import Parser, SyslogMessageHandler
+from portal.input.syslog import (
+    Parser, ParsingError, SyslogMessageHandler, get_intern_cache,
+    get_priority_filter)
+from portal.metrics import COUNT_BUCKETS, get_registry
+from portal.pipeline import BatchReader
 
 
 _LOG = get_logger(__name__)
 
+READ_CHUNK_SIZE = 65536
+
+# Metrics are labeled with at most this many source hosts per process. Any
+# others are counted together under the host label OTHER_HOSTS.
+DEFAULT_MAX_HOST_LABELS = 256
+OTHER_HOSTS = 'other'
+
+_max_host_labels = DEFAULT_MAX_HOST_LABELS
+_host_labels = set()
+
+
+def set_max_host_labels(count):
+    """
+    Sets how many distinct source hosts metrics may be labeled with. Hosts
+    already labeled keep their label.
+    """
+    global _max_host_labels
+    _max_host_labels = count
+
+
+def host_label(host):
+    """
+    Returns the host label to count metrics from the given source host under.
+    """
+    if host in _host_labels:
+        return host
+
+    if len(_host_labels) < _max_host_labels:
+        _host_labels.add(host)
+        return host
+
+    return OTHER_HOSTS
+
+
+def _intern_count(name):
+    cache = get_intern_cache()
+    return getattr(cache, name) if cache is not None else 0
+
+
+def _messages_dropped():
+    priority_filter = get_priority_filter()
+    return priority_filter.dropped if priority_filter is not None else 0
+
+
+class SourceMetrics(object):
+    """
+    SourceMetrics counts the bytes, messages and parse errors received from
+    one source host over one transport. Past the first few hundred hosts,
+    as set with set_max_host_labels, hosts share the OTHER_HOSTS label.
+    """
+
+    def __init__(self, transport, host):
+        registry = get_registry()
+        host = host_label(host)
+        self.transport = transport
+        self.bytes = registry.counter(
+            'portal_received_bytes_total', 'Bytes received from clients',
+            transport=transport, host=host)
+        self.messages = registry.counter(
+            'portal_received_messages_total',
+            'Syslog messages parsed from clients',
+            transport=transport, host=host)
+
+    def error(self, ex):
+        """
+        Counts a parse error by its USYSLOG_ERROR code.
+        """
+        code = getattr(ex, 'code_name', 'unknown')
+        get_registry().counter(
+            'portal_parse_errors_total', 'Syslog parse errors by code',
+            transport=self.transport, code=code).inc()
+
 
 class TornadoConnection(object):
+    """
+    TornadoConnection passes the data read from a client stream to a reader,
+    such as a Parser, one chunk at a time. The reader's messages attribute is
+    the count of messages it has parsed. Reading may be paused, in which case
+    no more data is taken from the stream so that TCP flow control pushes
+    back on the client until reading is resumed.
+
+    The bytes and messages read over the connection are kept in bytes_read
+    and messages_read and added to the metrics of the client host. When the
+    connection closes they are recorded in the
+    portal_connection_received_bytes and portal_connection_received_messages
+    histograms, which stand in for per connection metrics whose labels would
+    grow without bound.
+    """
 
-    def __init__(self, reader, stream, address):
+    def __init__(self, reader, stream, address, on_close=None):
         self.reader = reader
         self.stream = stream
         self.address = address
+        self.paused = False
+        self.on_close = on_close
+        self.bytes_read = 0
+        self.messages_read = 0
+        self.metrics = SourceMetrics('tcp', address[0])
+        self._reading = False
 
         # Set our callbacks
         self.stream.set_close_callback(self._on_close)
-        self.stream.read_until_close(
-            callback=self._on_stream,
-            streaming_callback=self._on_stream)
+        self._read_next()
+
+    def pause(self):
+        """
+        Stops reading from the stream once the current read completes.
+        """
+        self.paused = True
+
+    def resume(self):
+        """
+        Resumes reading from the stream.
+        """
+        self.paused = False
+
+        if not self._reading:
+            self._read_next()
+
+    def _read_next(self):
+        try:
+            self.stream.read_bytes(
+                READ_CHUNK_SIZE, callback=self._on_stream, partial=True)
+            self._reading = True
+        except StreamClosedError:
+            self._reading = False
 
     def _on_stream(self, data):
+        self._reading = False
+        self.bytes_read += len(data)
+        self.metrics.bytes.inc(len(data))
+
         try:
             self.reader.read(data)
+        except ParsingError as ex:
+            self.metrics.error(ex)
+            _LOG.exception(ex)
         except Exception as ex:
             _LOG.exception(ex)
 
+        messages = self.reader.messages
+
+        if messages != self.messages_read:
+            self.metrics.messages.inc(messages - self.messages_read)
+            self.messages_read = messages
+
+        if not self.paused:
+            self._read_next()
+
     def _on_close(self):
-        pass
+        _LOG.debug('Connection from {} closed after {} bytes, {} messages'
+                   .format(self.address, self.bytes_read, self.messages_read))
+
+        registry = get_registry()
+        registry.histogram(
+            'portal_connection_received_bytes',
+            'Bytes received over each closed client connection',
+            buckets=COUNT_BUCKETS, transport='tcp').observe(self.bytes_read)
+        registry.histogram(
+            'portal_connection_received_messages',
+            'Syslog messages parsed from each closed client connection',
+            buckets=COUNT_BUCKETS, transport='tcp').observe(self.messages_read)
+
+        if self.on_close is not None:
+            self.on_close(self)
 
 
 class TornadoTcpServer(TCPServer):
@@ -38,20 +192,484 @@ class TornadoTcpServer(TCPServer):
         super(TornadoTcpServer, self).__init__(ssl_options=ssl_options)
         self.address = address
 
-    def start(self):
+    def start(self, processes=1):
+        """
+        Binds the listening socket and starts accepting connections. When
+        processes is anything other than 1 the listener is bound once in the
+        parent and then shared by forked worker processes. A value of 0 forks
+        one worker per CPU. The parent process never returns from this call;
+        it supervises the workers and restarts any that die.
+
+        :param processes: The number of worker processes to accept on
+        """
         self.bind(self.address[1], self.address[0])
-        super(TornadoTcpServer, self).start()
+        super(TornadoTcpServer, self).start(processes)
         _LOG.info('TCP server ready!')
 
 
 class SyslogServer(TornadoTcpServer):
+    """
+    SyslogServer parses syslog messages from TCP clients. It may be added as
+    a listener to a ZeroMQCaster so that reading from every client pauses
+    while the caster is saturated. The number of connections paused so far
+    and the total seconds spent paused are kept in pauses and paused_time.
 
-    def __init__(self, address, msg_delegate, ssl_options=None):
+    Message delegates such as SyslogToZeroMQHandler build up the message
+    being parsed, so a delegate can only serve one connection at a time.
+    When delegate_factory is given it is called for a new delegate for every
+    connection; msg_delegate is only used when it is not.
+
+    When given a record_sink, such as a SenderPool, client data is parsed
+    into records in batches and the records are submitted to the sink
+    instead of being passed to the message delegate.
+
+    When given a buffer_pool every connection's parser borrows its parse
+    buffer from the pool only while it is reading a message. When given a
+    parser_pool, parsers are taken from it as connections are accepted and
+    given back to it as they close; the pool's own buffer_pool is used then.
+    """
+
+    def __init__(self, address, msg_delegate, ssl_options=None,
+                 zero_copy=False, record_sink=None, delegate_factory=None,
+                 buffer_pool=None, parser_pool=None):
         super(SyslogServer, self).__init__(address, ssl_options)
         self.msg_delegate = msg_delegate
+        self.delegate_factory = delegate_factory
+        self.zero_copy = zero_copy
+        self.record_sink = record_sink
+        self.buffer_pool = buffer_pool
+        self.parser_pool = parser_pool
+        self.connections = set()
+        self.paused = False
+        self.pauses = 0
+        self.paused_time = 0.0
+        self._pause_start = None
+
+        registry = get_registry()
+        registry.gauge(
+            'portal_connections', 'Open client connections',
+            fn=lambda: len(self.connections))
+        registry.gauge(
+            'portal_paused_connections', 'Client connections paused',
+            fn=lambda: self.paused_connections)
+        self._pause_counter = registry.counter(
+            'portal_connection_pauses_total',
+            'Times a client connection was paused by backpressure')
+        registry.counter(
+            'portal_intern_hits_total',
+            'Header values served from the intern cache',
+            fn=lambda: _intern_count('hits'))
+        registry.counter(
+            'portal_intern_misses_total',
+            'Header values not found in the intern cache',
+            fn=lambda: _intern_count('misses'))
+        registry.counter(
+            'portal_messages_dropped_total',
+            'Messages skipped by the priority filter',
+            fn=_messages_dropped)
+
+        if buffer_pool is not None:
+            registry.gauge(
+                'portal_parse_buffers_pooled',
+                'Parse buffers held for reuse by idle connections',
+                fn=lambda: buffer_pool.pooled)
+            registry.counter(
+                'portal_parse_buffers_created_total',
+                'Parse buffers allocated since the pool was exhausted',
+                fn=lambda: buffer_pool.created)
+
+        if parser_pool is not None:
+            registry.gauge(
+                'portal_parsers_pooled',
+                'Parsers held for reuse by new connections',
+                fn=lambda: parser_pool.pooled)
+            registry.counter(
+                'portal_parsers_created_total',
+                'Parsers built since the pool was exhausted',
+                fn=lambda: parser_pool.created)
+
+    @property
+    def paused_connections(self):
+        """
+        Returns the number of client connections currently paused.
+        """
+        return sum(1 for connection in self.connections if connection.paused)
+
+    def _new_parser(self, msg_delegate=None, zero_copy=False):
+        if self.parser_pool is not None:
+            return self.parser_pool.take(msg_delegate, zero_copy)
+
+        return Parser(
+            msg_delegate, zero_copy=zero_copy, buffer_pool=self.buffer_pool)
+
+    def _on_connection_close(self, connection):
+        self.connections.discard(connection)
+
+        if self.parser_pool is not None:
+            reader = connection.reader
+
+            if isinstance(reader, BatchReader):
+                reader = reader.parser
+
+            self.parser_pool.give(reader)
 
     def handle_stream(self, stream, address):
-        TornadoConnection(Parser(self.msg_delegate), stream, address)
+        if self.record_sink is not None:
+            reader = BatchReader(self._new_parser(), self.record_sink)
+        elif self.delegate_factory is not None:
+            reader = self._new_parser(self.delegate_factory(), self.zero_copy)
+        else:
+            reader = self._new_parser(self.msg_delegate, self.zero_copy)
+
+        connection = TornadoConnection(
+            reader, stream, address, self._on_connection_close)
+        self.connections.add(connection)
+
+        if self.paused:
+            connection.pause()
+            self.pauses += 1
+            self._pause_counter.inc()
+
+    def on_saturated(self):
+        """
+        Pauses reading from all client connections.
+        """
+        if self.paused:
+            return
+
+        self.paused = True
+        self._pause_start = time.time()
+
+        for connection in self.connections:
+            connection.pause()
+            self.pauses += 1
+            self._pause_counter.inc()
+
+    def on_drained(self):
+        """
+        Resumes reading from all client connections.
+        """
+        if not self.paused:
+            return
+
+        self.paused = False
+        self.paused_time += time.time() - self._pause_start
+        self._pause_start = None
+
+        for connection in list(self.connections):
+            connection.resume()
+
+
+class SyslogUdpServer(object):
+    """
+    SyslogUdpServer reads syslog messages sent over UDP. Every datagram is
+    parsed as one complete message and handed to the same message delegate
+    as the TCP server.
+
+    Whenever the socket is readable up to batch_size datagrams are read into
+    a ring of preallocated buffers, one recvfrom_into call each, before any of
+    them are parsed. Datagrams that fill a whole buffer of max_datagram_size
+    bytes may have been truncated and are counted as such.
+
+    Like SyslogServer it may be added as a listener to a ZeroMQCaster. While
+    the caster is saturated the socket is not read and datagrams queue in the
+    kernel receive buffer and are dropped once it is full.
+
+    The counters attribute holds running totals of datagrams received,
+    truncated and dropped as well as messages that failed to parse. Drops are
+    the datagrams the kernel discarded because the receive buffer was full,
+    as reported in /proc/net/udp. The rates attribute holds how much each
+    counter grew over the last second.
+    """
+
+    def __init__(self, address, msg_delegate, recv_buffer_size=None,
+                 batch_size=32, max_datagram_size=65535, zero_copy=False,
+                 record_sink=None):
+        """
+        :param address: (host, port) to listen on
+        :param msg_delegate: The SyslogMessageHandler to pass messages to
+        :param recv_buffer_size: Optional SO_RCVBUF size in bytes
+        :param batch_size: The most datagrams to read per readable event
+        :param max_datagram_size: The size of each receive buffer
+        :param zero_copy: Passed through to the parser
+        :param record_sink: Optional object to submit parsed records to in
+        place of the message delegate, such as a SenderPool
+        """
+        self.address = address
+        self.msg_delegate = msg_delegate
+        self.record_sink = record_sink
+        self.recv_buffer_size = recv_buffer_size
+        self.batch_size = batch_size
+        self.max_datagram_size = max_datagram_size
+        self.zero_copy = zero_copy
+        self.socket = None
+        self.paused = False
+
+        self.counters = dict.fromkeys(
+            ('received', 'truncated', 'dropped', 'errors'), 0)
+        self.rates = dict.fromkeys(self.counters, 0)
+        self._last_counters = dict(self.counters)
+
+        self._parser = None
+        self._buffers = [
+            bytearray(max_datagram_size) for _ in range(batch_size)]
+        self._views = [memoryview(buff) for buff in self._buffers]
+        self._lengths = [0] * batch_size
+        self._hosts = [None] * batch_size
+        self._sources = dict()
+
+        registry = get_registry()
+
+        for name in self.counters:
+            registry.counter(
+                'portal_udp_datagrams_total',
+                'UDP datagrams by what happened to them',
+                fn=lambda name=name: self.counters[name], counter=name)
+
+    def bind(self):
+        """
+        Creates and binds the UDP socket. This is done before forking so
+        that all worker processes read from the same socket.
+        """
+        family = socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self.recv_buffer_size:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+
+        self.socket.setblocking(0)
+        self.socket.bind((self.address[0], int(self.address[1])))
+
+    def start(self):
+        """
+        Starts reading datagrams on the I/O loop and updating the per second
+        counters. The socket is bound first if bind was not called.
+        """
+        if self.socket is None:
+            self.bind()
+
+        if self.record_sink is not None:
+            self._parser = Parser()
+        else:
+            self._parser = Parser(self.msg_delegate, zero_copy=self.zero_copy)
+
+        IOLoop.instance().add_handler(
+            self.socket.fileno(), self._on_readable, IOLoop.READ)
+        periodic(self.update_counters, 1000)
+        _LOG.info('UDP server ready!')
+
+    def stop(self):
+        if self.socket is not None:
+            if not self.paused:
+                IOLoop.instance().remove_handler(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+
+    def on_saturated(self):
+        """
+        Stops reading datagrams.
+        """
+        if not self.paused and self.socket is not None:
+            self.paused = True
+            IOLoop.instance().remove_handler(self.socket.fileno())
+
+    def on_drained(self):
+        """
+        Resumes reading datagrams.
+        """
+        if self.paused and self.socket is not None:
+            self.paused = False
+            IOLoop.instance().add_handler(
+                self.socket.fileno(), self._on_readable, IOLoop.READ)
+
+    def _on_readable(self, fd, events):
+        count = self.read_datagrams()
+        parser = self._parser
+
+        for index in range(count):
+            datagram = self._views[index][:self._lengths[index]]
+            metrics = self._source_metrics(self._hosts[index])
+            metrics.bytes.inc(self._lengths[index])
+            messages = parser.messages
+
+            try:
+                if self.record_sink is not None:
+                    self._submit_datagram(datagram)
+                else:
+                    parser.read_datagram(datagram)
+            except Exception as ex:
+                self.counters['errors'] += 1
+                metrics.error(ex)
+                _LOG.debug(ex)
+
+            metrics.messages.inc(parser.messages - messages)
+
+    def _source_metrics(self, host):
+        host = host_label(host)
+        metrics = self._sources.get(host)
+
+        if metrics is None:
+            metrics = SourceMetrics('udp', host)
+            self._sources[host] = metrics
+
+        return metrics
+
+    def _submit_datagram(self, datagram):
+        try:
+            records, pending = self._parser.parse_batch(datagram, final=True)
+        except ParsingError as ex:
+            if ex.records:
+                self.record_sink.submit(ex.records)
+            raise
+
+        if records:
+            self.record_sink.submit(records)
+
+    def read_datagrams(self):
+        """
+        Reads waiting datagrams into the receive buffers and returns how
+        many were read.
+        """
+        count = 0
+
+        while count < self.batch_size:
+            try:
+                length, address = self.socket.recvfrom_into(
+                    self._buffers[count])
+            except socket.error as ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if length == self.max_datagram_size:
+                self.counters['truncated'] += 1
+
+            self._lengths[count] = length
+            self._hosts[count] = address[0]
+            count += 1
+
+        self.counters['received'] += count
+        return count
+
+    def update_counters(self):
+        """
+        Refreshes the kernel drop count and works out the per second rates.
+        This is called once a second by the I/O loop after start.
+        """
+        dropped = socket_drops(self.socket)
+
+        if dropped is not None:
+            self.counters['dropped'] = dropped
+
+        for name, value in self.counters.iteritems():
+            self.rates[name] = value - self._last_counters[name]
+
+        self._last_counters = dict(self.counters)
+
+        if self.rates['dropped']:
+            _LOG.warning(
+                'Kernel dropped {} UDP datagrams in the last second; '
+                'consider a larger receive buffer'.format(
+                    self.rates['dropped']))
+
+
+def socket_drops(sock):
+    """
+    Returns the number of datagrams the kernel has dropped for the given UDP
+    socket or None if that count is not available on this platform.
+    """
+    if sock is None:
+        return None
+
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except OSError:
+        return None
+
+    for table in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(table) as lines:
+                next(lines)
+
+                for line in lines:
+                    columns = line.split()
+
+                    if len(columns) > 12 and columns[9] == inode:
+                        return int(columns[12])
+        except (IOError, StopIteration):
+            continue
+
+    return None
+
+
+def task_id():
+    """
+    Returns the zero based index of the current worker process or None if
+    Portal was not started with forked workers.
+    """
+    return process.task_id()
+
+
+def worker_address(address):
+    """
+    Returns the address that the current worker process should use for
+    resources that can not be shared between processes. Workers are assigned
+    the port of the given address offset by their task id so that worker 0
+    uses the configured port, worker 1 the port after it and so on. When not
+    running with forked workers the address is returned unchanged.
+
+    :param address: (host, port), for example ('127.0.0.1', 5000)
+    """
+    worker_id = task_id()
+    if worker_id is None:
+        return address
+    return (address[0], int(address[1]) + worker_id)
+
+
+def check_worker_addresses(addresses, processes):
+    """
+    Checks that no two of the given addresses share a port in any worker
+    process. Each worker binds worker_address of every address, so with N
+    processes an address takes N ports starting at its own, and addresses on
+    the same host must be spaced at least N ports apart. A ValueError naming
+    the first two addresses that overlap is raised otherwise.
+
+    :param addresses: A list of (host, port) tuples bound by every worker
+    :param processes: The number of worker processes, as given to start
+    """
+    workers = processes if processes > 0 else process.cpu_count()
+    ranges = sorted(
+        (int(port), int(port) + workers - 1, host)
+        for host, port in addresses)
+
+    for index, (first, last, host) in enumerate(ranges):
+        for other_first, other_last, other_host in ranges[index + 1:]:
+            if other_first > last:
+                break
+
+            if (host == other_host or '*' in (host, other_host) or
+                    '0.0.0.0' in (host, other_host)):
+                raise ValueError(
+                    'Workers bind {}:{}-{} and {}:{}-{}, which overlap with '
+                    '{} processes. Space zmq_bind_host, shard_bind_hosts and '
+                    'rule routes at least {} ports apart.'.format(
+                        host, first, last, other_host, other_first,
+                        other_last, workers, workers))
+
+
+def periodic(callback, interval_ms):
+    """
+    Schedules a callback to run on the I/O loop every interval_ms
+    milliseconds. The started PeriodicCallback is returned so that it may be
+    stopped later.
+    """
+    periodic_callback = PeriodicCallback(callback, interval_ms)
+    periodic_callback.start()
+    return periodic_callback
 
 
 def start_io():
@@ -0,0 +1,346 @@
+"""
+The sharding module spreads messages over several downstream endpoints so
+that every message with the same key lands on the same endpoint. The key is
+read from each parsed message head, for example the tenant of the meniscus
+structured data element or the hostname, and placed on a consistent hash
+ring of the endpoints:
+
+    [transport]
+    shard_bind_hosts = 127.0.0.1:6000, 127.0.0.1:6100, 127.0.0.1:6200
+    shard_key = meniscus.tenant, hostname
+
+Each endpoint owns many points on the ring, so adding an endpoint only moves
+the keys of the points it takes over, about one in every N keys for N
+endpoints, and leaves the rest where they were.
+"""
+
+import bisect
+import hashlib
+import operator
+import struct
+
+from portal.metrics import get_registry
+
+
+HEAD_FIELDS = ('hostname', 'appname', 'processid', 'messageid')
+
+DEFAULT_REPLICAS = 100
+
+# Keys whose node is remembered before the cache is started over
+KEY_CACHE_SIZE = 65536
+
+_EMPTY = dict()
+
+
+def _hash(value):
+    return struct.unpack_from('>I', hashlib.md5(value).digest())[0]
+
+
+class HashRing(object):
+    """
+    HashRing is a consistent hash of keys onto nodes. Nodes are identified
+    by name and each is placed on the ring at replicas points. A key belongs
+    to the node owning the first point at or after the key's hash. Nodes must
+    be named the same way everywhere the ring is built, such as by their
+    configured address, for every process to agree on where keys go.
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        """
+        :param nodes: An iterable of (name, node) tuples
+        :param replicas: The number of points each node has on the ring
+        """
+        if replicas < 1:
+            raise ValueError('A hash ring needs at least one replica')
+
+        self.replicas = replicas
+        self.nodes = dict()
+        self._points = list()
+        self._owners = list()
+        self._cache = dict()
+
+        for name, node in nodes:
+            self.nodes[name] = node
+
+        self._build()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, name, node):
+        """
+        Adds a node under the given name, taking over part of the keys of
+        the nodes already on the ring.
+        """
+        self.nodes[name] = node
+        self._build()
+
+    def remove(self, name):
+        """
+        Removes the node with the given name. Its keys move to the nodes
+        owning the points after its own.
+        """
+        del self.nodes[name]
+        self._build()
+
+    def _build(self):
+        ring = sorted(
+            (_hash('{}-{}'.format(name, replica)), name)
+            for name in self.nodes
+            for replica in xrange(self.replicas))
+
+        self._points = [point for point, name in ring]
+        self._owners = [self.nodes[name] for point, name in ring]
+        self._cache = dict()
+
+    def node_for(self, key):
+        """
+        Returns the node that the key belongs to, or None if the ring has no
+        nodes.
+        """
+        node = self._cache.get(key)
+
+        if node is not None or not self._owners:
+            return node
+
+        index = bisect.bisect_left(self._points, _hash(key))
+        node = self._owners[index % len(self._owners)]
+
+        if len(self._cache) >= KEY_CACHE_SIZE:
+            self._cache = dict()
+
+        self._cache[key] = node
+        return node
+
+
+def key_getter(keys):
+    """
+    Returns a function that reads the shard key of a message head. Each key
+    is either a head field, such as hostname, or a structured data field
+    given as element.field, such as meniscus.tenant. The first of the keys
+    that the message has is used; messages with none of them get an empty
+    key.
+
+    :param keys: A list of key names tried in order
+    """
+    getters = list()
+
+    for key in keys:
+        if key in HEAD_FIELDS:
+            getters.append(operator.attrgetter(key))
+            continue
+
+        element, dot, field = key.rpartition('.')
+
+        if not element or not field:
+            raise ValueError(
+                'Unknown shard key {!r}, expected one of {} or '
+                'element.field'.format(key, ', '.join(HEAD_FIELDS)))
+
+        getters.append(
+            lambda msg_head, element=element, field=field:
+                msg_head.sd.get(element, _EMPTY).get(field))
+
+    if not getters:
+        raise ValueError('At least one shard key is needed')
+
+    def get_key(msg_head):
+        for getter in getters:
+            value = getter(msg_head)
+
+            if value:
+                return value
+
+        return ''
+
+    return get_key
+
+
+class _Shards(object):
+    """
+    The members of a sharded destination on a hash ring, and the listeners
+    to be told when the destination saturates and drains. The destination is
+    saturated as soon as any one member is and drained once all of them are.
+    """
+
+    def __init__(self, members, keys, replicas):
+        self.ring = HashRing(replicas=replicas)
+        self.key = key_getter(keys)
+        self.counts = dict()
+        self.saturated = False
+        self._saturated = set()
+        self._listeners = list()
+
+        for name, member in members:
+            self.add(name, member)
+
+        if not self.ring:
+            raise ValueError('Sharding needs at least one destination')
+
+    def add(self, name, member):
+        """
+        Adds a destination under the given name. Messages for about one in
+        every len(ring) keys move to it.
+        """
+        self.ring.add(name, member)
+        self.counts[member] = 0
+        member.add_listener(_ShardListener(self, member))
+
+        get_registry().counter(
+            'portal_shard_messages_total', 'Messages sent to each shard',
+            fn=lambda: self.counts[member], shard=str(name))
+
+    def add_listener(self, listener):
+        """
+        Adds a listener to be told when any of the destinations saturates
+        and when all of them have drained. The listener must have
+        on_saturated and on_drained methods.
+        """
+        self._listeners.append(listener)
+
+    def _on_saturated(self, member):
+        self._saturated.add(member)
+
+        if not self.saturated:
+            self.saturated = True
+
+            for listener in self._listeners:
+                listener.on_saturated()
+
+    def _on_drained(self, member):
+        self._saturated.discard(member)
+
+        if self.saturated and not self._saturated:
+            self.saturated = False
+
+            for listener in self._listeners:
+                listener.on_drained()
+
+
+class _ShardListener(object):
+
+    def __init__(self, shards, member):
+        self.shards = shards
+        self.member = member
+
+    def on_saturated(self):
+        self.shards._on_saturated(self.member)
+
+    def on_drained(self):
+        self.shards._on_drained(self.member)
+
+
+class ShardedCaster(_Shards):
+    """
+    ShardedCaster sends each message with one of several casters, chosen by
+    a consistent hash of the message's shard key. It stands in for a single
+    ZeroMQCaster: SyslogToZeroMQHandler asks it for the caster of each
+    message with caster_for, while binding, flushing and closing apply to
+    every caster. The messages sent to each shard are counted in
+    portal_shard_messages_total.
+    """
+
+    def __init__(self, casters, keys, replicas=DEFAULT_REPLICAS):
+        """
+        :param casters: A list of (name, caster) tuples, named the same way
+            in every process, such as by configured address
+        :param keys: A list of shard key names, see key_getter
+        :param replicas: The number of points each caster has on the ring
+        """
+        super(ShardedCaster, self).__init__(casters, keys, replicas)
+
+    @property
+    def casters(self):
+        """
+        Returns the casters of every shard.
+        """
+        return self.ring.nodes.values()
+
+    @property
+    def batching(self):
+        """
+        Returns True if any of the casters sends messages in batches.
+        """
+        return any(caster.batching for caster in self.casters)
+
+    @property
+    def backlog(self):
+        """
+        Returns the number of sends waiting across all of the casters.
+        """
+        return sum(caster.backlog for caster in self.casters)
+
+    def caster_for(self, msg_head):
+        """
+        Returns the caster that sends the message with the given head.
+        """
+        caster = self.ring.node_for(self.key(msg_head))
+        self.counts[caster] += 1
+        return caster
+
+    def bind(self):
+        """
+        Binds every caster.
+        """
+        for caster in self.casters:
+            caster.bind()
+
+    def flush(self):
+        """
+        Sends the current batch of every caster.
+        """
+        for caster in self.casters:
+            caster.flush()
+
+    def flush_expired(self):
+        """
+        Sends the batches of the casters whose batch latency has passed.
+        """
+        for caster in self.casters:
+            caster.flush_expired()
+
+    def close(self):
+        """
+        Closes every caster.
+        """
+        for caster in self.casters:
+            caster.close()
+
+
+class ShardingSink(_Shards):
+    """
+    ShardingSink splits records on their way to several record sinks, such
+    as SenderPools, by a consistent hash of each record's shard key. It takes
+    the place of a single sink. The records sent to each shard are counted in
+    portal_shard_messages_total.
+    """
+
+    def __init__(self, sinks, keys, replicas=DEFAULT_REPLICAS):
+        """
+        :param sinks: A list of (name, sink) tuples, named the same way in
+            every process, such as by configured address
+        :param keys: A list of shard key names, see key_getter
+        :param replicas: The number of points each sink has on the ring
+        """
+        super(ShardingSink, self).__init__(sinks, keys, replicas)
+
+    def submit(self, records):
+        """
+        Submits each record to the sink for its shard key.
+        """
+        shards = dict()
+        node_for = self.ring.node_for
+        key = self.key
+
+        for record in records:
+            sink = node_for(key(record))
+            shard = shards.get(sink)
+
+            if shard is None:
+                shards[sink] = [record]
+            else:
+                shard.append(record)
+
+        for sink, shard in shards.iteritems():
+            self.counts[sink] += len(shard)
+            sink.submit(shard)
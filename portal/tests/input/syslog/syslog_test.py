@@ -1,8 +1,14 @@
+# -*- coding: utf-8 -*-
 import unittest
 import time
 
+import simplejson
+
 from portal.input.syslog import (
-    SyslogMessageHandler, Parser, ParsingError
+    BufferPool, InternCache, SyslogMessageHandler, SyslogMessageHead, Parser,
+    ParserPool, ParsingError, JsonEncoder, PriorityFilter, SdFilter,
+    get_intern_cache, get_priority_filter, get_sd_filter, set_intern_cache,
+    set_priority_filter, set_sd_filter
 )
 
 BAD_OCTET_COUNT = (
@@ -113,6 +119,29 @@ class MessageValidator(SyslogMessageHandler):
         raise NotImplementedError
 
 
+class SpanCollector(MessageValidator):
+
+    def __init__(self, test):
+        super(SpanCollector, self).__init__(test)
+        self.parts = list()
+
+    def on_msg_part(self, msg_part):
+        self.parts.append(msg_part)
+        super(SpanCollector, self).on_msg_part(msg_part)
+
+
+class BodyCollector(MessageValidator):
+
+    def __init__(self, test):
+        super(BodyCollector, self).__init__(test)
+        self.bodies = list()
+
+    def on_msg_complete(self, msg_length):
+        super(BodyCollector, self).on_msg_complete(msg_length)
+        self.bodies.append(bytes(self.msg))
+        self.msg = bytearray()
+
+
 class BackToBackValidator(MessageValidator):
 
     def _validate(self, test, caught_exception, msg_head, msg):
@@ -319,6 +348,71 @@ class WhenParsingSyslog(unittest.TestCase):
         self.assertTrue(validator.called)
         validator.validate()
 
+    def test_read_memoryview(self):
+        validator = RsyslogMessageValidator(self)
+        parser = Parser(validator)
+
+        parser.read(memoryview(ACTUAL_MESSAGE))
+        validator.validate()
+
+    def test_read_bytearray(self):
+        validator = RsyslogMessageValidator(self)
+        parser = Parser(validator)
+
+        parser.read(bytearray(ACTUAL_MESSAGE))
+        validator.validate()
+
+    def test_zero_copy_delivers_single_span(self):
+        validator = SpanCollector(self)
+        parser = Parser(validator, zero_copy=True)
+
+        parser.read(ACTUAL_MESSAGE)
+        self.assertTrue(validator.complete)
+        self.assertEqual(1, len(validator.parts))
+        self.assertIsInstance(validator.parts[0], memoryview)
+        self.assertEqual(
+            ACTUAL_MESSAGE[ACTUAL_MESSAGE.index(b'[origin'):],
+            validator.msg)
+
+    def test_zero_copy_across_chunks(self):
+        validator = SpanCollector(self)
+        parser = Parser(validator, zero_copy=True)
+
+        chunk_message(HAPPY_PATH_MESSAGE, parser)
+        self.assertTrue(validator.complete)
+        self.assertEqual(b'start', validator.msg)
+        for part in validator.parts:
+            self.assertIsInstance(part, memoryview)
+
+    def test_message_head_reused(self):
+        validator = MessageValidator(self)
+        parser = Parser(validator)
+
+        parser.read(ACTUAL_MESSAGE)
+        first_head = validator.msg_head
+        parser.read(HAPPY_PATH_MESSAGE)
+        self.assertIs(first_head, validator.msg_head)
+        self.assertEqual('46', validator.msg_head.priority)
+
+    def test_message_head_outlives_parser(self):
+        validator = RsyslogMessageValidator(self)
+        parser = Parser(validator)
+
+        parser.read(ACTUAL_MESSAGE)
+        del parser
+        validator.validate()
+
+    def test_message_head_as_dict(self):
+        validator = HappyPathValidator(self)
+        parser = Parser(validator)
+
+        parser.read(HAPPY_PATH_MESSAGE)
+        head_dict = validator.msg_head.as_dict()
+        self.assertEqual('46', head_dict['priority'])
+        self.assertEqual('tohru', head_dict['hostname'])
+        self.assertEqual(
+            u'7.2.2', head_dict['sd']['origin_1']['swVersion'])
+
     def test_read_messages_back_to_back(self):
         validator = BackToBackValidator(self)
         parser = Parser(validator)
@@ -335,6 +429,857 @@ class WhenParsingSyslog(unittest.TestCase):
         self.assertEqual(4, validator.times_called)
 
 
+class WhenBatchParsingSyslog(unittest.TestCase):
+
+    def test_parse_batch_of_messages(self):
+        parser = Parser()
+        data = ACTUAL_MESSAGE + bytes(HAPPY_PATH_MESSAGE) + ACTUAL_MESSAGE
+
+        records, pending = parser.parse_batch(data)
+        self.assertEqual(3, len(records))
+        self.assertEqual(0, pending)
+        self.assertEqual(['47', '46', '47'], [r.priority for r in records])
+        self.assertEqual(b'start', records[1].message)
+        self.assertEqual(263, records[1].msg_length)
+        self.assertEqual(2, len(records[1].sd))
+        self.assertEqual(0, len(records[0].sd))
+
+    def test_parse_batch_with_partial_tail(self):
+        parser = Parser()
+        data = ACTUAL_MESSAGE + ACTUAL_MESSAGE[:40]
+
+        records, pending = parser.parse_batch(data)
+        self.assertEqual(1, len(records))
+        self.assertEqual(40, pending)
+
+        records, pending = parser.parse_batch(ACTUAL_MESSAGE[40:])
+        self.assertEqual(1, len(records))
+        self.assertEqual(0, pending)
+        self.assertEqual('tohru', records[0].hostname)
+        self.assertEqual(162, records[0].msg_length)
+
+    def test_reset_without_handler(self):
+        parser = Parser()
+        parser.parse_batch(ACTUAL_MESSAGE[:40])
+
+        parser.reset()
+        records, pending = parser.parse_batch(ACTUAL_MESSAGE)
+        self.assertEqual(1, len(records))
+        self.assertEqual(0, pending)
+        self.assertEqual('tohru', records[0].hostname)
+
+    def test_parse_batch_across_many_chunks(self):
+        parser = Parser()
+        records = list()
+        data = bytes(HAPPY_PATH_MESSAGE)
+
+        for index in range(0, len(data), 7):
+            records.extend(parser.parse_batch(data[index:index + 7])[0])
+
+        self.assertEqual(1, len(records))
+        self.assertEqual('2012-12-11T15:48:23.217459-06:00',
+                         records[0].timestamp)
+        self.assertEqual(b'start', records[0].message)
+
+    def test_record_as_dict(self):
+        parser = Parser()
+
+        records, pending = parser.parse_batch(NO_STRUCTURED_DATA)
+        record_dict = records[0].as_dict()
+        self.assertEqual(u'start', record_dict['message'])
+        self.assertEqual(33, record_dict['msg_length'])
+        self.assertEqual('6611', record_dict['processid'])
+        self.assertEqual({}, record_dict['sd'])
+
+    def test_long_header_fields(self):
+        parser = Parser()
+        appname = b'a' * 3000
+
+        records, pending = parser.parse_batch(
+            b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru ' + appname +
+            b' 6611 ID47 - start\n' + ACTUAL_MESSAGE)
+
+        self.assertEqual('2012-12-11T15:48:23.217459-06:00',
+                         records[0].timestamp)
+        self.assertEqual('tohru', records[0].hostname)
+        self.assertEqual(appname, records[0].appname)
+        self.assertEqual('6611', records[0].processid)
+        self.assertEqual('ID47', records[0].messageid)
+        self.assertEqual('tohru', records[1].hostname)
+        self.assertEqual('rsyslogd', records[1].appname)
+
+    def test_parse_batch_error_keeps_records(self):
+        parser = Parser()
+
+        with self.assertRaises(ParsingError) as cm:
+            parser.parse_batch(ACTUAL_MESSAGE + BAD_OCTET_COUNT)
+        self.assertEqual(1, len(cm.exception.records))
+
+    def test_escaped_sd_values(self):
+        parser = Parser()
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - h a - - [x@1 a="q\\"z" b="c\\]d\\\\" c="e\\f"] body\n')
+        self.assertEqual(
+            {u'a': u'q"z', u'b': u'c]d\\', u'c': u'e\\f'},
+            records[0].as_dict()['sd']['x@1'])
+
+    def test_escaped_sd_values_split_across_reads(self):
+        parser = Parser()
+        data = b'<46>1 - h a - - [x@1 a="q\\"z"] body\n'
+        escape = data.index(b'\\')
+
+        records = parser.parse_batch(data[:escape + 1])[0]
+        records += parser.parse_batch(data[escape + 1:])[0]
+        self.assertEqual(u'q"z', records[0].as_dict()['sd']['x@1']['a'])
+
+    def test_messages_counted(self):
+        parser = Parser()
+
+        parser.parse_batch(ACTUAL_MESSAGE + ACTUAL_MESSAGE[:10])
+        self.assertEqual(1, parser.messages)
+
+    def test_error_code(self):
+        parser = Parser()
+
+        with self.assertRaises(ParsingError) as cm:
+            parser.parse_batch(b'<46>1 - tohru', final=True)
+        self.assertEqual('premature_msg_end', cm.exception.code_name)
+
+    def test_parse_batch_final(self):
+        parser = Parser()
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - tohru - 6611 - - start', final=True)
+        self.assertEqual(0, pending)
+        self.assertEqual(b'start', records[0].message)
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - tohru - 6611 - - again', final=True)
+        self.assertEqual(b'again', records[0].message)
+
+    def test_parse_batch_final_premature_end(self):
+        parser = Parser()
+
+        with self.assertRaises(ParsingError):
+            parser.parse_batch(b'<46>1 - tohru', final=True)
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - tohru - 6611 - - start', final=True)
+        self.assertEqual(1, len(records))
+
+
+class WhenParsingDatagrams(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = SpanCollector(self)
+        self.parser = Parser(self.collector)
+
+    def test_datagram_without_newline(self):
+        self.parser.read_datagram(b'<46>1 - tohru - 6611 - - start')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'start', self.collector.msg)
+        self.assertEqual('tohru', self.collector.msg_head.hostname)
+
+    def test_datagram_with_newline(self):
+        self.parser.read_datagram(b'<46>1 - tohru - 6611 - - start\n')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'start\n', self.collector.msg)
+
+    def test_datagram_with_octet_count(self):
+        self.parser.read_datagram(bytes(NO_STRUCTURED_DATA))
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'start', self.collector.msg)
+
+    def test_datagram_without_body(self):
+        self.parser.read_datagram(b'<46>1 - tohru - 6611 - [a b="c"]')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'', self.collector.msg)
+        self.assertEqual('c', self.collector.msg_head.sd['a']['b'])
+
+    def test_truncated_datagram(self):
+        with self.assertRaises(ParsingError):
+            self.parser.read_datagram(b'<46>1 - tohru')
+        self.assertFalse(self.collector.complete)
+
+        self.parser.read_datagram(b'<46>1 - tohru - 6611 - - start')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual('tohru', self.collector.msg_head.hostname)
+
+    def test_short_octet_count(self):
+        with self.assertRaises(ParsingError):
+            self.parser.read_datagram(bytes(SHORT_OCTET_COUNT))
+
+    def test_datagrams_back_to_back(self):
+        for index in range(3):
+            self.parser.read_datagram(
+                '<46>1 - host{} - - - - body'.format(index))
+            self.assertEqual(
+                'host{}'.format(index), self.collector.msg_head.hostname)
+
+
+class WhenPoolingBuffers(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BufferPool(capacity=2, initial_size=16, max_size=4096)
+
+    def test_buffer_released_between_messages(self):
+        parser = Parser(buffer_pool=self.pool)
+        self.assertFalse(parser.holds_buffer)
+        self.assertEqual(1, self.pool.pooled)
+
+        parser.parse_batch(ACTUAL_MESSAGE[:40])
+        self.assertTrue(parser.holds_buffer)
+        self.assertEqual(0, self.pool.pooled)
+
+        records, pending = parser.parse_batch(ACTUAL_MESSAGE[40:])
+        self.assertEqual('tohru', records[0].hostname)
+        self.assertFalse(parser.holds_buffer)
+        self.assertEqual(1, self.pool.pooled)
+
+    def test_buffer_shared_by_parsers(self):
+        parsers = [Parser(buffer_pool=self.pool) for _ in range(10)]
+        self.assertEqual(2, self.pool.pooled)
+
+        for parser in parsers:
+            self.assertEqual(1, len(parser.parse_batch(ACTUAL_MESSAGE)[0]))
+
+        self.assertEqual(0, self.pool.created)
+        self.assertEqual(10, self.pool.reused)
+
+    def test_buffer_grows_past_initial_size(self):
+        parser = Parser(buffer_pool=self.pool)
+        hostname = 'h' * 1000
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - ' + hostname + b' - 6611 - - start\n')
+        self.assertEqual(hostname, records[0].hostname)
+
+    def test_token_truncated_at_max_size(self):
+        parser = Parser(buffer_pool=self.pool)
+
+        records, pending = parser.parse_batch(
+            b'<46>1 - ' + b'h' * 5000 + b' - 6611 - - start\n')
+        self.assertEqual(4095, len(records[0].hostname))
+
+    def test_buffer_returned_on_dealloc(self):
+        parser = Parser(buffer_pool=self.pool)
+        parser.parse_batch(ACTUAL_MESSAGE[:40])
+        del parser
+
+        self.assertEqual(1, self.pool.pooled)
+
+    def test_pool_capacity(self):
+        parsers = [Parser(buffer_pool=self.pool) for _ in range(3)]
+
+        for parser in parsers:
+            parser.parse_batch(ACTUAL_MESSAGE[:40])
+
+        del parsers
+        self.assertEqual(2, self.pool.pooled)
+
+    def test_read(self):
+        collector = SpanCollector(self)
+        parser = Parser(collector, buffer_pool=self.pool)
+
+        parser.read(ACTUAL_MESSAGE[:40])
+        self.assertTrue(parser.holds_buffer)
+
+        parser.read(ACTUAL_MESSAGE[40:])
+        self.assertTrue(collector.complete)
+        self.assertFalse(parser.holds_buffer)
+
+    def test_read_datagram(self):
+        collector = SpanCollector(self)
+        parser = Parser(collector, buffer_pool=self.pool)
+
+        parser.read_datagram(b'<46>1 - tohru - 6611 - - start')
+        self.assertEqual(b'start', collector.msg)
+        self.assertFalse(parser.holds_buffer)
+
+    def test_bad_sizes(self):
+        with self.assertRaises(ValueError):
+            BufferPool(initial_size=1024, max_size=512)
+
+
+class WhenPoolingParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ParserPool(capacity=2)
+
+    def test_parser_reused(self):
+        parser = self.pool.take()
+        self.pool.give(parser)
+
+        self.assertIs(parser, self.pool.take())
+        self.assertEqual(1, self.pool.created)
+        self.assertEqual(1, self.pool.reused)
+
+    def test_reused_parser_takes_new_handler(self):
+        first = SpanCollector(self)
+        parser = self.pool.take(first)
+        parser.read(ACTUAL_MESSAGE)
+        self.pool.give(parser)
+
+        second = SpanCollector(self)
+        parser = self.pool.take(second, zero_copy=True)
+        parser.read(b'<46>1 - tohru - 6611 - - start\n')
+
+        self.assertEqual(b'start\n', second.msg)
+        self.assertEqual(1, parser.messages)
+        self.assertNotEqual(b'start\n', first.msg)
+
+    def test_partial_message_dropped(self):
+        parser = self.pool.take()
+        parser.parse_batch(ACTUAL_MESSAGE[:40])
+        self.pool.give(parser)
+
+        records, pending = self.pool.take().parse_batch(ACTUAL_MESSAGE)
+        self.assertEqual(1, len(records))
+        self.assertEqual(0, pending)
+
+    def test_held_message_head_kept(self):
+        collector = SpanCollector(self)
+        parser = self.pool.take(collector)
+        parser.read(ACTUAL_MESSAGE)
+        self.pool.give(parser)
+
+        self.pool.take().parse_batch(b'<46>1 - other - 6611 - - start\n')
+        self.assertEqual('tohru', collector.msg_head.hostname)
+
+    def test_held_message_head_kept_by_next_handler(self):
+        first = SpanCollector(self)
+        parser = self.pool.take(first)
+        parser.read(ACTUAL_MESSAGE)
+        self.pool.give(parser)
+
+        second = SpanCollector(self)
+        self.pool.take(second).read(b'<46>1 - other - 6611 - - start\n')
+        self.assertIsNot(first.msg_head, second.msg_head)
+        self.assertEqual('tohru', first.msg_head.hostname)
+        self.assertEqual('other', second.msg_head.hostname)
+
+    def test_capacity(self):
+        parsers = [self.pool.take() for _ in range(3)]
+
+        for parser in parsers:
+            self.pool.give(parser)
+
+        self.assertEqual(2, self.pool.pooled)
+
+    def test_given_twice(self):
+        parser = self.pool.take()
+        self.pool.give(parser)
+        self.pool.give(parser)
+
+        self.assertEqual(1, self.pool.pooled)
+
+    def test_buffer_pool_used(self):
+        buffer_pool = BufferPool(capacity=2)
+        pool = ParserPool(buffer_pool=buffer_pool)
+
+        self.assertFalse(pool.take().holds_buffer)
+        self.assertEqual(1, buffer_pool.pooled)
+
+
+class WhenInterningHeaderValues(unittest.TestCase):
+
+    def setUp(self):
+        self.default_cache = get_intern_cache()
+        self.cache = InternCache(size=16, max_length=8)
+        set_intern_cache(self.cache)
+
+    def tearDown(self):
+        set_intern_cache(self.default_cache)
+
+    def test_same_object_returned(self):
+        first = self.cache.get(bytes(bytearray(b'tohru')))
+        second = self.cache.get(bytes(bytearray(b'tohru')))
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_long_values_not_cached(self):
+        value = bytes(bytearray(b'a' * 9))
+
+        self.assertIsNot(value, self.cache.get(value))
+        self.assertEqual(0, self.cache.hits + self.cache.misses)
+
+    def test_size_must_be_power_of_two(self):
+        with self.assertRaises(ValueError):
+            InternCache(size=12)
+
+    def test_records_share_values(self):
+        records, pending = Parser().parse_batch(
+            bytes(HAPPY_PATH_MESSAGE) + bytes(HAPPY_PATH_MESSAGE))
+
+        self.assertIs(records[0].hostname, records[1].hostname)
+        self.assertIs(records[0].appname, records[1].appname)
+        self.assertEqual(records[0].sd.keys(), records[1].sd.keys())
+        self.assertIs(list(records[0].sd)[0], list(records[1].sd)[0])
+        self.assertTrue(self.cache.hits > 0)
+
+    def test_interning_off(self):
+        set_intern_cache(None)
+        records, pending = Parser().parse_batch(ACTUAL_MESSAGE * 2)
+
+        self.assertEqual(records[0].hostname, records[1].hostname)
+        self.assertEqual(0, self.cache.hits + self.cache.misses)
+
+
+class WhenParsingRfc3164(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = SpanCollector(self)
+        self.parser = Parser(self.collector)
+
+    def _parse(self, data, chunk_size=7):
+        self.collector.msg = bytearray()
+        chunk_message(data, self.parser, chunk_size)
+        self.assertTrue(self.collector.complete)
+        return self.collector.msg_head
+
+    def test_rfc3164_message(self):
+        msg_head = self._parse(
+            b"<34>Oct 11 22:14:15 mymachine su: 'su root' failed\n")
+        self.assertEqual('34', msg_head.priority)
+        self.assertEqual('0', msg_head.version)
+        self.assertEqual('Oct 11 22:14:15', msg_head.timestamp)
+        self.assertEqual('mymachine', msg_head.hostname)
+        self.assertEqual('su', msg_head.appname)
+        self.assertEqual('', msg_head.processid)
+        self.assertEqual({}, msg_head.sd)
+        self.assertEqual(b"'su root' failed\n", self.collector.msg)
+
+    def test_tag_with_pid(self):
+        msg_head = self._parse(
+            b'<13>Feb  5 17:32:18 10.0.0.99 sshd[1234]: Accepted key\n')
+        self.assertEqual('Feb  5 17:32:18', msg_head.timestamp)
+        self.assertEqual('10.0.0.99', msg_head.hostname)
+        self.assertEqual('sshd', msg_head.appname)
+        self.assertEqual('1234', msg_head.processid)
+        self.assertEqual(b'Accepted key\n', self.collector.msg)
+
+    def test_without_timestamp(self):
+        msg_head = self._parse(b'<13>Decatur app: hello\n')
+        self.assertEqual('', msg_head.timestamp)
+        self.assertEqual('Decatur', msg_head.hostname)
+        self.assertEqual('app', msg_head.appname)
+        self.assertEqual(b'hello\n', self.collector.msg)
+
+    def test_without_hostname(self):
+        msg_head = self._parse(b'<13>Oct 11 22:14:15 sshd[99]: hello\n')
+        self.assertEqual('', msg_head.hostname)
+        self.assertEqual('sshd', msg_head.appname)
+        self.assertEqual('99', msg_head.processid)
+
+        msg_head = self._parse(b'<13>Oct 11 22:14:15 cron: hello\n')
+        self.assertEqual('', msg_head.hostname)
+        self.assertEqual('cron', msg_head.appname)
+        self.assertEqual(b'hello\n', self.collector.msg)
+
+    def test_without_tag(self):
+        msg_head = self._parse(b'<13>Oct 11 22:14:15 host Use the BFG!\n')
+        self.assertEqual('host', msg_head.hostname)
+        self.assertEqual('', msg_head.appname)
+        self.assertEqual(b'Use the BFG!\n', self.collector.msg)
+
+    def test_mixed_with_rfc5424(self):
+        stream = (
+            b'<13>Oct 11 22:14:15 host app: one\n' +
+            bytes(HAPPY_PATH_MESSAGE) +
+            b'38 <13>Oct 11 22:14:15 host app: two')
+        validator = BackToBackValidator(self)
+        parser = Parser(validator)
+
+        chunk_message(stream, parser, 5)
+        self.assertEqual(3, validator.times_called)
+        self.assertEqual('app', validator.msg_head.appname)
+        self.assertEqual(b'one\nstarttwo', validator.msg)
+
+    def test_datagram_ending_after_pid(self):
+        self.parser.read_datagram(b'<13>Oct 11 22:14:15 host app[1]')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual('1', self.collector.msg_head.processid)
+        self.assertEqual(b'', self.collector.msg)
+
+    def test_datagram_of_one_word(self):
+        self.parser.read_datagram(b'<13>Oct 11 22:14:15 host word')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'word', self.collector.msg)
+
+    def test_ip_address_hostname(self):
+        stream = (
+            b'<13>192.168.1.1 foo: hello\n'
+            b'<13>10.0.0.1 bar[3]: world\n'
+            b'<46>1 - host app - - - five\n'
+            b'<13>Oct 11 22:14:15 2001:db8::1 baz: again\n')
+
+        for chunk_size in (1, 3, 5, len(stream)):
+            parser = Parser()
+            records = list()
+
+            for index in range(0, len(stream), chunk_size):
+                records.extend(
+                    parser.parse_batch(stream[index:index + chunk_size])[0])
+
+            self.assertEqual(
+                [('0', '192.168.1.1', 'foo', b'hello\n'),
+                 ('0', '10.0.0.1', 'bar', b'world\n'),
+                 ('1', 'host', 'app', b'five\n'),
+                 ('0', '2001:db8::1', 'baz', b'again\n')],
+                [(r.version, r.hostname, r.appname, r.message)
+                 for r in records], chunk_size)
+
+    def test_bad_timestamp(self):
+        with self.assertRaises(ParsingError):
+            self.parser.read(b'<13>Oct 11 22-14-15 host app: hello\n')
+
+    def test_zero_copy_without_tag(self):
+        parser = Parser(self.collector, zero_copy=True)
+
+        for data, body in (
+                (b'<13>Feb  5 17:32:18 10.0.0.99 Use the BFG!\n',
+                 b'Use the BFG!\n'),
+                (b'<13>host foo bar\n', b'foo bar\n')):
+            self.collector.msg = bytearray()
+            parser.read(data)
+            self.assertTrue(self.collector.complete)
+            self.assertEqual(body, self.collector.msg)
+
+    def test_zero_copy_datagram_of_one_word(self):
+        parser = Parser(self.collector, zero_copy=True)
+
+        parser.read_datagram(b'<13>Oct 11 22:14:15 host word')
+        self.assertTrue(self.collector.complete)
+        self.assertEqual(b'word', self.collector.msg)
+
+    def test_any_chunk_size(self):
+        stream = (
+            b'<13>Feb  5 17:32:18 10.0.0.99 Use the BFG!\n'
+            b'<13>host foo bar\n'
+            b'<34>Oct 11 22:14:15 mymachine su: failed\n')
+        expected = [b'Use the BFG!\n', b'foo bar\n', b'failed\n']
+
+        for zero_copy in (False, True):
+            for chunk_size in range(1, len(stream) + 1):
+                collector = BodyCollector(self)
+                chunk_message(
+                    stream, Parser(collector, zero_copy=zero_copy),
+                    chunk_size)
+                self.assertEqual(
+                    expected, collector.bodies, (zero_copy, chunk_size))
+
+
+class WhenDecodingTimestamps(unittest.TestCase):
+
+    def _epoch(self, timestamp, parser=None):
+        records, pending = (parser or Parser()).parse_batch(
+            b'<46>1 ' + timestamp + b' host app - - - hello\n')
+        return records[0].epoch, records[0].epoch_usec
+
+    def test_offset_applied(self):
+        self.assertEqual(
+            (1355262503, 217459),
+            self._epoch(b'2012-12-11T15:48:23.217459-06:00'))
+        self.assertEqual(
+            (1355232203, 0), self._epoch(b'2012-12-11T15:48:23+02:25'))
+
+    def test_utc(self):
+        self.assertEqual(
+            (1355240903, 0), self._epoch(b'2012-12-11T15:48:23Z'))
+
+    def test_short_fraction(self):
+        self.assertEqual(
+            (1355240903, 3000), self._epoch(b'2012-12-11T15:48:23.003Z'))
+
+    def test_leap_day(self):
+        self.assertEqual(
+            (1330473600, 0), self._epoch(b'2012-02-29T00:00:00Z'))
+
+    def test_undecodable(self):
+        for timestamp in (b'-', b'2012-12-11T15:48:23', b'2012-02-30T00:00:00Z',
+                          b'2012-12-11T15:48:23.Z', b'2012-12-11T24:00:00Z',
+                          b'2012-12-11T15:48:23+0600', b'1969-12-31T23:59:59Z'):
+            self.assertEqual((None, None), self._epoch(timestamp))
+
+    def test_rfc3164_timestamp(self):
+        records, pending = Parser().parse_batch(
+            b'<34>Oct 11 22:14:15 mymachine su: failed\n')
+        self.assertIsNone(records[0].epoch)
+
+    def test_prefix_reused(self):
+        parser = Parser()
+
+        self.assertEqual(
+            (1355240903, 1), self._epoch(b'2012-12-11T15:48:23.000001Z', parser))
+        self.assertEqual(
+            (1355262503, 2),
+            self._epoch(b'2012-12-11T15:48:23.000002-06:00', parser))
+        self.assertEqual(
+            (1355240904, 0), self._epoch(b'2012-12-11T15:48:24Z', parser))
+        self.assertEqual((None, None), self._epoch(b'-', parser))
+
+    def test_standalone_head(self):
+        msg_head = SyslogMessageHead()
+        self.assertIsNone(msg_head.epoch)
+
+        msg_head.epoch = 10
+        self.assertEqual(10, msg_head.as_dict()['epoch'])
+
+
+class WhenFilteringPriorities(unittest.TestCase):
+
+    DEBUG_MESSAGE = b'<191>1 - host app - - [a b="c"] chatty\n'
+    INFO_MESSAGE = b'<190>1 - host app - - - useful\n'
+
+    def setUp(self):
+        self.default_filter = get_priority_filter()
+        self.filter = PriorityFilter(drop=['*.debug'])
+        set_priority_filter(self.filter)
+
+    def tearDown(self):
+        set_priority_filter(self.default_filter)
+
+    def test_facility_and_severity(self):
+        records, pending = Parser().parse_batch(bytes(HAPPY_PATH_MESSAGE))
+
+        self.assertEqual(5, records[0].facility)
+        self.assertEqual(6, records[0].severity)
+        self.assertEqual(5, records[0].as_dict()['facility'])
+        self.assertIsNone(SyslogMessageHead().severity)
+
+    def test_dropped_in_batch(self):
+        records, pending = Parser().parse_batch(
+            self.DEBUG_MESSAGE + self.INFO_MESSAGE + self.DEBUG_MESSAGE)
+
+        self.assertEqual([b'useful\n'], [r.message for r in records])
+        self.assertEqual(0, pending)
+        self.assertEqual(2, self.filter.dropped)
+
+    def test_dropped_without_callbacks(self):
+        collector = SpanCollector(self)
+        parser = Parser(collector)
+
+        chunk_message(b'30 ' + self.DEBUG_MESSAGE[:30], parser, 4)
+        self.assertFalse(collector.called)
+        self.assertEqual(0, parser.messages)
+
+        chunk_message(self.INFO_MESSAGE, parser, 4)
+        self.assertEqual('190', collector.msg_head.priority)
+        self.assertEqual(b'useful\n', collector.msg)
+
+    def test_pending_dropped_message(self):
+        parser = Parser()
+        records, pending = parser.parse_batch(
+            self.INFO_MESSAGE + self.DEBUG_MESSAGE[:10])
+        self.assertEqual(10, pending)
+
+        records, pending = parser.parse_batch(
+            self.DEBUG_MESSAGE[10:] + self.INFO_MESSAGE)
+        self.assertEqual(1, len(records))
+        self.assertEqual(1, self.filter.dropped)
+
+    def test_dropped_datagram(self):
+        parser = Parser()
+        parser.read_datagram(self.DEBUG_MESSAGE.rstrip())
+
+        with self.assertRaises(ParsingError):
+            parser.read_datagram(b'40 ' + self.DEBUG_MESSAGE[:20])
+        self.assertEqual(2, self.filter.dropped)
+
+    def test_keep_after_drop(self):
+        priority_filter = PriorityFilter(
+            drop=['*.debug', 'local7.*'], keep=['auth.debug', '23.0'])
+
+        self.assertTrue(priority_filter.drops(1, 7))
+        self.assertFalse(priority_filter.drops(4, 7))
+        self.assertTrue(priority_filter.drops(23, 6))
+        self.assertFalse(priority_filter.drops(23, 0))
+        self.assertFalse(priority_filter.drops(40, 7))
+
+    def test_bad_selectors(self):
+        for selector in ('debug', 'kern.loud', 'nope.*', '24.info'):
+            with self.assertRaises(ValueError):
+                PriorityFilter(drop=[selector])
+
+    def test_no_filter(self):
+        set_priority_filter(None)
+        records, pending = Parser().parse_batch(self.DEBUG_MESSAGE)
+        self.assertEqual(1, len(records))
+
+
+class WhenFilteringSd(unittest.TestCase):
+
+    SD = (b'[meniscus tenant="acme" other="a \\"]quoted\\" b" token="t1"]'
+          b'[origin software="rsyslogd" swVersion="7.2.5"]')
+    MESSAGE = b'<46>1 - host app - - ' + SD + b'  body\n'
+
+    def setUp(self):
+        self.default_filter = get_sd_filter()
+        set_sd_filter(SdFilter(['meniscus.tenant', 'meniscus.token']))
+
+    def tearDown(self):
+        set_sd_filter(self.default_filter)
+
+    def test_only_kept_values(self):
+        record, = Parser().parse_batch(self.MESSAGE)[0]
+
+        self.assertEqual(
+            {'meniscus': {'tenant': 'acme', 'token': 't1'}}, record.sd)
+        self.assertEqual(self.SD, record.sd_raw)
+        self.assertEqual(b'body\n', record.message)
+
+    def test_whole_element(self):
+        set_sd_filter(SdFilter(['origin.*']))
+        record, = Parser().parse_batch(self.MESSAGE)[0]
+
+        self.assertEqual(['origin'], record.sd.keys())
+        self.assertEqual('7.2.5', record.sd['origin']['swVersion'])
+
+    def test_chunked(self):
+        for size in range(1, 12):
+            collector = JsonCollector()
+            chunk_message(self.MESSAGE + HAPPY_PATH_MESSAGE, Parser(collector),
+                          size)
+
+            self.assertEqual(collector.expected, collector.encoded)
+            first, second = [simplejson.loads(e) for e in collector.encoded]
+            self.assertEqual(self.SD, first['sd_raw'])
+            self.assertEqual('acme', first['sd']['meniscus']['tenant'])
+            self.assertEqual({}, second['sd'])
+            self.assertTrue(second['sd_raw'].startswith('[origin_1 '))
+
+    def test_ends_after_sd(self):
+        collector = SpanCollector(self)
+        Parser(collector).read_datagram(
+            b'<46>1 - host app - - [meniscus tenant="a"]')
+
+        self.assertEqual('[meniscus tenant="a"]', collector.msg_head.sd_raw)
+
+    def test_sd_raw_truncated_at_max_size(self):
+        parser = Parser(buffer_pool=BufferPool(initial_size=16, max_size=1024))
+        sd = b'[meniscus tenant="acme" other="' + b'x' * 5000 + b'"]'
+        records, pending = parser.parse_batch(
+            b'<46>1 - host app - - ' + sd + b' body\n')
+
+        self.assertEqual(1024, parser.arena_size)
+        self.assertGreater(1024, len(records[0].sd_raw))
+        self.assertTrue(sd.startswith(records[0].sd_raw))
+        self.assertEqual('acme', records[0].sd['meniscus']['tenant'])
+        self.assertEqual(b'body\n', records[0].message)
+
+    def test_arena_shrunk_when_pooled(self):
+        pool = ParserPool()
+        parser = pool.take()
+        parser.parse_batch(
+            b'<46>1 - host app - - [meniscus other="' + b'x' * 5000 + b'"]\n')
+        self.assertLess(5000, parser.arena_size)
+
+        pool.give(parser)
+        self.assertEqual(256, parser.arena_size)
+
+        records, pending = pool.take().parse_batch(self.MESSAGE)
+        self.assertEqual(self.SD, records[0].sd_raw)
+
+    def test_no_sd(self):
+        record, = Parser().parse_batch(bytes(NO_STRUCTURED_DATA))[0]
+        self.assertIsNone(record.sd_raw)
+
+    def test_no_filter(self):
+        set_sd_filter(None)
+        record, = Parser().parse_batch(self.MESSAGE)[0]
+
+        self.assertIsNone(record.sd_raw)
+        self.assertNotIn('sd_raw', record.as_dict())
+        self.assertNotIn('sd_raw', simplejson.loads(JsonEncoder().encode(
+            record, record.message, record.msg_length)))
+        self.assertEqual(3, len(record.sd['meniscus']))
+
+    def test_paths(self):
+        sd_filter = SdFilter(['meniscus.tenant', 'origin.*'])
+
+        self.assertEqual(['meniscus.tenant', 'origin.*'], sd_filter.paths)
+        self.assertTrue(sd_filter.keeps('origin', 'software'))
+        self.assertFalse(sd_filter.keeps('meniscus', 'token'))
+
+        with self.assertRaises(ValueError):
+            sd_filter.add('tenant')
+
+
+class JsonCollector(SyslogMessageHandler):
+
+    def __init__(self):
+        self.msg = bytearray()
+        self.msg_head = None
+        self.encoder = JsonEncoder()
+        self.encoded = list()
+        self.expected = list()
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_part(self, msg_part):
+        self.msg.extend(msg_part)
+
+    def on_msg_complete(self, msg_length):
+        self.encoded.append(
+            self.encoder.encode(self.msg_head, self.msg, msg_length))
+
+        syslog_msg = self.msg_head.as_dict()
+        syslog_msg['message'] = self.msg.decode('utf-8')
+        syslog_msg['msg_length'] = msg_length
+        self.expected.append(simplejson.dumps(syslog_msg))
+        del self.msg[:]
+
+
+class WhenEncodingJson(unittest.TestCase):
+
+    def _assert_matches(self, data):
+        collector = JsonCollector()
+        parser = Parser(collector)
+
+        chunk_message(data, parser, 13)
+        self.assertTrue(collector.encoded)
+        self.assertEqual(collector.expected, collector.encoded)
+
+    def test_matches_simplejson(self):
+        self._assert_matches(bytes(HAPPY_PATH_MESSAGE))
+        self._assert_matches(ACTUAL_MESSAGE_NO_OCTET_COUNT)
+        self._assert_matches(bytes(NO_STRUCTURED_DATA))
+        self._assert_matches(bytes(BLANK_CHAR_MESSAGE))
+
+    def test_matches_simplejson_with_escapes(self):
+        message = (
+            u'<46>1 - hést app - - [a b="☃ / \t" '
+            u'c="\U0001f600"][d e="1"] \x01\x7f "quoted" \\ é\b\f\r\n'
+        ).encode('utf-8')
+        self._assert_matches(message)
+
+    def test_many_sd_fields(self):
+        fields = ' '.join('f{0}="{0}"'.format(i) for i in range(40))
+        self._assert_matches(
+            '<46>1 - h a - - [x {0}][y {0}][z {0}] body\n'.format(fields))
+
+    def test_standalone_head(self):
+        msg_head = SyslogMessageHead()
+        msg_head.hostname = 'host'
+        msg_head.priority = 13
+
+        expected = msg_head.as_dict()
+        expected['message'] = u'body'
+        expected['msg_length'] = 4
+
+        self.assertEqual(
+            simplejson.dumps(expected),
+            JsonEncoder().encode(msg_head, u'body', 4))
+
+    def test_invalid_utf8(self):
+        with self.assertRaises(UnicodeError):
+            JsonEncoder().encode(SyslogMessageHead(), b'\xc3\x28', 2)
+
+
 def performance(duration=10, print_output=True):
     validator = MessageValidator(None)
     parser = Parser(validator)
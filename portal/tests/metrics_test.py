@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tornado.testing import AsyncHTTPTestCase
+from portal import metrics
+
+
+class WhenRecordingMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_counter_by_labels(self):
+        self.registry.counter('bytes', host='a').inc(10)
+        self.registry.counter('bytes', host='a').inc(5)
+        self.registry.counter('bytes', host='b').inc()
+
+        samples = self.registry.snapshot()['bytes']['samples']
+        values = dict((s['labels']['host'], s['value']) for s in samples)
+        self.assertEqual({'a': 15, 'b': 1}, values)
+
+    def test_gauge_function(self):
+        depth = [3]
+        self.registry.gauge('depth', fn=lambda: depth[0])
+        depth[0] = 7
+
+        sample = self.registry.snapshot()['depth']['samples'][0]
+        self.assertEqual(7, sample['value'])
+
+    def test_counter_function(self):
+        self.registry.counter('stalls', fn=lambda: 2)
+        sample = self.registry.snapshot()['stalls']['samples'][0]
+        self.assertEqual(2, sample['value'])
+
+    def test_failing_function_skipped(self):
+        self.registry.gauge('broken', fn=lambda: 1 / 0)
+        self.assertEqual([], self.registry.snapshot()['broken']['samples'])
+
+    def test_histogram_buckets(self):
+        histogram = self.registry.histogram('latency', buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        value = self.registry.snapshot()['latency']['samples'][0]['value']
+        self.assertEqual([2, 1, 1], value['counts'])
+        self.assertEqual(4, value['count'])
+        self.assertAlmostEqual(2.65, value['sum'])
+
+    def test_kind_conflict(self):
+        self.registry.counter('name')
+        with self.assertRaises(ValueError):
+            self.registry.gauge('name')
+
+    def test_remove(self):
+        self.registry.counter('bytes', host='a')
+        self.registry.remove('bytes', host='a')
+        self.assertEqual([], self.registry.snapshot()['bytes']['samples'])
+
+
+class WhenAggregatingSnapshots(unittest.TestCase):
+
+    def _snapshot(self, count, latency):
+        registry = metrics.MetricsRegistry()
+        registry.counter('messages', 'Messages', host='a').inc(count)
+        registry.histogram('latency', buckets=(1.0,)).observe(latency)
+        return registry.snapshot()
+
+    def test_merge_sums_workers(self):
+        merged = metrics.merge_snapshots(
+            [self._snapshot(2, 0.5), self._snapshot(3, 2.0)])
+
+        self.assertEqual(5, merged['messages']['samples'][0]['value'])
+        latency = merged['latency']['samples'][0]['value']
+        self.assertEqual([1, 1], latency['counts'])
+        self.assertEqual(2, latency['count'])
+
+    def test_merge_leaves_inputs_alone(self):
+        snapshot = self._snapshot(2, 0.5)
+        metrics.merge_snapshots([snapshot, self._snapshot(3, 0.5)])
+        self.assertEqual(
+            [1, 0], snapshot['latency']['samples'][0]['value']['counts'])
+
+    def test_prometheus_format(self):
+        text = metrics.format_prometheus(self._snapshot(2, 0.5))
+
+        self.assertIn('# HELP messages Messages', text)
+        self.assertIn('# TYPE messages counter', text)
+        self.assertIn('messages{host="a"} 2', text)
+        self.assertIn('latency_bucket{le="1.0"} 1', text)
+        self.assertIn('latency_bucket{le="+Inf"} 1', text)
+        self.assertIn('latency_sum 0.5', text)
+        self.assertIn('latency_count 1', text)
+
+    def test_label_values_escaped(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter('errors', code='say "hi"').inc()
+
+        text = metrics.format_prometheus(registry.snapshot())
+        self.assertIn('errors{code="say \\"hi\\""} 1', text)
+
+
+class WhenStoringSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = metrics.SnapshotStore(self.directory, 'worker-0')
+        self.other = metrics.SnapshotStore(self.directory, 'worker-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_other_workers(self):
+        self.store.write({'mine': {}})
+        self.other.write({'theirs': {}})
+
+        self.assertEqual([{'theirs': {}}], self.store.read_others())
+
+    def test_dead_workers_ignored(self):
+        with open(os.path.join(self.directory, 'worker-9.json'), 'w') as out:
+            json.dump({'pid': 2 ** 22 + 1, 'metrics': {}}, out)
+
+        self.assertEqual([], self.store.read_others())
+
+    def test_stale_snapshots_ignored(self):
+        self.other.write({'theirs': {}})
+        os.utime(self.other.path, (0, 0))
+
+        self.assertEqual([], self.store.read_others())
+
+
+class WhenServingMetrics(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.registry = metrics.MetricsRegistry()
+        self.registry.counter('portal_messages_total', host='a').inc(3)
+        return metrics.metrics_application(self.registry)
+
+    def test_prometheus_text(self):
+        response = self.fetch('/metrics')
+
+        self.assertEqual(200, response.code)
+        self.assertIn('text/plain', response.headers['Content-Type'])
+        self.assertIn('portal_messages_total{host="a"} 3', response.body)
+
+    def test_json(self):
+        for path in ('/metrics.json', '/metrics?format=json'):
+            response = self.fetch(path)
+            snapshot = json.loads(response.body)
+            self.assertEqual(
+                3, snapshot['portal_messages_total']['samples'][0]['value'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import time
+import unittest
+
+from mock import MagicMock, patch
+from tornado.ioloop import IOLoop
+from portal import metrics, pipeline
+from portal.input.syslog import Parser, ParsingError
+from portal.transport import ZeroMQReceiver
+
+
+MESSAGES = (
+    b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru rsyslogd 6611 - - first\n'
+    b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru rsyslogd 6611 - - second\n')
+
+
+class WhenReadingBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = MagicMock()
+        self.reader = pipeline.BatchReader(Parser(), self.sink)
+
+    def test_records_submitted(self):
+        self.reader.read(MESSAGES)
+
+        records = self.sink.submit.call_args[0][0]
+        self.assertEqual(
+            [b'first\n', b'second\n'], [r.message for r in records])
+
+    def test_partial_message_not_submitted(self):
+        self.reader.read(MESSAGES[:20])
+        self.assertFalse(self.sink.submit.called)
+
+        self.reader.read(MESSAGES[20:])
+        self.assertEqual(2, len(self.sink.submit.call_args[0][0]))
+
+    def test_records_before_error_submitted(self):
+        with self.assertRaises(ParsingError):
+            self.reader.read(MESSAGES[:72] + b'<46>1 2012 bad\n')
+
+        records = self.sink.submit.call_args[0][0]
+        self.assertEqual([b'first\n'], [r.message for r in records])
+
+
+class WhenSubmittingToSenderPool(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = MagicMock()
+        self.pool = pipeline.SenderPool(
+            ('127.0.0.1', '5000'), queue_size=2, retry_interval=None)
+        self.pool.add_listener(self.listener)
+
+    def test_unknown_wire_format(self):
+        with self.assertRaises(ValueError):
+            pipeline.SenderPool(('127.0.0.1', '5000'), wire_format='xml')
+
+    def test_queued_until_full(self):
+        self.pool.submit(['first', 'second'])
+        self.assertFalse(self.pool.saturated)
+        self.assertEqual(2, self.pool.queue_depth)
+
+    def test_saturates_when_queue_is_full(self):
+        self.pool.submit(['first', 'second', 'third'])
+        self.pool.submit(['fourth'])
+
+        self.assertTrue(self.pool.saturated)
+        self.assertEqual(4, self.pool.queue_depth)
+        self.listener.on_saturated.assert_called_once_with()
+
+    def test_drains_in_order(self):
+        self.pool.submit(['first', 'second', 'third', 'fourth'])
+
+        self.pool._queue.get_nowait()
+        self.assertFalse(self.pool.drain())
+        self.assertFalse(self.listener.on_drained.called)
+
+        self.pool._queue.get_nowait()
+        self.assertTrue(self.pool.drain())
+        self.listener.on_drained.assert_called_once_with()
+
+        self.assertEqual('third', self.pool._queue.get_nowait()[1])
+        self.assertEqual('fourth', self.pool._queue.get_nowait()[1])
+
+    def test_close_before_start(self):
+        self.pool.close()
+        self.assertFalse(self.pool.started)
+
+    def test_metrics_per_endpoint(self):
+        registry = metrics.MetricsRegistry()
+
+        with patch('portal.pipeline.get_registry', return_value=registry):
+            first = pipeline.SenderPool(('127.0.0.1', '5000'))
+            second = pipeline.SenderPool(('127.0.0.1', '5100'))
+        first.submit(['first', 'second'])
+        second.submit(['third'])
+
+        samples = registry.snapshot()['portal_sender_queue_depth']['samples']
+        self.assertEqual(
+            {'tcp://127.0.0.1:5000': 2, 'tcp://127.0.0.1:5100': 1},
+            dict((s['labels']['endpoint'], s['value']) for s in samples))
+
+
+class WhenIntegrationTestingSenderPool(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.receiver = ZeroMQReceiver([('127.0.0.1', '5000')])
+        self.receiver.connect()
+
+    def tearDown(self):
+        self.pool.close()
+        self.receiver.close()
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def _send(self, data, **kwargs):
+        # Queued before the threads start so that batches fill up
+        self.pool = pipeline.SenderPool(('127.0.0.1', '5000'), **kwargs)
+        pipeline.BatchReader(Parser(), self.pool).read(data)
+        self.pool.start()
+
+    def _wait_for_sends(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while self.pool.sent < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_close_stops_every_thread(self):
+        self._send(b'', threads=4, batch_size=16)
+
+        start = time.time()
+        self.pool.close(timeout=2)
+        self.assertLess(time.time() - start, 1)
+        self.assertFalse(self.pool.started)
+
+    def test_sends_forwarded_before_close(self):
+        self._send(MESSAGES * 50, threads=4)
+        self.pool.close()
+
+        messages = list()
+        while len(messages) < 100:
+            messages.extend(self.receiver.get_messages())
+        self.assertEqual(100, self.pool.sent)
+        self.assertEqual(50, [m['message'] for m in messages].count('first\n'))
+
+    def test_json_sent_from_threads(self):
+        self._send(MESSAGES, threads=2)
+        self._wait_for_sends(2)
+
+        messages = self.receiver.get_messages() + self.receiver.get_messages()
+        self.assertEqual(
+            set(['first\n', 'second\n']),
+            set(message['message'] for message in messages))
+        self.assertEqual('tohru', messages[0]['hostname'])
+
+    def test_binary_batches(self):
+        self._send(MESSAGES, wire_format='binary', batch_size=2)
+        self._wait_for_sends(2)
+
+        messages = self.receiver.get_messages()
+        self.assertEqual(2, len(messages))
+        self.assertEqual(b'first\n', messages[0].message)
+        self.assertEqual('6611', messages[1].as_dict()['processid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+import unittest
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+
+import simplejson
+from mock import MagicMock
+
+from portal import routing, transport
+from portal.config import PortalConfiguration
+from portal.input.syslog import Parser
+from portal.metrics import get_registry
+
+
+CONFIG = '''
+[rule:cron]
+appname = CRON, anacron
+action = drop
+
+[rule:ci]
+hostname = build-*, /^ci\\d+\\./
+action = tag
+tag = ci
+
+[rule:acme]
+sd = meta.tenant = acme, globex
+action = route
+route = localhost:5100
+
+[rule:percent]
+messageid = 100%
+action = tag
+tag = full
+'''
+
+
+def parse(*messages):
+    records, pending = Parser().parse_batch(b''.join(messages))
+    return records
+
+
+def message(hostname='web1', appname='app', sd='-', messageid='-'):
+    return '<46>1 - {} {} - {} {} hello\n'.format(
+        hostname, appname, messageid, sd)
+
+
+def load_rules(text=CONFIG):
+    cfg = ConfigParser()
+    cfg.readfp(StringIO(text))
+    return routing.RuleSet.from_config(PortalConfiguration(cfg).rules)
+
+
+def matcher(*rules):
+    matcher = routing.Matcher()
+
+    for index, patterns in enumerate(rules):
+        matcher.add(1 << index, patterns)
+
+    matcher.compile()
+    return matcher
+
+
+class WhenMatchingPatterns(unittest.TestCase):
+
+    def test_exact(self):
+        m = matcher(['CRON', 'anacron'], ['CRON'])
+        self.assertEqual(3, m.match('CRON'))
+        self.assertEqual(1, m.match('anacron'))
+        self.assertEqual(0, m.match('CRONX'))
+
+    def test_prefix(self):
+        m = matcher(['build-*', 'ci*'], ['build-eu-*'])
+        self.assertEqual(3, m.match('build-eu-7'))
+        self.assertEqual(1, m.match('ci'))
+        self.assertEqual(0, m.match('buil'))
+        self.assertEqual([2, 6, 9], [l for l, p in m.prefixes])
+
+    def test_expression(self):
+        m = matcher(['/^ci\\d+$/'], ['/tenant-[ab]/'], ['/^x|y$/'])
+        self.assertEqual(1, m.match('ci42'))
+        self.assertEqual(2, m.match('a.tenant-b.z'))
+        self.assertEqual(4, m.match('ay'))
+        self.assertEqual(0, m.match('ci'))
+
+    def test_always(self):
+        m = matcher(['web'])
+        m.always = 2
+        self.assertEqual(3, m.match('web'))
+        self.assertEqual(2, m.match('db'))
+
+    def test_bad_expression(self):
+        with self.assertRaises(routing.RuleError):
+            routing.Matcher().add(1, ['/(/'])
+
+
+class WhenApplyingRules(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = load_rules()
+
+    def test_config_order_kept(self):
+        self.assertEqual(
+            ['cron', 'ci', 'acme', 'percent'],
+            [rule.name for rule in self.rules.rules])
+        self.assertEqual(set([('localhost', 5100)]), self.rules.routes)
+
+    def test_drop(self):
+        record, = parse(message(appname='CRON'))
+        self.assertIs(routing.DROPPED, self.rules.apply(record))
+        self.assertEqual(1, self.rules.rules[0].hits)
+
+    def test_tag_carries_on(self):
+        record, = parse(message(hostname='ci12.example', sd='[meta tenant="acme"]'))
+
+        self.assertEqual(('localhost', 5100), self.rules.apply(record))
+        self.assertEqual('ci', record.sd['portal']['tags'])
+
+    def test_tags_joined(self):
+        record, = parse(message(hostname='build-1', messageid='100%'))
+
+        self.assertIsNone(self.rules.apply(record))
+        self.assertEqual('ci,full', record.as_dict()['sd']['portal']['tags'])
+
+    def test_no_match(self):
+        record, = parse(message(sd='[meta tenant="initech"]'))
+
+        self.assertIsNone(self.rules.apply(record))
+        self.assertNotIn('portal', record.sd)
+
+    def test_hits_published(self):
+        record, = parse(message(appname='anacron'))
+        self.rules.apply(record)
+
+        samples = get_registry().snapshot()['portal_rule_hits_total']['samples']
+        hits = dict((s['labels']['rule'], s['value']) for s in samples)
+        self.assertEqual(1, hits['cron'])
+
+    def test_commas_within_expressions(self):
+        rules = load_rules(
+            '[rule:ci]\n'
+            'hostname = /^ci\\d{1,3}\\./, build-*\n'
+            'sd = meta.tenant = /^(acme|globex){1,2}$/, initech\n'
+            'action = drop\n')
+        cfg = ConfigParser()
+        cfg.readfp(StringIO('[rule:ci]\nhostname = /^ci\\d{1,3}\\./, b\n'))
+        self.assertEqual(
+            {'hostname': ['/^ci\\d{1,3}\\./', 'b']},
+            PortalConfiguration(cfg).rules[0].fields)
+
+        dropped, kept = parse(
+            message(hostname='ci12.example', sd='[meta tenant="acmeglobex"]'),
+            message(hostname='ci1234.example', sd='[meta tenant="initech"]'))
+        self.assertIs(routing.DROPPED, rules.apply(dropped))
+        self.assertIsNone(rules.apply(kept))
+
+    def test_bad_rules(self):
+        for text in ('[rule:a]\naction = drop\n',
+                     '[rule:a]\nappname = x\naction = explode\n',
+                     '[rule:a]\nappname = x\naction = tag\n',
+                     '[rule:a]\nappname = x\naction = route\n',
+                     '[rule:a]\nsd = tenant = x\naction = drop\n'):
+            with self.assertRaises(routing.RuleError):
+                load_rules(text)
+
+
+class WhenRoutingRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = MagicMock()
+        self.acme = MagicMock()
+        self.routing_sink = routing.RoutingSink(
+            load_rules(), self.sink, {('localhost', 5100): self.acme})
+
+    def test_records_split(self):
+        self.routing_sink.submit(parse(
+            message(), message(appname='CRON'),
+            message(sd='[meta tenant="globex"]'), message(hostname='db')))
+
+        records, = self.sink.submit.call_args[0]
+        self.assertEqual(['web1', 'db'], [r.hostname for r in records])
+
+        records, = self.acme.submit.call_args[0]
+        self.assertEqual(1, len(records))
+
+    def test_all_dropped(self):
+        self.routing_sink.submit(parse(message(appname='CRON')))
+        self.assertFalse(self.sink.submit.called)
+
+    def test_missing_route(self):
+        with self.assertRaises(routing.RuleError):
+            routing.RoutingSink(load_rules(), self.sink)
+
+
+class WhenHandlingWithRules(unittest.TestCase):
+
+    def setUp(self):
+        self.caster = MagicMock()
+        self.acme = MagicMock()
+        self.handler = transport.SyslogToZeroMQHandler(
+            self.caster, rules=load_rules(),
+            routes={('localhost', 5100): self.acme})
+        self.parser = Parser(self.handler)
+
+    def test_dropped_not_encoded(self):
+        self.parser.read(message(appname='CRON'))
+
+        self.assertFalse(self.caster.cast.called)
+        self.assertEqual(b'', self.handler.msg)
+
+    def test_routed(self):
+        self.parser.read(message(sd='[meta tenant="acme"]'))
+
+        self.assertFalse(self.caster.cast.called)
+        document = simplejson.loads(self.acme.cast.call_args[0][0])
+        self.assertEqual('acme', document['sd']['meta']['tenant'])
+
+    def test_tagged(self):
+        self.parser.read(message(hostname='build-3'))
+
+        document = simplejson.loads(self.caster.cast.call_args[0][0])
+        self.assertEqual('ci', document['sd']['portal']['tags'])
+
+    def test_missing_route(self):
+        with self.assertRaises(routing.RuleError):
+            transport.SyslogToZeroMQHandler(self.caster, rules=load_rules())
+
+
+if __name__ == '__main__':
+    unittest.main()
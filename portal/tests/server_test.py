@@ -0,0 +1,362 @@
+import socket
+import unittest
+
+from mock import MagicMock, patch
+from portal import server
+from portal.input.syslog import BufferPool, ERROR_NAMES, ParserPool
+from portal.metrics import COUNT_BUCKETS, get_registry
+from portal.input.syslog import SyslogMessageHandler
+
+
+class WhenFormattingWorkerAddresses(unittest.TestCase):
+
+    def setUp(self):
+        self.address = ('127.0.0.1', 5000)
+
+    def test_address_unchanged_without_workers(self):
+        with patch('portal.server.process.task_id', return_value=None):
+            self.assertEqual(self.address, server.worker_address(self.address))
+
+    def test_address_offset_by_task_id(self):
+        with patch('portal.server.process.task_id', return_value=0):
+            self.assertEqual(
+                ('127.0.0.1', 5000), server.worker_address(self.address))
+        with patch('portal.server.process.task_id', return_value=3):
+            self.assertEqual(
+                ('127.0.0.1', 5003), server.worker_address(self.address))
+
+    def test_string_ports_are_accepted(self):
+        with patch('portal.server.process.task_id', return_value=1):
+            self.assertEqual(
+                ('127.0.0.1', 5001),
+                server.worker_address(('127.0.0.1', '5000')))
+
+
+class WhenCheckingWorkerAddresses(unittest.TestCase):
+
+    def test_spaced_addresses(self):
+        server.check_worker_addresses(
+            [('127.0.0.1', 5000), ('127.0.0.1', '5004'), ('10.0.0.1', 5001)],
+            4)
+
+    def test_overlapping_addresses(self):
+        for addresses in ([('127.0.0.1', 5000), ('127.0.0.1', 5003)],
+                          [('127.0.0.1', 5000), ('127.0.0.1', 5000)],
+                          [('*', 5002), ('127.0.0.1', 5000)]):
+            with self.assertRaises(ValueError):
+                server.check_worker_addresses(addresses, 4)
+
+    def test_one_worker_per_cpu(self):
+        addresses = [('127.0.0.1', 5000), ('127.0.0.1', 5010)]
+
+        with patch('portal.server.process.cpu_count', return_value=8):
+            server.check_worker_addresses(addresses, 0)
+        with patch('portal.server.process.cpu_count', return_value=16):
+            with self.assertRaises(ValueError):
+                server.check_worker_addresses(addresses, 0)
+
+
+class WhenPausingConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = MagicMock(messages=0)
+        self.stream = MagicMock()
+        self.connection = server.TornadoConnection(
+            self.reader, self.stream, ('127.0.0.1', 1234))
+
+    def test_reads_on_creation(self):
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+    def test_reads_next_chunk(self):
+        self.connection._on_stream('data')
+        self.reader.read.assert_called_once_with('data')
+        self.assertEqual(2, self.stream.read_bytes.call_count)
+
+    def test_paused_connection_stops_reading(self):
+        self.connection.pause()
+        self.connection._on_stream('data')
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+        self.connection.resume()
+        self.assertEqual(2, self.stream.read_bytes.call_count)
+
+    def test_resume_with_read_pending(self):
+        self.connection.pause()
+        self.connection.resume()
+        self.assertEqual(1, self.stream.read_bytes.call_count)
+
+    def test_bytes_and_messages_counted(self):
+        registry = get_registry()
+        received = registry.counter(
+            'portal_received_bytes_total', transport='tcp', host='127.0.0.1')
+        parsed = registry.counter(
+            'portal_received_messages_total', transport='tcp',
+            host='127.0.0.1')
+        bytes_before, messages_before = received.value, parsed.value
+
+        self.reader.messages = 2
+        self.connection._on_stream('data')
+
+        self.assertEqual(4, self.connection.bytes_read)
+        self.assertEqual(2, self.connection.messages_read)
+        self.assertEqual(4, received.value - bytes_before)
+        self.assertEqual(2, parsed.value - messages_before)
+
+    def test_parse_errors_counted_by_code(self):
+        errors = get_registry().counter(
+            'portal_parse_errors_total', transport='tcp',
+            code='bad_priority')
+        before = errors.value
+
+        code = dict((v, k) for k, v in ERROR_NAMES.items())['bad_priority']
+        self.reader.read.side_effect = server.ParsingError(
+            'bad', None, code=code)
+        self.connection._on_stream('data')
+        self.assertEqual(1, errors.value - before)
+
+    def test_host_labels_capped(self):
+        with patch('portal.server._host_labels', set()), \
+                patch('portal.server._max_host_labels', 2):
+            labels = [server.host_label(host) for host in
+                      ('10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.1')]
+            metrics = server.SourceMetrics('tcp', '10.0.0.4')
+
+        self.assertEqual(['10.0.0.1', '10.0.0.2', 'other', '10.0.0.1'], labels)
+        self.assertIs(
+            get_registry().counter(
+                'portal_received_bytes_total', transport='tcp', host='other'),
+            metrics.bytes)
+
+    def test_totals_recorded_on_close(self):
+        received = get_registry().histogram(
+            'portal_connection_received_bytes', buckets=COUNT_BUCKETS,
+            transport='tcp')
+        parsed = get_registry().histogram(
+            'portal_connection_received_messages', buckets=COUNT_BUCKETS,
+            transport='tcp')
+        before = received.sample(), parsed.sample()
+
+        self.reader.messages = 2
+        self.connection._on_stream('data')
+        self.stream.set_close_callback.call_args[0][0]()
+
+        self.assertEqual(1, received.sample()['count'] - before[0]['count'])
+        self.assertEqual(4, received.sample()['sum'] - before[0]['sum'])
+        self.assertEqual(2, parsed.sample()['sum'] - before[1]['sum'])
+
+    def test_closed_stream(self):
+        self.stream.read_bytes.side_effect = server.StreamClosedError()
+        self.connection._on_stream('data')
+        self.connection.resume()
+        self.assertFalse(self.connection._reading)
+
+
+class WhenApplyingBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.server = server.SyslogServer(('127.0.0.1', 0), None)
+        self.streams = [MagicMock(), MagicMock()]
+        for stream in self.streams:
+            self.server.handle_stream(stream, ('127.0.0.1', 1234))
+
+    def test_saturation_pauses_connections(self):
+        with patch('portal.server.time.time', return_value=100):
+            self.server.on_saturated()
+        self.assertEqual(2, self.server.paused_connections)
+        self.assertEqual(2, self.server.pauses)
+
+        self.server.handle_stream(MagicMock(), ('127.0.0.1', 1234))
+        self.assertEqual(3, self.server.paused_connections)
+
+        with patch('portal.server.time.time', return_value=103):
+            self.server.on_drained()
+        self.assertEqual(0, self.server.paused_connections)
+        self.assertEqual(3, self.server.paused_time)
+
+    def test_record_sink_reads_batches(self):
+        self.server.record_sink = MagicMock()
+        self.server.handle_stream(MagicMock(), ('127.0.0.1', 1234))
+
+        readers = [connection.reader for connection in self.server.connections]
+        self.assertEqual(
+            1, sum(isinstance(r, server.BatchReader) for r in readers))
+
+    def test_delegate_per_connection(self):
+        factory = MagicMock(side_effect=lambda: MessageCollector())
+        self.server.delegate_factory = factory
+        self.server.handle_stream(MagicMock(), ('127.0.0.1', 1234))
+        self.server.handle_stream(MagicMock(), ('127.0.0.1', 1235))
+
+        self.assertEqual(2, factory.call_count)
+
+    def test_parsers_share_buffer_pool(self):
+        pool = BufferPool(capacity=4)
+        pooled_server = server.SyslogServer(
+            ('127.0.0.1', 0), None, buffer_pool=pool)
+        pooled_server.handle_stream(MagicMock(), ('127.0.0.1', 1234))
+        pooled_server.handle_stream(MagicMock(), ('127.0.0.1', 1235))
+
+        readers = [c.reader for c in pooled_server.connections]
+        self.assertEqual(2, pool.pooled)
+        self.assertFalse(any(reader.holds_buffer for reader in readers))
+
+    def test_parsers_returned_to_pool(self):
+        pool = ParserPool()
+        pooled_server = server.SyslogServer(
+            ('127.0.0.1', 0), None, parser_pool=pool)
+        stream = MagicMock()
+        pooled_server.handle_stream(stream, ('127.0.0.1', 1234))
+        reader = list(pooled_server.connections)[0].reader
+
+        stream.set_close_callback.call_args[0][0]()
+        self.assertEqual(1, pool.pooled)
+
+        pooled_server.handle_stream(MagicMock(), ('127.0.0.1', 1235))
+        self.assertIs(reader, list(pooled_server.connections)[0].reader)
+
+    def test_no_priority_filter(self):
+        with patch('portal.server.get_priority_filter', return_value=None):
+            samples = get_registry().snapshot()[
+                'portal_messages_dropped_total']['samples']
+        self.assertEqual([0], [sample['value'] for sample in samples])
+
+    def test_no_intern_cache(self):
+        with patch('portal.server.get_intern_cache', return_value=None):
+            snapshot = get_registry().snapshot()
+
+        for name in ('portal_intern_hits_total', 'portal_intern_misses_total'):
+            self.assertEqual(
+                [0], [sample['value'] for sample in snapshot[name]['samples']])
+
+    def test_closed_connections_forgotten(self):
+        close_callback = self.streams[0].set_close_callback.call_args[0][0]
+        close_callback()
+        self.assertEqual(1, len(self.server.connections))
+
+
+class MessageCollector(SyslogMessageHandler):
+
+    def __init__(self):
+        self.msg = bytearray()
+        self.messages = list()
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_part(self, msg_part):
+        self.msg.extend(msg_part)
+
+    def on_msg_complete(self, msg_length):
+        self.messages.append((self.msg_head.hostname, bytes(self.msg)))
+        self.msg = bytearray()
+
+
+class WhenReceivingUdpSyslog(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = MessageCollector()
+        self.server = server.SyslogUdpServer(
+            ('127.0.0.1', 0), self.collector, recv_buffer_size=65536,
+            batch_size=4, max_datagram_size=64, zero_copy=True)
+        self.server.bind()
+        self.server._parser = server.Parser(self.collector, zero_copy=True)
+        self.address = self.server.socket.getsockname()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.socket.close()
+
+    def _send(self, *datagrams):
+        for datagram in datagrams:
+            self.sender.sendto(datagram, self.address)
+
+    def _drain(self):
+        # Datagrams sent over loopback are queued before sendto returns
+        while self.server.read_datagrams() == self.server.batch_size:
+            pass
+
+    def test_datagrams_parsed_as_messages(self):
+        self._send(
+            b'<46>1 - one - - - - first',
+            b'<46>1 - two - - - - second\n')
+        self.server._on_readable(None, None)
+
+        self.assertEqual(
+            [('one', b'first'), ('two', b'second\n')],
+            self.collector.messages)
+        self.assertEqual(2, self.server.counters['received'])
+
+    def test_reads_at_most_batch_size(self):
+        self._send(*[b'<46>1 - h - - - - m'] * 6)
+        self.server._on_readable(None, None)
+        self.assertEqual(4, len(self.collector.messages))
+        self.server._on_readable(None, None)
+        self.assertEqual(6, len(self.collector.messages))
+
+    def test_errors_and_truncation_counted(self):
+        self._send(b'<46>1 - bad', b'<46>1 - h - - - - ' + b'x' * 64)
+        self.server._on_readable(None, None)
+
+        self.assertEqual(1, self.server.counters['errors'])
+        self.assertEqual(1, self.server.counters['truncated'])
+
+    def test_metrics_by_source_host(self):
+        registry = get_registry()
+        received = registry.counter(
+            'portal_received_bytes_total', transport='udp', host='127.0.0.1')
+        parsed = registry.counter(
+            'portal_received_messages_total', transport='udp',
+            host='127.0.0.1')
+        errors = registry.counter(
+            'portal_parse_errors_total', transport='udp',
+            code='premature_msg_end')
+        before = received.value, parsed.value, errors.value
+
+        self._send(b'<46>1 - h - - - - m', b'<46>1 - bad')
+        self.server._on_readable(None, None)
+
+        self.assertEqual(30, received.value - before[0])
+        self.assertEqual(1, parsed.value - before[1])
+        self.assertEqual(1, errors.value - before[2])
+
+    def test_counters_per_second(self):
+        self._send(b'<46>1 - h - - - - m', b'<46>1 - h - - - - m')
+        self._drain()
+        self.server.update_counters()
+        self.assertEqual(2, self.server.rates['received'])
+
+        self.server.update_counters()
+        self.assertEqual(0, self.server.rates['received'])
+        self.assertEqual(2, self.server.counters['received'])
+
+    def test_saturation_stops_reading(self):
+        io_loop = MagicMock()
+        with patch('portal.server.IOLoop.instance', return_value=io_loop):
+            self.server.on_saturated()
+            self.server.on_saturated()
+            io_loop.remove_handler.assert_called_once_with(
+                self.server.socket.fileno())
+
+            self.server.on_drained()
+            io_loop.add_handler.assert_called_once_with(
+                self.server.socket.fileno(), self.server._on_readable,
+                server.IOLoop.READ)
+
+    def test_records_submitted_to_sink(self):
+        self.server.record_sink = MagicMock()
+        self.server._parser = server.Parser()
+        self._send(b'<46>1 - one - - - - first', b'<46>1 - bad')
+        self.server._on_readable(None, None)
+
+        records = self.server.record_sink.submit.call_args[0][0]
+        self.assertEqual([b'first'], [r.message for r in records])
+        self.assertEqual(1, self.server.counters['errors'])
+        self.assertEqual([], self.collector.messages)
+
+    def test_socket_drops(self):
+        self.assertEqual(0, server.socket_drops(self.server.socket))
+
+
+if __name__ == '__main__':
+    unittest.main()
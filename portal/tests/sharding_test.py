@@ -0,0 +1,159 @@
+import unittest
+
+import simplejson
+from mock import MagicMock
+
+from portal import sharding, transport
+from portal.input.syslog import Parser
+
+
+def parse(*messages):
+    records, pending = Parser().parse_batch(b''.join(messages))
+    return records
+
+
+def message(hostname='web1', sd='-'):
+    return '<46>1 - {} app - - {} hello\n'.format(hostname, sd)
+
+
+def tenant(name):
+    return message(sd='[meniscus tenant="{}"]'.format(name))
+
+
+class WhenHashingKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = sharding.HashRing(
+            ('node-{}'.format(n), n) for n in range(4))
+        self.keys = ['tenant-{}'.format(k) for k in range(2000)]
+
+    def test_same_node_every_time(self):
+        other = sharding.HashRing(
+            ('node-{}'.format(n), n) for n in reversed(range(4)))
+
+        for key in self.keys:
+            self.assertEqual(self.ring.node_for(key), other.node_for(key))
+
+    def test_keys_spread(self):
+        counts = [0] * 4
+
+        for key in self.keys:
+            counts[self.ring.node_for(key)] += 1
+
+        for count in counts:
+            self.assertTrue(300 < count < 700, counts)
+
+    def test_adding_node_moves_few_keys(self):
+        before = dict((key, self.ring.node_for(key)) for key in self.keys)
+        self.ring.add('node-4', 4)
+
+        moved = [key for key in self.keys
+                 if self.ring.node_for(key) != before[key]]
+
+        # Only keys taken over by the new node move
+        self.assertEqual(
+            set([4]), set(self.ring.node_for(key) for key in moved))
+        self.assertTrue(200 < len(moved) < 600, len(moved))
+
+    def test_removing_node(self):
+        self.ring.remove('node-0')
+
+        self.assertNotIn(0, [self.ring.node_for(key) for key in self.keys])
+
+    def test_empty(self):
+        self.assertIsNone(sharding.HashRing().node_for('a'))
+
+
+class WhenReadingKeys(unittest.TestCase):
+
+    def test_sd_then_hostname(self):
+        get_key = sharding.key_getter(['meniscus.tenant', 'hostname'])
+        with_tenant, without = parse(tenant('acme'), message('db1'))
+
+        self.assertEqual('acme', get_key(with_tenant))
+        self.assertEqual('db1', get_key(without))
+
+    def test_no_key(self):
+        get_key = sharding.key_getter(['meniscus.tenant'])
+        record, = parse(message())
+
+        self.assertEqual('', get_key(record))
+
+    def test_bad_keys(self):
+        for keys in ([], ['tenant']):
+            with self.assertRaises(ValueError):
+                sharding.key_getter(keys)
+
+
+class WhenShardingCasts(unittest.TestCase):
+
+    def setUp(self):
+        self.casters = [MagicMock(backlog=n) for n in range(3)]
+        self.sharded = sharding.ShardedCaster(
+            [('shard-{}'.format(n), c) for n, c in enumerate(self.casters)],
+            ['meniscus.tenant'])
+        self.listener = MagicMock()
+        self.sharded.add_listener(self.listener)
+
+    def test_tenant_sticks_to_caster(self):
+        handler = transport.SyslogToZeroMQHandler(self.sharded)
+        parser = Parser(handler)
+
+        for _ in range(5):
+            parser.read(tenant('acme'))
+            parser.read(tenant('globex'))
+
+        counts = sorted(c.cast.call_count for c in self.casters)
+        self.assertIn(counts, ([0, 5, 5], [0, 0, 10]))
+
+        caster = self.sharded.ring.node_for('acme')
+        document = simplejson.loads(caster.cast.call_args_list[0][0][0])
+        self.assertEqual('acme', document['sd']['meniscus']['tenant'])
+
+    def test_all_bound(self):
+        self.sharded.bind()
+
+        for caster in self.casters:
+            self.assertTrue(caster.bind.called)
+
+    def test_backlog(self):
+        self.assertEqual(3, self.sharded.backlog)
+
+    def test_drained_once_all_drained(self):
+        first, second = [
+            c.add_listener.call_args[0][0] for c in self.casters[:2]]
+
+        first.on_saturated()
+        second.on_saturated()
+        self.assertEqual(1, self.listener.on_saturated.call_count)
+
+        first.on_drained()
+        self.assertFalse(self.listener.on_drained.called)
+
+        second.on_drained()
+        self.assertTrue(self.listener.on_drained.called)
+
+
+class WhenShardingRecords(unittest.TestCase):
+
+    def test_records_split(self):
+        sinks = [MagicMock(), MagicMock()]
+        sink = sharding.ShardingSink(
+            [('a', sinks[0]), ('b', sinks[1])], ['hostname'])
+        records = parse(*[message('host{}'.format(n)) for n in range(50)])
+
+        sink.submit(records)
+
+        submitted = [r.hostname
+                     for s in sinks for r in s.submit.call_args[0][0]]
+        self.assertEqual(50, len(submitted))
+        self.assertEqual(set(r.hostname for r in records), set(submitted))
+
+        for record in records:
+            self.assertIn(record.hostname, [
+                r.hostname for r in
+                sink.ring.node_for(record.hostname).submit.call_args[0][0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
+import time
 import unittest
 
 import simplejson
 from mock import MagicMock, patch
-from portal import transport
-from portal.input.syslog.usyslog import SyslogMessageHead
+from tornado.ioloop import IOLoop
+from portal import metrics, transport
+from portal.input.syslog.usyslog import BinaryEncoder, SyslogMessageHead
 
 
 class WhenTestingSyslogToZeroMQHandler(unittest.TestCase):
@@ -33,10 +35,7 @@ class WhenTestingSyslogToZeroMQHandler(unittest.TestCase):
 
     def test_on_msg_part(self):
         self.handler.on_msg_part(self.msg_part_1)
-        self.assertEqual(
-            self.handler.msg,
-            bytearray(self.msg_part_1)
-        )
+        self.assertEqual(self.handler.msg, b'')
         self.handler.on_msg_part(self.msg_part_2)
         self.assertEqual(
             self.handler.msg,
@@ -58,6 +57,62 @@ class WhenTestingSyslogToZeroMQHandler(unittest.TestCase):
             simplejson.dumps(self.final_message))
         self.assertEqual(self.handler.msg, b'')
 
+    def test_on_msg_complete_binary(self):
+        handler = transport.SyslogToZeroMQHandler(self.caster, 'binary')
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_part(self.msg_part_1)
+        handler.on_msg_part(self.msg_part_2)
+        msg = handler.msg
+        handler.on_msg_complete(self.msg_length)
+
+        self.caster.cast_frames.assert_called_once_with([
+            BinaryEncoder().encode(
+                self.msg_head, len(msg), self.msg_length),
+            msg])
+        self.assertEqual(msg, bytearray(self.msg_part_1 + self.msg_part_2))
+        self.assertEqual(handler.msg, b'')
+
+    def test_single_span_sent_without_copy(self):
+        handler = transport.SyslogToZeroMQHandler(self.caster, 'binary')
+        span = memoryview(b'<46>1 - - - - - - ' + self.msg_part_1)[18:]
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_part(span)
+        handler.on_msg_complete(self.msg_length)
+
+        header, body = self.caster.cast_frames.call_args[0][0]
+        self.assertIs(span, body)
+        self.assertEqual(handler.msg, b'')
+
+    def test_span_over_reused_buffer_copied(self):
+        handler = transport.SyslogToZeroMQHandler(self.caster, 'binary')
+        buff = bytearray(self.msg_part_1)
+        handler.on_msg_head(self.msg_head)
+        handler.on_msg_part(memoryview(buff))
+        buff[:] = self.msg_part_2
+        handler.on_msg_complete(self.msg_length)
+
+        header, body = self.caster.cast_frames.call_args[0][0]
+        self.assertEqual(bytearray(self.msg_part_1), body)
+
+    def test_latency_sampled(self):
+        registry = metrics.MetricsRegistry()
+
+        with patch('portal.transport.get_registry', return_value=registry):
+            handler = transport.SyslogToZeroMQHandler(
+                self.caster, latency_sample_interval=4)
+
+        for _ in range(9):
+            handler.on_msg_head(self.msg_head)
+            handler.on_msg_complete(self.msg_length)
+
+        samples = registry.snapshot()['portal_parse_to_send_seconds']
+        self.assertEqual(3, samples['samples'][0]['value']['count'])
+        self.assertEqual(9, self.caster.cast.call_count)
+
+    def test_unknown_wire_format(self):
+        with self.assertRaises(ValueError):
+            transport.SyslogToZeroMQHandler(self.caster, 'xml')
+
 
 class WhenTestingZeroMqCaster(unittest.TestCase):
 
@@ -103,7 +158,8 @@ class WhenTestingZeroMqCaster(unittest.TestCase):
         with patch('portal.transport.zmq', self.zmq_mock):
             self.caster.bind()
         self.caster.cast(self.msg)
-        self.socket_mock.send.assert_called_once_with(self.msg)
+        self.socket_mock.send.assert_called_once_with(
+            self.msg, transport.zmq.NOBLOCK)
 
         self.caster.close()
         with self.assertRaises(transport.zmq.error.ZMQError):
@@ -120,6 +176,254 @@ class WhenTestingZeroMqCaster(unittest.TestCase):
         self.assertFalse(self.caster.bound)
 
 
+    def test_metrics_per_endpoint(self):
+        registry = metrics.MetricsRegistry()
+
+        with patch('portal.transport.get_registry', return_value=registry):
+            first = transport.ZeroMQCaster(('127.0.0.1', '5000'))
+            second = transport.ZeroMQCaster(('127.0.0.1', '5100'))
+        first.stalls = 5
+        second.stalls = 7
+
+        samples = registry.snapshot()['portal_caster_stalls_total']['samples']
+        self.assertEqual(
+            {'tcp://127.0.0.1:5000': 5, 'tcp://127.0.0.1:5100': 7},
+            dict((s['labels']['endpoint'], s['value']) for s in samples))
+
+
+class WhenTestingBatchingZeroMqCaster(unittest.TestCase):
+
+    def setUp(self):
+        self.bind_host_tuple = ('127.0.0.1', '5000')
+        self.zmq_mock = MagicMock()
+        self.socket_mock = MagicMock()
+        self.context_mock = MagicMock()
+        self.context_mock.socket.return_value = self.socket_mock
+        self.zmq_mock.Context.return_value = self.context_mock
+
+    def _bound_caster(self, **kwargs):
+        caster = transport.ZeroMQCaster(self.bind_host_tuple, **kwargs)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+        return caster
+
+    def test_batching_disabled_by_default(self):
+        caster = self._bound_caster()
+        self.assertFalse(caster.batching)
+
+    def test_flush_on_batch_size(self):
+        caster = self._bound_caster(batch_size=3)
+        caster.cast('a')
+        caster.cast('b')
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        caster.cast('c')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['a', 'b', 'c'], transport.zmq.NOBLOCK)
+        self.assertFalse(self.socket_mock.send.called)
+
+    def test_flush_on_batch_bytes(self):
+        caster = self._bound_caster(batch_size=100, batch_bytes=6)
+        caster.cast('abc')
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        caster.cast('def')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['abc', 'def'], transport.zmq.NOBLOCK)
+
+    def test_flush_on_batch_latency(self):
+        caster = self._bound_caster(batch_size=100, batch_latency=5)
+        with patch('portal.transport.time.time', return_value=100):
+            caster.cast('a')
+            caster.flush_expired()
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        with patch('portal.transport.time.time', return_value=105):
+            caster.flush_expired()
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['a'], transport.zmq.NOBLOCK)
+
+    def test_close_flushes_batch(self):
+        caster = self._bound_caster(batch_size=100)
+        caster.cast('a')
+        caster.close()
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['a'], transport.zmq.NOBLOCK)
+
+    def test_cast_frames_without_batching(self):
+        caster = self._bound_caster()
+        caster.cast_frames(['head', 'body'])
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['head', 'body'], transport.zmq.NOBLOCK, copy=False)
+
+    def test_cast_frames_counts_messages(self):
+        caster = self._bound_caster(batch_size=2)
+        caster.cast_frames(['h1', 'b1'])
+        self.assertFalse(self.socket_mock.send_multipart.called)
+        caster.cast('c')
+        self.socket_mock.send_multipart.assert_called_once_with(
+            ['h1', 'b1', 'c'], transport.zmq.NOBLOCK, copy=False)
+
+
+class WhenTestingZeroMqCasterBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.zmq_mock = MagicMock()
+        self.socket_mock = MagicMock()
+        self.context_mock = MagicMock()
+        self.context_mock.socket.return_value = self.socket_mock
+        self.zmq_mock.Context.return_value = self.context_mock
+        self.listener = MagicMock()
+
+        self.caster = transport.ZeroMQCaster(
+            ('127.0.0.1', '5000'), sndhwm=10, retry_interval=None)
+        self.caster.add_listener(self.listener)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            self.caster.bind()
+
+    def test_sndhwm_set_before_bind(self):
+        self.socket_mock.setsockopt.assert_called_once_with(
+            self.zmq_mock.SNDHWM, 10)
+
+    def test_saturates_when_socket_is_full(self):
+        self.socket_mock.send.side_effect = transport.zmq.Again()
+        self.caster.cast('a')
+        self.caster.cast('b')
+
+        self.assertTrue(self.caster.saturated)
+        self.assertEqual(2, self.caster.backlog)
+        self.assertEqual(1, self.caster.stalls)
+        self.listener.on_saturated.assert_called_once_with()
+        # Later messages wait behind the backlog
+        self.assertEqual(1, self.socket_mock.send.call_count)
+
+    def test_drains_in_order(self):
+        self.socket_mock.send.side_effect = transport.zmq.Again()
+        with patch('portal.transport.time.time', return_value=100):
+            self.caster.cast('a')
+            self.caster.cast('b')
+
+        self.socket_mock.send.reset_mock()
+        self.socket_mock.send.side_effect = None
+        with patch('portal.transport.time.time', return_value=102):
+            self.assertTrue(self.caster.drain())
+
+        self.assertEqual(
+            [(('a', transport.zmq.NOBLOCK),), (('b', transport.zmq.NOBLOCK),)],
+            self.socket_mock.send.call_args_list)
+        self.assertFalse(self.caster.saturated)
+        self.assertEqual(0, self.caster.backlog)
+        self.assertEqual(2, self.caster.stall_time)
+        self.listener.on_drained.assert_called_once_with()
+
+    def test_partial_drain(self):
+        self.socket_mock.send.side_effect = transport.zmq.Again()
+        self.caster.cast('a')
+        self.caster.cast('b')
+
+        self.socket_mock.send.side_effect = [None, transport.zmq.Again()]
+        self.assertFalse(self.caster.drain())
+        self.assertEqual(1, self.caster.backlog)
+        self.assertTrue(self.caster.saturated)
+        self.assertFalse(self.listener.on_drained.called)
+
+    def test_saturated_batches_kept_whole(self):
+        caster = transport.ZeroMQCaster(
+            ('127.0.0.1', '5000'), batch_size=2, retry_interval=None)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            caster.bind()
+
+        self.socket_mock.send_multipart.side_effect = transport.zmq.Again()
+        caster.cast('a')
+        caster.cast('b')
+        self.assertEqual(1, caster.backlog)
+
+        self.socket_mock.send_multipart.side_effect = None
+        self.assertTrue(caster.drain())
+        self.socket_mock.send_multipart.assert_called_with(
+            ['a', 'b'], transport.zmq.NOBLOCK)
+
+
+class WhenTestingZeroMqStreamCaster(unittest.TestCase):
+
+    def setUp(self):
+        self.zmq_mock = MagicMock()
+        self.context_mock = MagicMock()
+        self.stream_mock = MagicMock()
+        self.listener = MagicMock()
+
+        self.caster = transport.ZeroMQStreamCaster(
+            ('127.0.0.1', '5000'), max_queue=4)
+        self.caster.add_listener(self.listener)
+        with patch('portal.transport.zmq', self.zmq_mock):
+            with patch('portal.transport.ZMQStream',
+                       return_value=self.stream_mock):
+                self.caster.bind()
+
+    def test_sends_through_stream(self):
+        self.caster.cast('a')
+        self.caster.cast_frames(['head', 'body'])
+
+        self.stream_mock.send.assert_called_once_with('a')
+        self.stream_mock.send_multipart.assert_called_once_with(
+            ['head', 'body'], copy=False)
+        self.assertEqual(2, self.caster.queue_depth)
+        self.stream_mock.on_send.assert_called_once_with(
+            self.caster._on_send)
+
+    def test_saturates_on_queue_depth(self):
+        for msg in 'abc':
+            self.caster.cast(msg)
+        self.assertFalse(self.caster.saturated)
+
+        self.caster.cast('d')
+        self.assertTrue(self.caster.saturated)
+        self.listener.on_saturated.assert_called_once_with()
+
+        self.caster._on_send(['a'], None)
+        self.assertTrue(self.caster.saturated)
+        self.caster._on_send(['b'], None)
+        self.assertFalse(self.caster.saturated)
+        self.listener.on_drained.assert_called_once_with()
+        self.assertEqual(2, self.caster.backlog)
+
+
+class WhenIntegrationTestingStreamCaster(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        self.caster = transport.ZeroMQStreamCaster(('127.0.0.1', '5000'))
+        self.caster.bind()
+        self.receiver = transport.ZeroMQReceiver([('127.0.0.1', '5000')])
+        self.receiver.connect()
+
+    def tearDown(self):
+        self.caster.close()
+        self.receiver.close()
+        self.io_loop.clear_current()
+        self.io_loop.close()
+
+    def _wait_for_sends(self, timeout=5):
+        deadline = time.time() + timeout
+
+        def check():
+            if self.caster.queue_depth == 0 or time.time() > deadline:
+                self.io_loop.stop()
+            else:
+                self.io_loop.call_later(0.01, check)
+
+        self.io_loop.add_callback(check)
+        self.io_loop.start()
+
+    def test_sends_on_io_loop(self):
+        for msg in ('first', 'second'):
+            self.caster.cast(msg)
+        self.assertEqual(2, self.caster.queue_depth)
+
+        self._wait_for_sends()
+        self.assertEqual(0, self.caster.queue_depth)
+        self.assertEqual('first', self.receiver.get())
+        self.assertEqual('second', self.receiver.get())
+
+
 class WhenTestingZeroMqReceiver(unittest.TestCase):
 
     def setUp(self):
@@ -184,6 +488,13 @@ class WhenTestingZeroMqReceiver(unittest.TestCase):
         self.assertFalse(self.receiver.connected)
 
 
+def drain(caster, timeout=5):
+    # Non-blocking sends back up until the receiver has connected
+    deadline = time.time() + timeout
+    while not caster.drain() and time.time() < deadline:
+        time.sleep(0.01)
+
+
 class WhenIntegrationTestingTransport(unittest.TestCase):
 
     def setUp(self):
@@ -209,10 +520,54 @@ class WhenIntegrationTestingTransport(unittest.TestCase):
         self.handler.on_msg_head(self.msg_head)
         self.handler.on_msg_part(self.test_message)
         self.handler.on_msg_complete(self.msg_length)
+        drain(self.caster)
 
         rcvd_msg = self.receiver.get()
         self.assertEqual(rcvd_msg, self.final_message_json)
 
+    def test_batched_transport_over_zmq(self):
+        self.caster = transport.ZeroMQCaster(self.host_tuple, batch_size=2)
+        self.caster.bind()
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+
+        self.caster.cast('first')
+        self.caster.cast('second')
+        self.caster.cast('third')
+        self.caster.cast('fourth')
+        drain(self.caster)
+
+        self.assertEqual(['first', 'second'], self.receiver.get_batch())
+        self.assertEqual('third', self.receiver.get())
+        self.assertEqual('fourth', self.receiver.get())
+
+    def test_unbatched_messages_received_as_batch(self):
+        self.caster = transport.ZeroMQCaster(self.host_tuple)
+        self.caster.bind()
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+
+        self.caster.cast('only')
+        drain(self.caster)
+        self.assertEqual(['only'], self.receiver.get_batch())
+
+    def test_binary_transport_over_zmq(self):
+        self.caster = transport.ZeroMQCaster(self.host_tuple, batch_size=2)
+        self.handler = transport.SyslogToZeroMQHandler(self.caster, 'binary')
+        self.receiver = transport.ZeroMQReceiver(self.connect_host_tuples)
+        self.receiver.connect()
+
+        for _ in range(2):
+            self.handler.on_msg_head(self.msg_head)
+            self.handler.on_msg_part(self.test_message)
+            self.handler.on_msg_complete(self.msg_length)
+        drain(self.caster)
+
+        messages = self.receiver.get_messages()
+        self.assertEqual(2, len(messages))
+        for message in messages:
+            self.assertEqual(self.final_message, message.as_dict())
+
     def tearDown(self):
         self.caster.close()
         self.receiver.close()
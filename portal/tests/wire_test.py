@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import struct
+import unittest
+
+import simplejson
+
+from portal import wire
+from portal.input.syslog import (
+    BinaryEncoder, Parser, SdFilter, SyslogMessageHandler, SyslogMessageHead,
+    get_sd_filter, set_sd_filter)
+
+
+HAPPY_PATH_MESSAGE = (
+    b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru rsyslogd 6611 12512 '
+    b'[origin_1 software="rsyslogd" swVersion="7.2.2" x-pid="12297"]'
+    b'[origin_2 software="rsyslogd" x-info="http://www.rsyslog.com"] '
+    b'start\n')
+
+NO_STRUCTURED_DATA = b'30 <46>1 - tohru - 6611 - - start'
+
+
+class BinaryCollector(SyslogMessageHandler):
+
+    def __init__(self):
+        self.encoder = BinaryEncoder()
+        self.msg_head = None
+        self.msg = bytearray()
+        self.expected = list()
+        self.frames = list()
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_part(self, msg_part):
+        self.msg.extend(msg_part)
+
+    def on_msg_complete(self, msg_length):
+        expected = self.msg_head.as_dict()
+        expected['message'] = bytes(self.msg).decode('utf-8')
+        expected['msg_length'] = msg_length
+        self.expected.append(expected)
+
+        self.frames.append(self.encoder.encode(
+            self.msg_head, len(self.msg), msg_length))
+        self.frames.append(bytes(self.msg))
+        self.msg = bytearray()
+
+
+class WhenDecodingBinaryRecords(unittest.TestCase):
+
+    def _round_trip(self, data):
+        collector = BinaryCollector()
+        Parser(collector).read(data)
+        self.assertTrue(collector.expected)
+
+        records = wire.decode_frames(collector.frames)
+        self.assertEqual(
+            collector.expected, [record.as_dict() for record in records])
+        return records
+
+    def test_round_trip(self):
+        record, = self._round_trip(HAPPY_PATH_MESSAGE)
+        self.assertEqual(46, record.priority)
+        self.assertEqual(1, record.version)
+        self.assertEqual('tohru', record.hostname)
+        self.assertEqual('6611', record.processid)
+        self.assertEqual(
+            'http://www.rsyslog.com', record.sd['origin_2']['x-info'])
+        self.assertEqual('start\n', record.message)
+
+    def test_round_trip_without_sd(self):
+        record, = self._round_trip(NO_STRUCTURED_DATA)
+        self.assertEqual({}, record.sd)
+        self.assertEqual('-', record.timestamp)
+
+    def test_round_trip_unicode(self):
+        self._round_trip(
+            u'<46>1 - hést app - - [a b="☃"] é\n'.encode('utf-8'))
+
+    def test_fields_read_lazily(self):
+        record, = self._round_trip(HAPPY_PATH_MESSAGE)
+        record = wire.BinaryRecord(record.header, record.message)
+        self.assertIsNone(record._fields)
+        self.assertIsNone(record._sd)
+        self.assertEqual('rsyslogd', record.appname)
+        self.assertIsNone(record._sd)
+
+    def test_standalone_head(self):
+        msg_head = SyslogMessageHead()
+        msg_head.hostname = 'host'
+        msg_head.priority = 13
+
+        record = wire.BinaryRecord(
+            BinaryEncoder().encode(msg_head, 4, 4), 'body')
+        self.assertEqual(13, record.priority)
+        self.assertEqual('host', record.hostname)
+        self.assertEqual('', record.appname)
+        self.assertIsNone(record.version)
+
+    def test_mixed_formats(self):
+        collector = BinaryCollector()
+        Parser(collector).read(NO_STRUCTURED_DATA)
+        document = {'message': 'json'}
+
+        messages = wire.decode_frames(
+            [simplejson.dumps(document)] + collector.frames)
+        self.assertEqual(document, messages[0])
+        self.assertEqual('start', messages[1].message)
+
+    def test_epoch(self):
+        record, = self._round_trip(HAPPY_PATH_MESSAGE)
+        self.assertEqual(1355262503, record.epoch)
+        self.assertEqual(217459, record.epoch_usec)
+
+        record, = self._round_trip(NO_STRUCTURED_DATA)
+        self.assertIsNone(record.epoch)
+        self.assertIsNone(record.epoch_usec)
+
+    def test_sd_raw(self):
+        default_filter = get_sd_filter()
+        set_sd_filter(SdFilter(['origin_2.*']))
+
+        try:
+            record, = self._round_trip(HAPPY_PATH_MESSAGE)
+        finally:
+            set_sd_filter(default_filter)
+
+        self.assertEqual(['origin_2'], record.sd.keys())
+        self.assertTrue(record.sd_raw.startswith('[origin_1 software='))
+        self.assertTrue(record.sd_raw.endswith('rsyslog.com"]'))
+
+    def test_version_1(self):
+        collector = BinaryCollector()
+        Parser(collector).read(HAPPY_PATH_MESSAGE)
+        header, body = collector.frames
+        header = b'\xfe\x01' + header[2:28] + header[44:]
+
+        record = wire.BinaryRecord(header, body)
+        self.assertEqual('tohru', record.hostname)
+        self.assertEqual('7.2.2', record.sd['origin_1']['swVersion'])
+        self.assertIsNone(record.epoch)
+
+    def test_version_2(self):
+        collector = BinaryCollector()
+        Parser(collector).read(HAPPY_PATH_MESSAGE)
+        header, body = collector.frames
+        header = b'\xfe\x02' + header[2:40] + header[44:]
+
+        record = wire.BinaryRecord(header, body)
+        self.assertEqual('tohru', record.hostname)
+        self.assertEqual('7.2.2', record.sd['origin_1']['swVersion'])
+        self.assertEqual(1355262503, record.epoch)
+        self.assertIsNone(record.sd_raw)
+
+    def test_unknown_version(self):
+        header = bytearray(
+            BinaryEncoder().encode(SyslogMessageHead(), 0, 0))
+        header[1] = wire.BINARY_VERSION + 1
+
+        with self.assertRaises(wire.WireFormatError):
+            wire.decode_frames([bytes(header), ''])
+
+    def test_missing_body(self):
+        header = BinaryEncoder().encode(SyslogMessageHead(), 0, 0)
+
+        with self.assertRaises(wire.WireFormatError):
+            wire.decode_frames([header])
+
+    def test_truncated_sd(self):
+        collector = BinaryCollector()
+        Parser(collector).read(HAPPY_PATH_MESSAGE)
+        header, body = collector.frames
+        sd_length, = struct.unpack_from('<I', header, 20)
+        header = header[:20] + struct.pack('<I', sd_length - 1) + header[24:-1]
+
+        record = wire.BinaryRecord(header, body)
+        with self.assertRaises(wire.WireFormatError):
+            record.sd
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,33 +3,102 @@ The transport module defines the classes that serve as the transport layer for
 Portal when sending parsed syslog messages downstream.
 """
 
-import simplejson as json
+import collections
+import time
+
 import zmq
+from tornado.ioloop import IOLoop
+from zmq.eventloop.zmqstream import ZMQStream
 
 from portal.log import get_logger
-from portal.input.syslog import SyslogMessageHandler
+from portal.metrics import get_registry
+from portal.input.syslog import (
+    BinaryEncoder, JsonEncoder, SyslogMessageHandler)
+from portal.routing import DROPPED, RuleError
+from portal.sharding import ShardedCaster
+from portal.wire import decode_frames
 
 
 _LOG = get_logger(__name__)
 
+# Parse to send latency is recorded for one message in this many, which keeps
+# the clock reads and the histogram lock off the path of most messages
+LATENCY_SAMPLE_INTERVAL = 64
+
 
 class SyslogToZeroMQHandler(SyslogMessageHandler):
     """
     SyslogToZeroMQHandler provides callback methods for the Syslog Parser.
-    It builds a dictionary of a parsed syslog message and then sends the
-    message downstream using ZeroMQ.
+    It serializes a parsed syslog message as JSON or in the binary format
+    described in portal.wire and then sends the message downstream using
+    ZeroMQ. The time from a message's head being parsed to the message being
+    handed to the caster is recorded in the portal_parse_to_send_seconds
+    histogram for one message in every latency_sample_interval.
+
+    A message body read in one piece, such as a zero-copy span of a TCP read,
+    is held as given and sent without being copied. Bodies split over several
+    pieces, and pieces over buffers that the reader reuses, such as the
+    datagram buffers of the UDP server, are copied into msg.
+
+    When given a RuleSet, the rules are applied to each completed message
+    before it is serialized. Dropped messages are never serialized and routed
+    messages are sent with the caster for their route. Messages for a
+    ShardedCaster are sent with the caster for their shard key.
     """
 
-    def __init__(self, zmq_caster):
+    def __init__(self, zmq_caster, wire_format='json', encoder=None,
+                 rules=None, routes=None,
+                 latency_sample_interval=LATENCY_SAMPLE_INTERVAL):
         """
         Initializes the handler msg, and msg_head.
 
         :param zmq_caster: An instance of ZeroMQCaster class
+        :param wire_format: Either 'json' or 'binary'
+        :param encoder: An encoder for the wire format to share with other
+            handlers on the same thread. One is created if not given.
+        :param rules: An optional portal.routing.RuleSet
+        :param routes: A dictionary of every route of the rules to the
+            ZeroMQCaster to send its messages with
+        :param latency_sample_interval: Parse to send latency is recorded
+            for one message in this many, starting with the first
         """
+        if wire_format not in ('json', 'binary'):
+            raise ValueError(
+                'Unknown wire format: {}'.format(wire_format))
+
         self.msg = bytearray()
         self.msg_head = None
+        self._span = None
+        self.wire_format = wire_format
+
+        if encoder is not None:
+            self.encoder = encoder
+        elif wire_format == 'binary':
+            self.encoder = BinaryEncoder()
+        else:
+            self.encoder = JsonEncoder()
+
         self.caster = zmq_caster
         self.caster.bind()
+        self.rules = rules
+        self.routes = routes or dict()
+
+        if rules is not None:
+            missing = rules.routes.difference(self.routes)
+
+            if missing:
+                raise RuleError('No caster for routes {}'.format(
+                    ', '.join(str(route) for route in missing)))
+
+        for caster in self.routes.itervalues():
+            caster.bind()
+
+        self.latency_sample_interval = max(1, latency_sample_interval)
+        self._until_sample = 1
+        self._head_time = None
+        self._parse_to_send = get_registry().histogram(
+            'portal_parse_to_send_seconds',
+            'Seconds from a message head being parsed to its send')
 
     def on_msg_head(self, msg_head):
         """
@@ -39,14 +108,31 @@ class SyslogToZeroMQHandler(SyslogMessageHandler):
         :param msg_head: An instance of the SyslogMessageHead class
         """
         self.msg_head = msg_head
+        self._until_sample -= 1
+
+        if self._until_sample == 0:
+            self._until_sample = self.latency_sample_interval
+            self._head_time = time.time()
 
     def on_msg_part(self, msg_part):
         """
         Callback method for the parser that builds the message as
         parts are received
 
-        :param msg_part: An str representing a piece or all of a syslog message
+        :param msg_part: An str or memoryview holding a piece or all of a
+            syslog message
         """
+        if self._span is None and not self.msg:
+            # A part that cannot change under us is held until a second part
+            # shows the message to be split over several reads
+            if isinstance(msg_part, bytes) or (
+                    isinstance(msg_part, memoryview) and msg_part.readonly):
+                self._span = msg_part
+                return
+        elif self._span is not None:
+            self.msg.extend(self._span)
+            self._span = None
+
         self.msg.extend(msg_part)
 
     def on_msg_complete(self, msg_length):
@@ -57,12 +143,48 @@ class SyslogToZeroMQHandler(SyslogMessageHandler):
 
         :param msg_length: The byte count of the syslog message received
         """
-        syslog_msg = self.msg_head.as_dict()
-        syslog_msg['message'] = self.msg.decode('utf-8')
-        syslog_msg['msg_length'] = msg_length
+        caster = self.caster
+
+        if self.rules is not None:
+            route = self.rules.apply(self.msg_head)
+
+            if route is DROPPED:
+                del self.msg[:]
+                self._span = None
+                self._head_time = None
+                return
+
+            if route is not None:
+                caster = self.routes[route]
+
+        if isinstance(caster, ShardedCaster):
+            caster = caster.caster_for(self.msg_head)
+
+        body = self._span
 
-        self.caster.cast(json.dumps(syslog_msg))
-        del self.msg[:]
+        if body is not None:
+            self._span = None
+        else:
+            body = self.msg
+
+        if self.wire_format == 'binary':
+            # The body is handed to zmq without a copy so the handler starts
+            # a new buffer rather than clearing the one being sent
+            if body is self.msg:
+                self.msg = bytearray()
+
+            caster.cast_frames([
+                self.encoder.encode(self.msg_head, len(body), msg_length),
+                body])
+        else:
+            # Same document as json.dumps of the head's as_dict() with the
+            # decoded message and msg_length added
+            caster.cast(self.encoder.encode(self.msg_head, body, msg_length))
+            del self.msg[:]
+
+        if self._head_time is not None:
+            self._parse_to_send.observe(time.time() - self._head_time)
+            self._head_time = None
 
 
 class ZeroMQCaster(object):
@@ -71,14 +193,46 @@ class ZeroMQCaster(object):
     messages over a zmq socket to downstream clients.  If multiple clients
     connect to this PUSH socket the messages will be load balanced evenly
     across the clients.
+
+    When batching is enabled, messages are held and sent together as the
+    frames of one multipart zmq message. A batch is sent once it holds
+    batch_size messages, once it holds at least batch_bytes bytes or once
+    the oldest message in it has waited batch_latency seconds. Receivers
+    that do not know about batching still get every message since zmq hands
+    out the frames of a multipart message one at a time.
+
+    Messages made of several frames, such as those in the binary wire
+    format, are sent with cast_frames. Their frames are sent without a copy
+    and must not be changed afterwards.
+
+    Sends never block. Once the socket reaches its send high-water mark the
+    caster is saturated: messages are kept in order in a backlog, listeners
+    added with add_listener have their on_saturated method called and the
+    backlog is retried on the I/O loop every retry_interval seconds. When the
+    backlog has been sent the listeners' on_drained method is called. The
+    number of stalls and the total seconds spent saturated are kept in
+    stalls and stall_time.
+
+    The time each send takes, the backlog and the stalls are recorded in the
+    portal_caster metrics.
     """
 
-    def __init__(self, bind_host_tuple):
+    def __init__(self, bind_host_tuple, batch_size=1, batch_bytes=None,
+                 batch_latency=None, sndhwm=None, retry_interval=0.005):
         """
         Creates an instance of the ZeroMQCaster.  A zmq PUSH socket is
         created and is bound to the specified host:port.
 
         :param bind_host_tuple: (host, port), for example ('127.0.0.1', '5000')
+        :param batch_size: The most messages to send in one batch. Values of 1
+        or less disable batching.
+        :param batch_bytes: Optional byte count that sends a batch once
+        reached.
+        :param batch_latency: Optional number of seconds a message may wait
+        in a batch before the batch is sent.
+        :param sndhwm: Optional send high-water mark for the zmq socket.
+        :param retry_interval: Seconds between attempts to send the backlog
+        while saturated. None leaves retrying to explicit drain calls.
         """
 
         self.socket_type = zmq.PUSH
@@ -87,34 +241,240 @@ class ZeroMQCaster(object):
         self.socket = None
         self.bound = False
 
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_latency = batch_latency
+        self._batch = list()
+        self._batch_count = 0
+        self._batch_byte_count = 0
+        self._batch_deadline = None
+        self._batch_copy = True
+
+        self.sndhwm = sndhwm
+        self.retry_interval = retry_interval
+        self.saturated = False
+        self.stalls = 0
+        self.stall_time = 0.0
+        self._stall_start = None
+        self._backlog = collections.deque()
+        self._listeners = list()
+        self._retry_scheduled = False
+
+        registry = get_registry()
+        self._send_latency = registry.histogram(
+            'portal_caster_send_seconds', 'Seconds spent sending to zmq')
+        registry.gauge(
+            'portal_caster_backlog', 'Sends waiting for room on the socket',
+            fn=lambda: self.backlog, endpoint=self.bind_host)
+        registry.counter(
+            'portal_caster_stalls_total', 'Times the caster saturated',
+            fn=lambda: self.stalls, endpoint=self.bind_host)
+        registry.counter(
+            'portal_caster_stall_seconds_total',
+            'Seconds the caster spent saturated',
+            fn=lambda: self.stall_time, endpoint=self.bind_host)
+
+    @property
+    def batching(self):
+        """
+        Returns True if this caster sends messages in batches.
+        """
+        return self.batch_size > 1
+
+    @property
+    def backlog(self):
+        """
+        Returns the number of sends waiting for room on the socket.
+        """
+        return len(self._backlog)
+
+    def add_listener(self, listener):
+        """
+        Adds a listener to be told when the caster saturates and drains. The
+        listener must have on_saturated and on_drained methods.
+        """
+        self._listeners.append(listener)
+
     def bind(self):
         """
         Bind the ZeroMQCaster to a host:port to push out messages.
         Create a zmq.Context and a zmq.PUSH socket, and bind the
-        socket to the specified host:port
+        socket to the specified host:port. Casters that are already bound
+        are left as they are so that several handlers may share one.
         """
+        if self.bound:
+            return
+
         self.context = zmq.Context()
         self.socket = self.context.socket(self.socket_type)
+
+        if self.sndhwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, self.sndhwm)
+
         self.socket.bind(self.bind_host)
         self.bound = True
 
     def cast(self, msg):
         """
-        Sends a message over the zmq PUSH socket
+        Sends a message over the zmq PUSH socket or adds it to the current
+        batch if batching is enabled.
+        """
+        if not self.bound:
+            raise zmq.error.ZMQError(
+                "ZeroMQCaster is not bound to a socket")
+
+        if not self.batching:
+            self._dispatch([msg], False, True)
+            return
+
+        self._add_to_batch([msg], len(msg))
+
+    def cast_frames(self, frames):
+        """
+        Sends a message made of several frames over the zmq PUSH socket
+        without copying them, or adds its frames to the current batch if
+        batching is enabled.
         """
         if not self.bound:
             raise zmq.error.ZMQError(
                 "ZeroMQCaster is not bound to a socket")
+
+        if not self.batching:
+            self._dispatch(frames, True, False)
+            return
+
+        self._batch_copy = False
+        self._add_to_batch(frames, sum(len(frame) for frame in frames))
+
+    def _add_to_batch(self, frames, byte_count):
+        if not self._batch and self.batch_latency is not None:
+            self._batch_deadline = time.time() + self.batch_latency
+
+        self._batch.extend(frames)
+        self._batch_count += 1
+        self._batch_byte_count += byte_count
+
+        if (self._batch_count >= self.batch_size or
+                (self.batch_bytes and
+                 self._batch_byte_count >= self.batch_bytes) or
+                self._batch_expired()):
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all messages held in the current batch.
+        """
+        if not self._batch:
+            return
+
+        batch = self._batch
+        copy = self._batch_copy
+        self._batch = list()
+        self._batch_count = 0
+        self._batch_byte_count = 0
+        self._batch_deadline = None
+        self._batch_copy = True
+
+        self._dispatch(batch, True, copy)
+
+    def drain(self):
+        """
+        Sends as much of the backlog as the socket will take. Returns True
+        once the backlog is empty, at which point the caster is no longer
+        saturated.
+        """
+        while self._backlog:
+            if not self._send(*self._backlog[0]):
+                self._schedule_retry()
+                return False
+            self._backlog.popleft()
+
+        self._drained()
+        return True
+
+    def _dispatch(self, frames, multipart, copy):
+        # Later sends wait behind the backlog so that order is kept
+        if self._backlog or not self._send(frames, multipart, copy):
+            self._backlog.append((frames, multipart, copy))
+
+            if not self.saturated:
+                self._saturate()
+                self._schedule_retry()
+
+    def _send(self, frames, multipart, copy):
+        start = time.time()
+
         try:
-            self.socket.send(msg)
+            if not multipart:
+                self.socket.send(frames[0], zmq.NOBLOCK)
+            elif copy:
+                self.socket.send_multipart(frames, zmq.NOBLOCK)
+            else:
+                self.socket.send_multipart(frames, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            return False
         except Exception as ex:
             _LOG.exception(ex)
 
+        self._send_latency.observe(time.time() - start)
+        return True
+
+    def _saturate(self):
+        self.saturated = True
+        self.stalls += 1
+        self._stall_start = time.time()
+
+        for listener in self._listeners:
+            listener.on_saturated()
+
+    def _drained(self):
+        if not self.saturated:
+            return
+
+        self.saturated = False
+        self.stall_time += time.time() - self._stall_start
+        self._stall_start = None
+
+        for listener in self._listeners:
+            listener.on_drained()
+
+    def _schedule_retry(self):
+        if self._retry_scheduled or self.retry_interval is None:
+            return
+
+        self._retry_scheduled = True
+        IOLoop.current().call_later(self.retry_interval, self._retry)
+
+    def _retry(self):
+        self._retry_scheduled = False
+
+        if self.bound:
+            self.drain()
+
+    def flush_expired(self):
+        """
+        Sends the current batch if its oldest message has waited longer than
+        the configured batch latency. This is meant to be called
+        periodically so that batches are sent even when traffic stops.
+        """
+        if self._batch_expired():
+            self.flush()
+
+    def _batch_expired(self):
+        return (self._batch_deadline is not None and
+                time.time() >= self._batch_deadline)
+
     def close(self):
         """
         Close the zmq socket
         """
         if self.bound:
+            self.flush()
+
+            if not self.drain():
+                _LOG.warning('Closing with {} sends still waiting'.format(
+                    self.backlog))
+
             self.socket.close()
             self.context.destroy()
             self.socket = None
@@ -122,6 +482,107 @@ class ZeroMQCaster(object):
             self.bound = False
 
 
+class ZeroMQStreamCaster(ZeroMQCaster):
+    """
+    ZeroMQStreamCaster is a ZeroMQCaster that sends through a ZMQStream on
+    the I/O loop. Messages are queued by the stream and written whenever the
+    socket is writable, so casting never waits on the socket and parsing
+    carries on while earlier messages are still being sent.
+
+    The number of sends waiting in the stream is kept in queue_depth. The
+    caster saturates once max_queue sends are waiting and drains once the
+    queue is back down to half of that, telling its listeners as
+    ZeroMQCaster does. Send latency is the time from a send being queued to
+    the stream writing it.
+    """
+
+    def __init__(self, bind_host_tuple, max_queue=1000, **kwargs):
+        """
+        :param bind_host_tuple: (host, port), for example ('127.0.0.1', '5000')
+        :param max_queue: The number of queued sends at which the caster
+        saturates.
+
+        The remaining keyword arguments are those of ZeroMQCaster.
+        """
+        super(ZeroMQStreamCaster, self).__init__(bind_host_tuple, **kwargs)
+        self.max_queue = max_queue
+        self.queue_depth = 0
+        self.stream = None
+        self._queued_times = collections.deque()
+
+    @property
+    def backlog(self):
+        """
+        Returns the number of sends queued in the stream.
+        """
+        return self.queue_depth
+
+    def bind(self):
+        """
+        Binds the socket as ZeroMQCaster does and wraps it in a ZMQStream on
+        the current I/O loop.
+        """
+        if self.bound:
+            return
+
+        super(ZeroMQStreamCaster, self).bind()
+        self.stream = ZMQStream(self.socket)
+        self.stream.on_send(self._on_send)
+
+    def drain(self):
+        """
+        Sends whatever the socket will take from the stream's queue right
+        away. Returns True once the queue is empty.
+        """
+        if self.queue_depth:
+            self.stream.flush(zmq.POLLOUT)
+        return self.queue_depth == 0
+
+    def _dispatch(self, frames, multipart, copy):
+        self.queue_depth += 1
+        self._queued_times.append(time.time())
+
+        if multipart:
+            self.stream.send_multipart(frames, copy=copy)
+        else:
+            self.stream.send(frames[0])
+
+        if self.queue_depth >= self.max_queue and not self.saturated:
+            self._saturate()
+
+    def _on_send(self, msg, status):
+        self.queue_depth -= 1
+
+        if self._queued_times:
+            self._send_latency.observe(
+                time.time() - self._queued_times.popleft())
+
+        if isinstance(status, Exception):
+            _LOG.error(status)
+
+        if self.queue_depth <= self.max_queue // 2:
+            self._drained()
+
+    def close(self):
+        """
+        Sends what the socket will take from the queue and closes the stream
+        and its socket.
+        """
+        if self.bound:
+            self.flush()
+
+            if not self.drain():
+                _LOG.warning('Closing with {} sends still waiting'.format(
+                    self.queue_depth))
+
+            self.stream.close()
+            self.context.destroy()
+            self.stream = None
+            self.socket = None
+            self.context = None
+            self.bound = False
+
+
 class ZeroMQReceiver(object):
     """
     ZeroMQReceiver allows for messages to be received by pulling
@@ -160,13 +621,33 @@ class ZeroMQReceiver(object):
 
     def get(self):
         """
-        Read a message form the zmq socket and return
+        Read a message form the zmq socket and return. Batches sent by a
+        batching caster are returned one message at a time.
         """
         if not self.connected:
             raise zmq.error.ZMQError(
                 "ZeroMQReceiver is not connected to a socket")
         return self.socket.recv()
 
+    def get_batch(self):
+        """
+        Read the next batch of messages from the zmq socket and return them
+        as a list. Messages sent by a caster that does not batch are returned
+        as a list of one message.
+        """
+        if not self.connected:
+            raise zmq.error.ZMQError(
+                "ZeroMQReceiver is not connected to a socket")
+        return self.socket.recv_multipart()
+
+    def get_messages(self):
+        """
+        Read the next batch of messages from the zmq socket and return them
+        decoded. JSON messages are returned as dictionaries and binary
+        messages as portal.wire.BinaryRecord instances.
+        """
+        return decode_frames(self.get_batch())
+
     def close(self):
         """
         Close the zmq socket
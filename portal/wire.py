@@ -0,0 +1,312 @@
+"""
+The wire module decodes the messages Portal sends downstream over ZeroMQ.
+
+Portal writes each parsed syslog message either as a JSON document in a single
+frame or in its binary format as a header frame followed by a body frame
+holding the raw message. The header starts with a magic byte that can never
+begin a JSON document and a format version, so receivers can read both
+formats from the same socket and casters can be switched one at a time once
+receivers understand the format. All integers are little endian.
+
+Binary header, version 3:
+
+    offset  size  field
+    0       1     magic, 0xFE
+    1       1     format version
+    2       2     priority, 0xFFFF when unset
+    4       2     syslog version, 0xFFFF when unset
+    6       4     message length as counted by the parser
+    10      2x5   lengths of timestamp, hostname, appname, processid and
+                  messageid
+    20      4     length of the structured data block
+    24      4     length of the body frame
+    28      8     timestamp as seconds since the epoch, 0xFFFFFFFFFFFFFFFF
+                  when the timestamp could not be decoded
+    36      4     microseconds of the timestamp
+    40      4     length of the raw structured data, 0xFFFFFFFF when the
+                  message was parsed without an SD filter
+    44            the five head fields back to back, the structured data,
+                  then the raw structured data
+
+Version 2 headers have no raw structured data length and the head fields
+start at offset 40. Version 1 headers have no epoch fields either and the
+head fields start at offset 28. Receivers read every version, so they must be
+upgraded before the casters that send to them.
+
+The structured data block holds each element as a two byte name length, the
+name and a two byte field count followed by each field as a two byte name
+length, the name, a four byte value length and the value.
+"""
+
+import struct
+
+import simplejson as json
+
+from portal.input.syslog import (
+    BINARY_MAGIC, BINARY_VERSION)
+
+
+_MAGIC = chr(BINARY_MAGIC)
+_PREAMBLE = struct.Struct('<BB')
+_FIXED_HEADERS = {
+    1: struct.Struct('<BBHHI5HII'),
+    2: struct.Struct('<BBHHI5HIIQI'),
+    3: struct.Struct('<BBHHI5HIIQII')
+}
+_SUPPORTED_VERSIONS = tuple(sorted(_FIXED_HEADERS))
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_UNSET = 0xFFFF
+_UNSET_EPOCH = 0xFFFFFFFFFFFFFFFF
+_UNSET_LENGTH = 0xFFFFFFFF
+_FIELD_NAMES = ('timestamp', 'hostname', 'appname', 'processid',
+                'messageid')
+
+
+class WireFormatError(Exception):
+    """
+    Raised when a message received from upstream can not be decoded.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class BinaryRecord(object):
+    """
+    BinaryRecord is a syslog message received in the binary format. Only the
+    fixed part of the header is read when the record is created; the head
+    fields and structured data are read from the header the first time they
+    are accessed and the message body is the body frame as it was received.
+    The priority and version are None if the message head did not set them
+    and the epoch and epoch_usec are None if the timestamp could not be
+    decoded or the record was sent in version 1 of the format. The sd_raw is
+    None unless the message was parsed with an SD filter.
+    """
+
+    __slots__ = ('header', 'message', 'priority', 'version', 'msg_length',
+                 'epoch', 'epoch_usec', 'sd_raw', '_lengths', '_sd_length',
+                 '_fields_offset', '_fields', '_sd')
+
+    def __init__(self, header, message):
+        """
+        :param header: The header frame
+        :param message: The body frame holding the raw message
+        """
+        if len(header) < _PREAMBLE.size:
+            raise WireFormatError('Binary header is truncated')
+
+        magic, format_version = _PREAMBLE.unpack_from(header)
+
+        if magic != BINARY_MAGIC:
+            raise WireFormatError('Frame is not a binary header')
+
+        fixed_header = _FIXED_HEADERS.get(format_version)
+
+        if fixed_header is None:
+            raise WireFormatError(
+                'Unsupported binary format version {}'.format(format_version))
+
+        if len(header) < fixed_header.size:
+            raise WireFormatError('Binary header is truncated')
+
+        values = fixed_header.unpack_from(header)
+
+        if len(message) != values[11]:
+            raise WireFormatError('Body frame does not match its header')
+
+        self.header = header
+        self.message = message
+        self.priority = values[2] if values[2] != _UNSET else None
+        self.version = values[3] if values[3] != _UNSET else None
+        self.msg_length = values[4]
+        self._lengths = values[5:10]
+        self._sd_length = values[10]
+        self._fields_offset = fixed_header.size
+        self._fields = None
+
+        if format_version > 1 and values[12] != _UNSET_EPOCH:
+            self.epoch = values[12]
+            self.epoch_usec = values[13]
+        else:
+            self.epoch = None
+            self.epoch_usec = None
+
+        if format_version > 2 and values[14] != _UNSET_LENGTH:
+            if values[14] > len(header):
+                raise WireFormatError('Binary header length does not match')
+
+            self.sd_raw = header[len(header) - values[14]:]
+        else:
+            self.sd_raw = None
+        self._sd = None
+
+    def _read_fields(self):
+        fields = list()
+        offset = self._fields_offset
+
+        for length in self._lengths:
+            fields.append(self.header[offset:offset + length])
+            offset += length
+
+        if offset + self._sd_length + self._sd_raw_length != len(
+                self.header):
+            raise WireFormatError('Binary header length does not match')
+
+        self._fields = fields
+        return fields
+
+    def _field(self, index):
+        fields = self._fields
+
+        if fields is None:
+            fields = self._read_fields()
+        return fields[index]
+
+    @property
+    def facility(self):
+        return self.priority >> 3 if self.priority is not None else None
+
+    @property
+    def severity(self):
+        return self.priority & 7 if self.priority is not None else None
+
+    @property
+    def timestamp(self):
+        return self._field(0)
+
+    @property
+    def hostname(self):
+        return self._field(1)
+
+    @property
+    def appname(self):
+        return self._field(2)
+
+    @property
+    def processid(self):
+        return self._field(3)
+
+    @property
+    def messageid(self):
+        return self._field(4)
+
+    @property
+    def sd(self):
+        """
+        Returns the structured data as a dictionary of element names to
+        dictionaries of field names and values.
+        """
+        if self._sd is None:
+            end = len(self.header) - self._sd_raw_length
+            self._sd = _decode_sd(self.header, end - self._sd_length, end)
+        return self._sd
+
+    @property
+    def _sd_raw_length(self):
+        return len(self.sd_raw) if self.sd_raw is not None else 0
+
+    def as_dict(self):
+        """
+        Returns the same dictionary as SyslogRecord.as_dict() for the message
+        this record was encoded from.
+        """
+        sd_copy = dict()
+        dictionary = {
+            'priority': _unset_to_empty(self.priority),
+            'version': _unset_to_empty(self.version),
+            'facility': self.facility,
+            'severity': self.severity,
+            'epoch': self.epoch,
+            'epoch_usec': self.epoch_usec,
+            'sd': sd_copy
+        }
+
+        if self.sd_raw is not None:
+            dictionary['sd_raw'] = self.sd_raw.decode('utf-8')
+
+        for index, name in enumerate(_FIELD_NAMES):
+            dictionary[name] = self._field(index)
+
+        for sd_name, sde in self.sd.iteritems():
+            sd_copy[sd_name] = dict(
+                (sd_fieldname, value.decode('utf-8'))
+                for sd_fieldname, value in sde.iteritems())
+
+        dictionary['message'] = bytes(self.message).decode('utf-8')
+        dictionary['msg_length'] = self.msg_length
+        return dictionary
+
+
+def _unset_to_empty(value):
+    return str(value) if value is not None else ''
+
+
+def _decode_sd(data, offset, end):
+    sd = dict()
+
+    try:
+        while offset < end:
+            length, = _U16.unpack_from(data, offset)
+            offset += 2
+            sd_name = data[offset:offset + length]
+            offset += length
+
+            count, = _U16.unpack_from(data, offset)
+            offset += 2
+            sde = sd.setdefault(sd_name, dict())
+
+            for _ in range(count):
+                length, = _U16.unpack_from(data, offset)
+                offset += 2
+                sd_fieldname = data[offset:offset + length]
+                offset += length
+
+                length, = _U32.unpack_from(data, offset)
+                offset += 4
+                sde[sd_fieldname] = data[offset:offset + length]
+                offset += length
+    except struct.error:
+        raise WireFormatError('Structured data block is truncated')
+
+    if offset != end:
+        raise WireFormatError('Structured data block is truncated')
+
+    return sd
+
+
+def is_binary(frame):
+    """
+    Returns True if the frame is the header of a binary message.
+    """
+    return bytes(frame[:1]) == _MAGIC
+
+
+def decode_frames(frames):
+    """
+    Decodes the frames of one zmq message, which may hold a batch, and returns
+    a list of messages. JSON messages are returned as dictionaries and binary
+    messages as BinaryRecord instances.
+
+    :param frames: A list of frames as returned by recv_multipart
+    """
+    messages = list()
+    index = 0
+
+    while index < len(frames):
+        frame = frames[index]
+        index += 1
+
+        if is_binary(frame):
+            if index == len(frames):
+                raise WireFormatError('Binary header has no body frame')
+
+            messages.append(BinaryRecord(frame, frames[index]))
+            index += 1
+        else:
+            messages.append(json.loads(frame))
+
+    return messages
@@ -59,6 +59,7 @@ def package_c():
         sources=[
             'include/syslog.c',
             'include/cstr.c',
+            'include/json.c',
             'portal/input/syslog/usyslog.c'
         ],
         extra_compile_args=COMPILER_ARGS))
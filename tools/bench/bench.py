@@ -0,0 +1,508 @@
+"""
+Times each layer of Portal on its own over a fixed corpus of syslog
+messages and a sweep of read chunk sizes:
+
+    c_exec          uslg_parser_exec with no-op callbacks (parser_bench.c)
+    parser_read     Parser.read with a no-op message handler
+    parser_batch    Parser.parse_batch
+    handler_json    Parser.read into SyslogToZeroMQHandler, serializing JSON
+    handler_binary  as handler_json with the binary wire format
+    tcp_zmq         a TCP client through SyslogServer and ZeroMQCaster to a
+                    ZeroMQReceiver, the server running in its own process
+
+The handler layers include the cost of parsing; subtract parser_read to get
+the cost of serializing alone. Each measurement is the best of several runs.
+
+Results are written as JSON. The compare command, or run with --baseline,
+reports how each result moved against a stored run and exits with status 1
+when any got slower by more than the threshold.
+
+Run from the project root after building the extension in place:
+
+    python tools/bench/bench.py run --output tools/bench/baseline.json
+    python tools/bench/bench.py run --baseline tools/bench/baseline.json
+    python tools/bench/bench.py compare baseline.json results.json
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+sys.path.insert(0, PROJECT_DIR)
+
+import zmq
+
+from portal.input.syslog import Parser, SyslogMessageHandler
+from portal.transport import SyslogToZeroMQHandler
+
+
+# Bumped whenever the corpus changes so that results of different corpora
+# are not compared
+CORPUS_VERSION = 1
+CORPUS_MESSAGES = 64
+
+BODY = (
+    b'Connection from 10.13.0.254 port 41263 closed by remote host after '
+    b'reaching the configured idle timeout for the session')
+
+LAYERS = (
+    'c_exec', 'parser_read', 'parser_batch', 'handler_json',
+    'handler_binary', 'tcp_zmq')
+
+DEFAULT_CHUNKS = (64, 512, 4096, 65536)
+DEFAULT_THRESHOLD = 0.10
+
+
+def build_corpus():
+    """
+    Returns the benchmark corpus: 64 RFC 5424 messages with structured data,
+    alternating between newline and octet counted framing. This is the same
+    corpus parser_bench.c builds.
+    """
+    corpus = bytearray()
+
+    for index in range(CORPUS_MESSAGES):
+        message = (
+            b'<%d>1 2013-11-19T20:30:%02d.873490+00:00 '
+            b'c-10-13-0-%d.c0002.netdev-ord.ohthree.com rsyslogd %d - '
+            b'[meniscus tenant="95feffb0" '
+            b'token="4c5e9071-6791-4023-859c-aa39077582d0"]'
+            b'[origin software="rsyslogd" swVersion="7.2.5"] %s' % (
+                index % 192, index % 60, index, 1000 + index, BODY))
+
+        if index % 2:
+            corpus.extend(b'%d %s' % (len(message), message))
+        else:
+            corpus.extend(message + b'\n')
+
+    return bytes(corpus)
+
+
+def chunks_of(data, chunk_size):
+    return [data[offset:offset + chunk_size]
+            for offset in range(0, len(data), chunk_size)]
+
+
+class NoopHandler(SyslogMessageHandler):
+
+    def on_msg_head(self, msg_head):
+        pass
+
+    def on_msg_part(self, msg_part):
+        pass
+
+    def on_msg_complete(self, msg_length):
+        pass
+
+
+class NullCaster(object):
+    """
+    Stands in for ZeroMQCaster so that only serialization is timed.
+    """
+
+    def bind(self):
+        pass
+
+    def cast(self, msg):
+        pass
+
+    def cast_frames(self, frames):
+        pass
+
+
+def best_of(repeat, fn):
+    """
+    Runs fn repeat times and returns the fastest run in seconds.
+    """
+    best = None
+
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def time_reader(make_reader, chunks, iterations, repeat):
+    def run():
+        reader = make_reader()
+
+        for _ in range(iterations):
+            for chunk in chunks:
+                reader(chunk)
+
+    return best_of(repeat, run)
+
+
+def bench_parser_read(corpus, chunk_size, iterations, repeat):
+    chunks = chunks_of(corpus, chunk_size)
+    return time_reader(
+        lambda: Parser(NoopHandler()).read, chunks, iterations, repeat)
+
+
+def bench_parser_batch(corpus, chunk_size, iterations, repeat):
+    chunks = chunks_of(corpus, chunk_size)
+    return time_reader(
+        lambda: Parser().parse_batch, chunks, iterations, repeat)
+
+
+def bench_handler(wire_format):
+    def bench(corpus, chunk_size, iterations, repeat):
+        chunks = chunks_of(corpus, chunk_size)
+
+        def make_reader():
+            handler = SyslogToZeroMQHandler(NullCaster(), wire_format)
+            return Parser(handler, zero_copy=True).read
+
+        return time_reader(make_reader, chunks, iterations, repeat)
+
+    return bench
+
+
+class CParserBench(object):
+    """
+    Builds parser_bench.c once and runs it over the corpus. The program
+    reports its own timing, which is used in place of the wall clock.
+    """
+
+    def __init__(self):
+        self.build_dir = None
+        self.binary = None
+        self.corpus_path = None
+
+    def available(self, corpus):
+        if self.binary is not None:
+            return True
+
+        self.build_dir = tempfile.mkdtemp()
+        binary = os.path.join(self.build_dir, 'parser_bench')
+        sources = [
+            os.path.join(PROJECT_DIR, 'include', 'syslog.c'),
+            os.path.join(PROJECT_DIR, 'include', 'cstr.c'),
+            os.path.join(BENCH_DIR, 'parser_bench.c')]
+
+        try:
+            subprocess.check_call(
+                [os.getenv('CC', 'cc'), '-O2',
+                 '-I' + os.path.join(PROJECT_DIR, 'include'),
+                 '-o', binary] + sources)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            sys.stderr.write('Skipping c_exec, unable to build: {}\n'.format(
+                ex))
+            return False
+
+        self.corpus_path = os.path.join(self.build_dir, 'corpus')
+
+        with open(self.corpus_path, 'wb') as out:
+            out.write(corpus)
+
+        self.binary = binary
+        return True
+
+    def __call__(self, corpus, chunk_size, iterations, repeat):
+        best = None
+
+        for _ in range(repeat):
+            output = subprocess.check_output([
+                self.binary, str(iterations), str(chunk_size),
+                self.corpus_path])
+            ns_per_msg = float(re.search(
+                r'ns_per_msg=([0-9.]+)', output).group(1))
+            elapsed = ns_per_msg * iterations * CORPUS_MESSAGES / 1e9
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return best
+
+    def close(self):
+        if self.build_dir is not None:
+            shutil.rmtree(self.build_dir)
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _serve(syslog_port, zmq_port, ready):
+    # Runs in its own process so the client and receiver don't share the
+    # server's GIL
+    from portal.server import SyslogServer, start_io
+    from portal.transport import ZeroMQCaster
+
+    caster = ZeroMQCaster(('127.0.0.1', zmq_port))
+    server = SyslogServer(
+        ('127.0.0.1', syslog_port), None, zero_copy=True,
+        delegate_factory=lambda: SyslogToZeroMQHandler(caster))
+    caster.add_listener(server)
+    server.start(1)
+    ready.set()
+    start_io()
+
+
+class TcpZmqBench(object):
+    """
+    Sends the corpus to a SyslogServer over TCP and times how long until a
+    ZeroMQReceiver has every message. One server process serves every chunk
+    size.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.receiver = None
+
+    def available(self, corpus):
+        if self.process is not None:
+            return True
+
+        from portal.transport import ZeroMQReceiver
+
+        self.syslog_port = free_port()
+        zmq_port = free_port()
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(self.syslog_port, zmq_port, ready))
+        self.process.daemon = True
+        self.process.start()
+
+        if not ready.wait(10):
+            sys.stderr.write('Skipping tcp_zmq, server did not start\n')
+            return False
+
+        self.receiver = ZeroMQReceiver([('127.0.0.1', zmq_port)])
+        self.receiver.connect()
+        self.receiver.socket.setsockopt(zmq.RCVTIMEO, 10000)
+        return True
+
+    def __call__(self, corpus, chunk_size, iterations, repeat):
+        chunks = chunks_of(corpus, chunk_size)
+        expected = iterations * CORPUS_MESSAGES
+
+        def send():
+            client = socket.create_connection(
+                ('127.0.0.1', self.syslog_port))
+
+            for _ in range(iterations):
+                for chunk in chunks:
+                    client.sendall(chunk)
+
+            client.close()
+
+        def run():
+            sender = threading.Thread(target=send)
+            sender.start()
+            received = 0
+
+            while received < expected:
+                received += len(self.receiver.get_batch())
+
+            sender.join()
+
+        return best_of(repeat, run)
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.close()
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+
+def run_suite(layers, chunk_sizes, iterations, repeat):
+    """
+    Runs the given layers over every chunk size and returns the results.
+    """
+    corpus = build_corpus()
+    benches = {
+        'c_exec': CParserBench(),
+        'parser_read': bench_parser_read,
+        'parser_batch': bench_parser_batch,
+        'handler_json': bench_handler('json'),
+        'handler_binary': bench_handler('binary'),
+        'tcp_zmq': TcpZmqBench()
+    }
+
+    results = list()
+
+    try:
+        for layer in layers:
+            bench = benches[layer]
+
+            if hasattr(bench, 'available') and not bench.available(corpus):
+                continue
+
+            for chunk_size in chunk_sizes:
+                seconds = bench(corpus, chunk_size, iterations, repeat)
+                messages = iterations * CORPUS_MESSAGES
+                result = {
+                    'layer': layer,
+                    'chunk_size': chunk_size,
+                    'messages': messages,
+                    'seconds': seconds,
+                    'ns_per_msg': seconds * 1e9 / messages,
+                    'msgs_per_sec': messages / seconds if seconds else None,
+                    'mb_per_sec': (len(corpus) * iterations / seconds /
+                                   1048576.0 if seconds else None)
+                }
+                results.append(result)
+                print('{layer:<15} chunk={chunk_size:<6} '
+                      '{ns_per_msg:>10.1f} ns/msg {msgs_per_sec:>12.0f} '
+                      'msgs/sec'.format(**result))
+    finally:
+        for bench in benches.values():
+            if hasattr(bench, 'close'):
+                bench.close()
+
+    return {
+        'meta': {
+            'corpus_version': CORPUS_VERSION,
+            'corpus_sha1': hashlib.sha1(corpus).hexdigest(),
+            'iterations': iterations,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'results': results
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two result sets by ns_per_msg and returns a list of
+    (layer, chunk_size, baseline ns, current ns, change) tuples along with
+    the ones that got slower by more than threshold, a fraction.
+    """
+    if (baseline['meta'].get('corpus_sha1') !=
+            current['meta'].get('corpus_sha1')):
+        sys.stderr.write(
+            'Warning: results were measured over different corpora\n')
+
+    before = dict(
+        ((r['layer'], r['chunk_size']), r['ns_per_msg'])
+        for r in baseline['results'])
+
+    changes = list()
+    regressions = list()
+
+    for result in current['results']:
+        key = (result['layer'], result['chunk_size'])
+
+        if key not in before:
+            continue
+
+        change = result['ns_per_msg'] / before[key] - 1
+        entry = key + (before[key], result['ns_per_msg'], change)
+        changes.append(entry)
+
+        if change > threshold:
+            regressions.append(entry)
+
+    return changes, regressions
+
+
+def report(changes, regressions):
+    for layer, chunk_size, before, after, change in changes:
+        flag = ' REGRESSION' if (
+            layer, chunk_size, before, after, change) in regressions else ''
+        print('{:<15} chunk={:<6} {:>10.1f} -> {:>10.1f} ns/msg '
+              '{:>+7.1%}{}'.format(
+                  layer, chunk_size, before, after, change, flag))
+
+    if regressions:
+        print('{} of {} results regressed'.format(
+            len(regressions), len(changes)))
+
+
+def load(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help='run the benchmarks')
+    run.add_argument(
+        '--layers', default=','.join(LAYERS),
+        help='comma separated layers to run (default: all)')
+    run.add_argument(
+        '--chunks', default=','.join(str(c) for c in DEFAULT_CHUNKS),
+        help='comma separated read chunk sizes in bytes')
+    run.add_argument(
+        '--iterations', type=int, default=500,
+        help='times the corpus is parsed per run')
+    run.add_argument(
+        '--repeat', type=int, default=3,
+        help='runs per measurement; the fastest is kept')
+    run.add_argument('--output', help='file to write the results to')
+    run.add_argument('--baseline', help='results to compare against')
+    run.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='slowdown counted as a regression (default: 0.10)')
+
+    cmp_parser = commands.add_parser(
+        'compare', help='compare two result files')
+    cmp_parser.add_argument('baseline')
+    cmp_parser.add_argument('results')
+    cmp_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='slowdown counted as a regression (default: 0.10)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        changes, regressions = compare(
+            load(args.baseline), load(args.results), args.threshold)
+        report(changes, regressions)
+        return 1 if regressions else 0
+
+    layers = [layer for layer in args.layers.split(',') if layer]
+
+    for layer in layers:
+        if layer not in LAYERS:
+            parser.error('unknown layer: {}'.format(layer))
+
+    results = run_suite(
+        layers, [int(c) for c in args.chunks.split(',')],
+        args.iterations, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        changes, regressions = compare(
+            load(args.baseline), results, args.threshold)
+        report(changes, regressions)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,506 @@
+"""
+Generates syslog load against a running Portal and reports the rate it
+achieved along with the end to end latency seen by a zmq consumer.
+
+Load is spread over worker processes, each of which holds its share of the
+connections open on its own I/O loop. Every message carries a marker with
+the time it was written so that the consumer, pulling from Portal's zmq
+endpoints, can tell how long it took to come out the other side. The
+consumer only counts messages from this run.
+
+Messages mix the framings, structured data and body sizes seen in practice:
+
+    framing     octet counted or newline terminated (--octet-ratio)
+    sd          none, light (one element) or heavy (several elements with
+                escaped values), weighted with --sd
+    body        short, medium or large (several KB), weighted with --body
+
+Each message may be cut into chunks written separately, with TCP_NODELAY
+set, so that Portal reads partial frames (--chunk-min, --chunk-max).
+
+Example, 2000 connections over 4 processes at 50000 messages a second
+against a Portal running 4 workers:
+
+    python tools/bench/loadgen.py --connections 2000 --processes 4 \\
+        --rate 50000 --duration 60 --zmq 127.0.0.1:5000-5003
+
+The consumer runs on the same host as the workers since latency is
+measured with the local clock.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import ssl
+import sys
+import threading
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+sys.path.insert(0, PROJECT_DIR)
+
+import zmq
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from portal.metrics import Histogram
+from portal.wire import decode_frames
+
+
+TICK_MS = 5
+
+BODY_SIZES = {
+    'short': (16, 128),
+    'medium': (256, 1024),
+    'large': (2048, 8192)
+}
+
+SD_SHAPES = ('none', 'light', 'heavy')
+
+_WORDS = (
+    b'connection', b'closed', b'session', b'opened', b'user', b'from',
+    b'port', b'timeout', b'request', b'failed', b'accepted', b'kernel',
+    b'disk', b'queue', b'error', b'retry', b'cache', b'worker')
+
+
+def parse_weights(spec, names):
+    """
+    Parses weights such as 'none:1,light:2' into a list of (name, weight).
+    """
+    weights = list()
+
+    for part in spec.split(','):
+        name, _, weight = part.partition(':')
+
+        if name not in names:
+            raise ValueError('Unknown choice: {}'.format(name))
+
+        weights.append((name, float(weight or 1)))
+
+    return weights
+
+
+def parse_endpoints(spec):
+    """
+    Parses host:port or host:first-last into a list of (host, port).
+    """
+    host, _, ports = spec.rpartition(':')
+    first, _, last = ports.partition('-')
+    return [(host, port) for port in range(int(first), int(last or first) + 1)]
+
+
+class MessageFactory(object):
+    """
+    Builds syslog messages in the configured mix of shapes. The marker
+    written at the start of each body is 'lg <run id> <sent at>'.
+    """
+
+    def __init__(self, run_id, octet_ratio=0.5, sd_weights=None,
+                 body_weights=None, seed=None):
+        self.run_id = run_id
+        self.octet_ratio = octet_ratio
+        self.sd_weights = sd_weights or [(shape, 1) for shape in SD_SHAPES]
+        self.body_weights = body_weights or [
+            ('short', 6), ('medium', 3), ('large', 1)]
+        self.random = random.Random(seed)
+        self.hostname = socket.gethostname()
+
+    def _choose(self, weights):
+        point = self.random.uniform(0, sum(w for _, w in weights))
+
+        for name, weight in weights:
+            point -= weight
+            if point <= 0:
+                return name
+
+        return weights[-1][0]
+
+    def _sd(self, shape):
+        if shape == 'none':
+            return b'-'
+
+        if shape == 'light':
+            return b'[meniscus tenant="95feffb0" token="%s"]' % (
+                uuid.UUID(int=self.random.getrandbits(128)))
+
+        elements = list()
+
+        for index in range(self.random.randint(3, 6)):
+            params = b' '.join(
+                b'p%d="%s \\"quoted\\" \\]bracket %d"' % (
+                    param, self.random.choice(_WORDS), param)
+                for param in range(self.random.randint(4, 8)))
+            elements.append(b'[el%d@32473 %s]' % (index, params))
+
+        return b''.join(elements)
+
+    def _body(self, size):
+        low, high = BODY_SIZES[size]
+        length = self.random.randint(low, high)
+        words = list()
+        total = 0
+
+        while total < length:
+            word = self.random.choice(_WORDS)
+            words.append(word)
+            total += len(word) + 1
+
+        return b' '.join(words)
+
+    def build(self):
+        """
+        Returns the next message, framed and ready to write.
+        """
+        message = b'<%d>1 %s %s loadgen %d - %s lg %s %.6f %s' % (
+            self.random.randint(0, 191),
+            time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            self.hostname,
+            os.getpid(),
+            self._sd(self._choose(self.sd_weights)),
+            self.run_id,
+            time.time(),
+            self._body(self._choose(self.body_weights)))
+
+        if self.random.random() < self.octet_ratio:
+            return b'%d %s' % (len(message), message)
+        return message + b'\n'
+
+
+class LoadWorker(object):
+    """
+    LoadWorker holds a share of the connections open on its own I/O loop and
+    writes messages to them in turn at its share of the target rate.
+    """
+
+    def __init__(self, args, index):
+        self.args = args
+        self.index = index
+        self.factory = MessageFactory(
+            args.run_id, args.octet_ratio,
+            parse_weights(args.sd, SD_SHAPES),
+            parse_weights(args.body, BODY_SIZES),
+            seed=None if args.seed is None else args.seed + index)
+        self.random = random.Random(self.factory.random.random())
+
+        share, extra = divmod(args.connections, args.processes)
+        self.connection_count = share + (1 if index < extra else 0)
+        self.rate = args.rate / float(args.processes)
+
+        self.streams = list()
+        self.next_stream = 0
+        self.budget = 0.0
+        self.last_tick = None
+        self.stats = dict.fromkeys(
+            ('sent', 'bytes', 'writes', 'connect_errors', 'closed',
+             'blocked'), 0)
+
+        self.io_loop = IOLoop.current()
+        self.ticker = PeriodicCallback(self.tick, TICK_MS)
+
+    def start(self):
+        client = TCPClient()
+        ssl_options = None
+
+        if self.args.tls:
+            ssl_options = {'cert_reqs': ssl.CERT_NONE}
+
+        for _ in range(self.connection_count):
+            future = client.connect(
+                self.args.host, self.args.port, ssl_options=ssl_options)
+            self.io_loop.add_future(future, self._on_connect)
+
+        self.started = time.time()
+        self.ticker.start()
+        self.io_loop.call_later(self.args.duration, self.stop)
+
+    def _on_connect(self, future):
+        try:
+            stream = future.result()
+        except Exception:
+            self.stats['connect_errors'] += 1
+            return
+
+        stream.set_nodelay(True)
+        self.streams.append(stream)
+
+    def tick(self):
+        now = time.time()
+        elapsed = now - (self.last_tick or now)
+        self.last_tick = now
+
+        if not self.streams:
+            return
+
+        if self.rate > 0:
+            # Don't let a stall turn into a burst of more than 100ms of load
+            self.budget = min(
+                self.budget + self.rate * elapsed, self.rate * 0.1 + 1)
+        else:
+            self.budget = len(self.streams) * 4
+
+        skipped = 0
+
+        while self.budget >= 1 and skipped < len(self.streams):
+            stream = self.streams[self.next_stream % len(self.streams)]
+            self.next_stream += 1
+
+            if stream.closed():
+                self.streams.remove(stream)
+                self.stats['closed'] += 1
+                if not self.streams:
+                    return
+                continue
+
+            # Connections the kernel won't take more data on are skipped
+            # until Portal catches up
+            if stream.writing():
+                self.stats['blocked'] += 1
+                skipped += 1
+                continue
+
+            skipped = 0
+            self.budget -= 1
+            self._write(stream, self.factory.build())
+
+    def _write(self, stream, message):
+        chunk_max = self.args.chunk_max or len(message)
+        chunk_min = min(self.args.chunk_min or chunk_max, chunk_max)
+        offset = 0
+
+        try:
+            while offset < len(message):
+                size = self.random.randint(chunk_min, chunk_max)
+                stream.write(message[offset:offset + size])
+                offset += size
+                self.stats['writes'] += 1
+        except StreamClosedError:
+            return
+
+        self.stats['sent'] += 1
+        self.stats['bytes'] += len(message)
+
+    def stop(self):
+        self.ticker.stop()
+        self.stats['seconds'] = time.time() - self.started
+
+        for stream in self.streams:
+            stream.close()
+
+        self.io_loop.stop()
+
+
+def run_worker(args, index, results):
+    worker = LoadWorker(args, index)
+    worker.start()
+    IOLoop.current().start()
+    results.put(worker.stats)
+
+
+class Consumer(threading.Thread):
+    """
+    Consumer pulls from Portal's zmq endpoints and records the latency of
+    every message belonging to this run.
+    """
+
+    def __init__(self, endpoints, run_id):
+        super(Consumer, self).__init__()
+        self.daemon = True
+        self.endpoints = endpoints
+        self.marker = 'lg {} '.format(run_id)
+        self.received = 0
+        self.foreign = 0
+        self.latency = Histogram()
+        self.running = True
+
+    def run(self):
+        context = zmq.Context()
+        pull = context.socket(zmq.PULL)
+
+        for host, port in self.endpoints:
+            pull.connect('tcp://{}:{}'.format(host, port))
+
+        poller = zmq.Poller()
+        poller.register(pull, zmq.POLLIN)
+
+        while self.running:
+            if not poller.poll(100):
+                continue
+
+            frames = pull.recv_multipart()
+            now = time.time()
+
+            for message in decode_frames(frames):
+                self._record(message, now)
+
+        pull.close()
+        context.term()
+
+    def _record(self, message, now):
+        if isinstance(message, dict):
+            body = message.get('message', u'')
+        else:
+            body = message.message.decode('utf-8', 'replace')
+
+        if not body.startswith(self.marker):
+            self.foreign += 1
+            return
+
+        sent_at = float(body[len(self.marker):].split(' ', 1)[0])
+        self.received += 1
+        self.latency.observe(max(now - sent_at, 0))
+
+
+def percentile(histogram, fraction):
+    """
+    Returns the upper bound of the bucket holding the given fraction of the
+    observed values.
+    """
+    if not histogram.count:
+        return None
+
+    target = histogram.count * fraction
+    seen = 0
+
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        seen += count
+        if seen >= target:
+            return bound
+
+    return float('inf')
+
+
+def report(args, stats, consumer, drained_for):
+    seconds = max(s['seconds'] for s in stats) if stats else 0
+    totals = dict((key, sum(s[key] for s in stats)) for key in (
+        'sent', 'bytes', 'writes', 'connect_errors', 'closed', 'blocked'))
+
+    result = {
+        'connections': args.connections,
+        'processes': args.processes,
+        'target_rate': args.rate,
+        'seconds': seconds,
+        'sent': totals['sent'],
+        'sent_rate': totals['sent'] / seconds if seconds else 0,
+        'mb_per_sec': totals['bytes'] / seconds / 1048576.0 if seconds else 0,
+        'writes': totals['writes'],
+        'connect_errors': totals['connect_errors'],
+        'closed': totals['closed'],
+        'blocked': totals['blocked']
+    }
+
+    if consumer is not None:
+        latency = consumer.latency
+        result.update({
+            'received': consumer.received,
+            'lost': totals['sent'] - consumer.received,
+            'foreign': consumer.foreign,
+            'drained_for': drained_for,
+            'latency_mean': latency.sum / latency.count if latency.count
+            else None,
+            'latency_p50': percentile(latency, 0.5),
+            'latency_p90': percentile(latency, 0.9),
+            'latency_p99': percentile(latency, 0.99)
+        })
+
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5140)
+    parser.add_argument('--tls', action='store_true',
+                        help='connect with TLS without verifying the server')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--rate', type=float, default=10000,
+                        help='messages per second over all connections; '
+                        '0 sends as fast as Portal takes them')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to send for')
+    parser.add_argument('--octet-ratio', type=float, default=0.5,
+                        help='fraction of messages that are octet counted')
+    parser.add_argument('--sd', default='none:1,light:1,heavy:1',
+                        help='structured data weights')
+    parser.add_argument('--body', default='short:6,medium:3,large:1',
+                        help='body size weights')
+    parser.add_argument('--chunk-min', type=int, default=0,
+                        help='smallest write in bytes; 0 writes whole '
+                        'messages')
+    parser.add_argument('--chunk-max', type=int, default=0,
+                        help='largest write in bytes')
+    parser.add_argument('--zmq', action='append', default=list(),
+                        help='host:port or host:first-last of Portal zmq '
+                        'endpoints to consume from; may be repeated')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='most seconds to wait for the consumer to '
+                        'catch up after sending stops')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args(argv)
+    args.run_id = uuid.uuid4().hex[:12]
+
+    try:
+        parse_weights(args.sd, SD_SHAPES)
+        parse_weights(args.body, BODY_SIZES)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    consumer = None
+    endpoints = [e for spec in args.zmq for e in parse_endpoints(spec)]
+
+    if endpoints:
+        consumer = Consumer(endpoints, args.run_id)
+        consumer.start()
+
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args, i, results))
+        for i in range(args.processes)]
+
+    for worker in workers:
+        worker.start()
+
+    stats = [results.get() for _ in workers]
+
+    for worker in workers:
+        worker.join()
+
+    drained_for = 0
+
+    if consumer is not None:
+        sent = sum(s['sent'] for s in stats)
+        start = time.time()
+
+        while consumer.received < sent and time.time() - start < args.drain:
+            time.sleep(0.05)
+
+        drained_for = time.time() - start
+        consumer.running = False
+        consumer.join()
+
+    result = report(args, stats, consumer, drained_for)
+
+    for key in sorted(result):
+        print('{:<16} {}'.format(key, result[key]))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(result, out, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+Reports how much memory a Portal process spends on each idle connection.
+
+A Portal syslog server is started in a child process with a handler per
+connection, as in production, but with nothing sent downstream. Connections
+are then opened in stages, by default up to 1000, 10000 and 50000, and one
+message is written on each so that every parser has been through a whole
+message before it sits idle. At every stage the server's resident memory is
+read from /proc and the growth over the server at rest is divided by the
+number of connections.
+
+Run once with the buffer pool and once without to see what pooling saves:
+
+    python tools/bench/memory_scaling.py
+    python tools/bench/memory_scaling.py --pool-size 0
+
+Each connection takes a file descriptor on both ends, so the open file limit
+must allow for the largest stage; stages that do not fit are skipped. Client
+sockets are spread over several loopback source addresses so that the
+ephemeral port range does not cap the count.
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import struct
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+sys.path.insert(0, PROJECT_DIR)
+
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from portal.input.syslog import BufferPool, SyslogMessageHandler
+from portal.server import SyslogServer
+
+
+MESSAGE = (
+    b'<46>1 2012-12-11T15:48:23.217459-06:00 tohru rsyslogd 6611 - '
+    b'[origin software="rsyslogd"] idle connection\n')
+
+# Connections per loopback source address, kept under the default ephemeral
+# port range of about 28000 ports
+CONNECTIONS_PER_SOURCE = 20000
+
+# Descriptors kept back for the interpreter, listener and pipes
+RESERVED_FDS = 64
+
+
+class CountingHandler(SyslogMessageHandler):
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.msg_head = None
+
+    def on_msg_head(self, msg_head):
+        self.msg_head = msg_head
+
+    def on_msg_part(self, msg_part):
+        pass
+
+    def on_msg_complete(self, msg_length):
+        self.counts[0] += 1
+
+
+def rss_bytes(pid):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+    raise ValueError('No VmRSS for pid {}'.format(pid))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+
+def run_server(args, ready, commands):
+    raise_fd_limit()
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+
+    buffer_pool = None
+
+    if args.pool_size > 0:
+        buffer_pool = BufferPool(
+            capacity=args.pool_size,
+            initial_size=args.buffer_size,
+            max_size=args.buffer_max_size)
+
+    counts = [0]
+    server = SyslogServer(
+        ('127.0.0.1', 0), None, zero_copy=True, buffer_pool=buffer_pool,
+        delegate_factory=lambda: CountingHandler(counts))
+    sockets = bind_sockets(0, '127.0.0.1', backlog=4096)
+    server.add_sockets(sockets)
+
+    def on_command(fd, events):
+        command = commands.recv()
+
+        if command == 'stop':
+            io_loop.stop()
+            return
+
+        gc.collect()
+        commands.send({
+            'connections': len(server.connections),
+            'messages': counts[0],
+            'pooled': buffer_pool.pooled if buffer_pool else None,
+            'created': buffer_pool.created if buffer_pool else None
+        })
+
+    io_loop.add_handler(commands.fileno(), on_command, IOLoop.READ)
+    ready.send(sockets[0].getsockname()[1])
+    io_loop.start()
+
+
+class Clients(object):
+
+    def __init__(self, port):
+        self.port = port
+        self.sockets = list()
+
+    def open(self, count):
+        while len(self.sockets) < count:
+            source = 2 + len(self.sockets) // CONNECTIONS_PER_SOURCE
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            # Reset on close so that no ports are left in TIME_WAIT
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            sock.bind(('127.0.0.{}'.format(source), 0))
+            sock.connect(('127.0.0.1', self.port))
+            sock.sendall(MESSAGE)
+            self.sockets.append(sock)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+        del self.sockets[:]
+
+
+def wait_for(commands, count, timeout):
+    deadline = time.time() + timeout
+
+    while True:
+        commands.send('stats')
+        stats = commands.recv()
+
+        if stats['connections'] >= count and stats['messages'] >= count:
+            return stats
+
+        if time.time() > deadline:
+            raise RuntimeError(
+                'Server has {connections} connections and {messages} '
+                'messages after {0} seconds'.format(timeout, **stats))
+
+        time.sleep(0.1)
+
+
+def measure(args):
+    fd_limit = raise_fd_limit()
+
+    ready, child_ready = multiprocessing.Pipe()
+    commands, child_commands = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=run_server, args=(args, child_ready, child_commands))
+    server.start()
+
+    results = list()
+    clients = Clients(ready.recv())
+
+    try:
+        wait_for(commands, 0, args.timeout)
+        base_rss = rss_bytes(server.pid)
+
+        for count in args.connections:
+            if count + RESERVED_FDS > fd_limit:
+                results.append({
+                    'connections': count,
+                    'skipped': 'open file limit is {}'.format(fd_limit)})
+                continue
+
+            clients.open(count)
+            stats = wait_for(commands, count, args.timeout)
+            rss = rss_bytes(server.pid)
+
+            results.append({
+                'connections': count,
+                'rss': rss,
+                'per_connection': float(rss - base_rss) / count,
+                'buffers_pooled': stats['pooled'],
+                'buffers_created': stats['created']})
+    finally:
+        clients.close()
+        commands.send('stop')
+        server.join(5)
+
+    return {
+        'pool_size': args.pool_size,
+        'buffer_size': args.buffer_size,
+        'buffer_max_size': args.buffer_max_size,
+        'base_rss': base_rss,
+        'results': results}
+
+
+def print_report(report, out=sys.stdout):
+    out.write('pool_size={pool_size} buffer_size={buffer_size} '
+              'buffer_max_size={buffer_max_size} '
+              'base_rss={base_rss}\n'.format(**report))
+    out.write('{:>12} {:>14} {:>16}\n'.format(
+        'connections', 'rss', 'bytes/conn'))
+
+    for result in report['results']:
+        if 'skipped' in result:
+            out.write('{:>12} skipped: {}\n'.format(
+                result['connections'], result['skipped']))
+        else:
+            out.write('{connections:>12} {rss:>14} '
+                      '{per_connection:>16.0f}\n'.format(**result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', default='1000,10000,50000',
+                        help='comma separated connection counts to measure')
+    parser.add_argument('--pool-size', type=int, default=1024,
+                        help='parse buffers kept for reuse; 0 gives every '
+                        'connection its own buffer')
+    parser.add_argument('--buffer-size', type=int, default=256)
+    parser.add_argument('--buffer-max-size', type=int, default=65536)
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='most seconds to wait for a stage to connect')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args(argv)
+    args.connections = sorted(int(c) for c in args.connections.split(','))
+
+    report = measure(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+/**
+* Times uslg_parser_exec over a fixed corpus of syslog messages and reports
+* the cost per message. Build it once with the default fast path and once
+* with -DUSLG_NO_FAST_PATH to compare against the byte at a time state
+* machine. See parser_bench.sh.
+*
+* A corpus file may be given in place of the built in corpus, as the
+* benchmark suite in bench.py does so that every layer parses the same data.
+*/
+#include "syslog.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#define HAS_TSC 1
+#else
+#define HAS_TSC 0
+#endif
+
+#define CORPUS_MESSAGES     64
+
+static const char *BODY =
+    "Connection from 10.13.0.254 port 41263 closed by remote host after "
+    "reaching the configured idle timeout for the session";
+
+static long completed = 0;
+
+static int on_cb(syslog_parser *parser) {
+    return 0;
+}
+
+static int on_complete_cb(syslog_parser *parser) {
+    completed++;
+    return 0;
+}
+
+static int on_data_cb(syslog_parser *parser, const char *data, size_t len) {
+    return 0;
+}
+
+static size_t build_corpus(char *corpus, size_t size) {
+    size_t position = 0;
+    int index;
+
+    for (index = 0; index < CORPUS_MESSAGES; index++) {
+        char message[1024];
+        int length;
+
+        length = snprintf(message, sizeof(message),
+            "<%d>1 2013-11-19T20:30:%02d.873490+00:00 "
+            "c-10-13-0-%d.c0002.netdev-ord.ohthree.com rsyslogd %d - "
+            "[meniscus tenant=\"95feffb0\" "
+            "token=\"4c5e9071-6791-4023-859c-aa39077582d0\"]"
+            "[origin software=\"rsyslogd\" swVersion=\"7.2.5\"] %s",
+            index % 192, index % 60, index, 1000 + index, BODY);
+
+        if (index % 2) {
+            // Octet counted framing
+            position += snprintf(corpus + position, size - position,
+                "%d %s", length, message);
+        } else {
+            // Newline framing
+            position += snprintf(corpus + position, size - position,
+                "%s\n", message);
+        }
+    }
+
+    return position;
+}
+
+static char * read_corpus(const char *path, size_t *size) {
+    FILE *corpus_file;
+    char *corpus;
+    long length;
+
+    corpus_file = fopen(path, "rb");
+
+    if (corpus_file == NULL) {
+        return NULL;
+    }
+
+    fseek(corpus_file, 0, SEEK_END);
+    length = ftell(corpus_file);
+    fseek(corpus_file, 0, SEEK_SET);
+
+    corpus = (char *) malloc(length > 0 ? length : 1);
+
+    if (corpus != NULL && fread(corpus, 1, length, corpus_file) != length) {
+        free(corpus);
+        corpus = NULL;
+    }
+
+    fclose(corpus_file);
+    *size = length;
+    return corpus;
+}
+
+static double now(void) {
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+int main(int argc, char **argv) {
+    static char built_corpus[CORPUS_MESSAGES * 1024];
+    char *corpus = built_corpus;
+    syslog_parser_settings settings = {
+        on_cb, on_data_cb, on_data_cb, on_data_cb,
+        on_cb, on_data_cb, on_complete_cb
+    };
+    syslog_parser *parser;
+    size_t corpus_size, chunk_size, offset;
+    long iterations, iteration, messages;
+    unsigned long long cycles = 0;
+    double elapsed;
+
+    iterations = argc > 1 ? atol(argv[1]) : 20000;
+    chunk_size = argc > 2 ? (size_t) atol(argv[2]) : 4096;
+
+    if (argc > 3) {
+        corpus = read_corpus(argv[3], &corpus_size);
+
+        if (corpus == NULL) {
+            fprintf(stderr, "Unable to read corpus %s\n", argv[3]);
+            return 1;
+        }
+    } else {
+        corpus_size = build_corpus(built_corpus, sizeof(built_corpus));
+    }
+
+    parser = (syslog_parser *) malloc(sizeof(syslog_parser));
+
+    if (parser == NULL || uslg_parser_init(parser, NULL)) {
+        fprintf(stderr, "Unable to create parser\n");
+        return 1;
+    }
+
+    elapsed = now();
+#if HAS_TSC
+    cycles = __rdtsc();
+#endif
+
+    for (iteration = 0; iteration < iterations; iteration++) {
+        for (offset = 0; offset < corpus_size; offset += chunk_size) {
+            size_t length = corpus_size - offset;
+
+            if (length > chunk_size) {
+                length = chunk_size;
+            }
+
+            if (uslg_parser_exec(parser, &settings, corpus + offset, length)) {
+                fprintf(stderr, "Parsing failed\n");
+                return 1;
+            }
+        }
+    }
+
+#if HAS_TSC
+    cycles = __rdtsc() - cycles;
+#endif
+    elapsed = now() - elapsed;
+    messages = completed;
+
+    printf("messages=%ld chunk=%zu ns_per_msg=%.1f cycles_per_msg=%.1f "
+           "msgs_per_sec=%.0f\n",
+        messages,
+        chunk_size,
+        elapsed * 1e9 / messages,
+        (double) cycles / messages,
+        messages / elapsed);
+
+    uslg_free_parser(parser);
+
+    if (corpus != built_corpus) {
+        free(corpus);
+    }
+
+    return 0;
+}
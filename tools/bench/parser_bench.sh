@@ -0,0 +1,19 @@
+#!/bin/sh
+
+# Compares the C parser fast path against the byte at a time state machine
+# by building tools/bench/parser_bench.c both ways. Run from the project root.
+#
+# usage: tools/bench/parser_bench.sh [iterations] [chunk size] [corpus file]
+
+ITERATIONS="${1:-20000}"
+CHUNK_SIZE="${2:-4096}"
+BUILD_DIR="$(mktemp -d)"
+SOURCES="include/syslog.c include/cstr.c tools/bench/parser_bench.c"
+
+cc -O2 -Iinclude -o "${BUILD_DIR}/fast" ${SOURCES} || exit 1
+cc -O2 -Iinclude -DUSLG_NO_FAST_PATH -o "${BUILD_DIR}/bytewise" ${SOURCES} || exit 1
+
+echo "bytewise: $("${BUILD_DIR}/bytewise" "${ITERATIONS}" "${CHUNK_SIZE}" ${3})"
+echo "fast:     $("${BUILD_DIR}/fast" "${ITERATIONS}" "${CHUNK_SIZE}" ${3})"
+
+rm -rf "${BUILD_DIR}"
@@ -0,0 +1,162 @@
+"""
+Times how long routing rules take to evaluate per message.
+
+A corpus of parsed records with a spread of hostnames, appnames and
+structured data tenants is built once. Rule sets of growing size are then
+compiled, each made of a mix of exact, prefix, regular expression and
+structured data rules, and applied to every record. All but the last rule
+only tag, so every message is tried against every rule, which is the worst
+case for a rule set of that size. The cost of JSON encoding the same records
+is shown alongside as the work that dropped messages are spared.
+
+    python tools/bench/rules_bench.py
+    python tools/bench/rules_bench.py --rules 1,10,100,1000 --messages 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+sys.path.insert(0, PROJECT_DIR)
+
+from portal.input.syslog import JsonEncoder, Parser
+from portal.routing import DROP, TAG, Rule, RuleSet
+
+
+APPNAMES = ('sshd', 'CRON', 'nginx', 'postgres', 'kernel', 'app-api',
+            'app-worker', 'haproxy')
+TENANTS = ('acme', 'globex', 'initech', 'umbrella', 'hooli')
+
+
+def build_corpus(count, seed=1):
+    rand = random.Random(seed)
+    lines = list()
+
+    for index in range(count):
+        lines.append(
+            '<46>1 2012-12-11T15:48:23.217459-06:00 {}-{}.dc{} {} {} - '
+            '[meta tenant="{}" env="prod"] request {} served\n'.format(
+                rand.choice(('web', 'db', 'build', 'ci')),
+                rand.randint(1, 500), rand.randint(1, 4),
+                rand.choice(APPNAMES), rand.randint(100, 99999),
+                rand.choice(TENANTS), index))
+
+    records, pending = Parser().parse_batch(b''.join(lines))
+    return records
+
+
+def build_rules(count):
+    rules = list()
+
+    for index in range(count - 1):
+        kind = index % 4
+        name = 'rule-{}'.format(index)
+
+        if kind == 0:
+            rule = Rule(name, TAG, tag=name, fields={
+                'appname': ['app-{}'.format(index), 'svc-{}'.format(index)]})
+        elif kind == 1:
+            rule = Rule(name, TAG, tag=name, fields={
+                'hostname': ['rack{}-*'.format(index), 'edge{}*'.format(index)]})
+        elif kind == 2:
+            rule = Rule(name, TAG, tag=name, fields={
+                'hostname': ['/^lb{}\\./'.format(index)]})
+        else:
+            rule = Rule(name, TAG, tag=name, sd=[
+                ('meta', 'tenant', ['tenant-{}'.format(index)])])
+
+        rules.append(rule)
+
+    rules.append(Rule('cron', DROP, fields={'appname': ['CRON']}))
+    return RuleSet(rules)
+
+
+def best_of(repeats, fn):
+    best = None
+
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def measure(args):
+    records = build_corpus(args.messages)
+    encoder = JsonEncoder()
+    results = list()
+
+    def encode_all():
+        for record in records:
+            encoder.encode(record, record.message, record.msg_length)
+
+    encode_time = best_of(args.repeats, encode_all)
+
+    for count in args.rules:
+        rule_set = build_rules(count)
+        apply_rules = rule_set.apply
+
+        def apply_all():
+            for record in records:
+                apply_rules(record)
+
+        # Tags are added to the records' structured data, so each run
+        # starts from untagged records
+        for record in records:
+            record.sd.pop('portal', None)
+
+        elapsed = best_of(args.repeats, apply_all)
+        results.append({
+            'rules': count,
+            'ns_per_msg': elapsed / len(records) * 1e9,
+            'dropped': rule_set.rules[-1].hits // args.repeats})
+
+    return {
+        'messages': len(records),
+        'json_ns_per_msg': encode_time / len(records) * 1e9,
+        'results': results}
+
+
+def print_report(report, out=sys.stdout):
+    out.write('messages={messages} json_ns_per_msg={json_ns_per_msg:.0f}\n'
+              .format(**report))
+    out.write('{:>8} {:>12} {:>10}\n'.format('rules', 'ns/msg', 'dropped'))
+
+    for result in report['results']:
+        out.write('{rules:>8} {ns_per_msg:>12.0f} {dropped:>10}\n'.format(
+            **result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', default='1,10,100',
+                        help='comma separated rule set sizes to measure')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='runs per measurement, the best is kept')
+    parser.add_argument('--output', help='file to write the report to')
+    args = parser.parse_args(argv)
+    args.rules = [int(count) for count in args.rules.split(',')]
+
+    report = measure(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()